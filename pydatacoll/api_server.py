@@ -1,44 +1,107 @@
-import pkgutil
+import hmac
+import ipaddress
+import os
+import signal
+import time
 from collections import defaultdict
+from itertools import chain
 try:
     import ujson as json
 except ImportError:
     import json
 import asyncio
-import functools
 import aioredis
 # import api_hour
+import aiohttp
 from aiohttp import web
-import redis
 
+from pydatacoll.utils import backend, bulk_config, codec, compress, data_export, key_index, metrics, profiler
+from pydatacoll.utils.loop_monitor import LoopMonitor
+from pydatacoll.utils.config_cache import ConfigCache, etag_matches, sort_ids
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.utils.json_response import JSON
 from pydatacoll.resources.protocol import *
 from pydatacoll.utils.func_container import ParamFunctionContainer, param_function
+from pydatacoll.utils.live_push import LiveDataHub, DEFAULT_INTERVAL
+from pydatacoll.utils.reply_mux import ReplyDispatcher
 from pydatacoll import plugins
 
 logger = my_logger.get_logger('APIServer')
 HANDLER_TIME_OUT = 10
+DRAIN_TIMEOUT = 10  # 停止时等待处理中请求的最长时间(秒)
+JSON_TYPE = 'application/json; charset=utf-8'
+SERIES_TYPE = 'application/x-pydatacoll-series'  # 格式见pydatacoll.utils.codec
+DATA_FORMATS = ('json', 'columnar', 'binary')
+ENCODE_OFFLOAD = 10000  # 数据点数不少于此值时在线程池中编码
+ADMIN_TOKEN_ENV = 'PYDATACOLL_ADMIN_TOKEN'  # 管理接口的令牌, 未设置时只允许本机访问
+PROFILE_SECONDS = 10  # 性能分析的默认时长(秒)
+
+HTTP_REQUESTS = metrics.counter('pydatacoll_http_requests_total', 'HTTP requests by handler and status',
+                                ('handler', 'method', 'status'))
+HTTP_LATENCY = metrics.histogram('pydatacoll_http_request_duration_seconds', 'HTTP request latency by handler',
+                                 ('handler',))
+HTTP_IN_PROGRESS = metrics.gauge('pydatacoll_http_requests_in_progress', 'HTTP requests being handled')
+
+
+async def metrics_middleware(_, handler):
+    async def middleware(request):
+        route = getattr(request.match_info, 'route', None)
+        name = getattr(route, 'name', None) or 'unmatched'
+        status = 500
+        HTTP_IN_PROGRESS.inc()
+        begin = time.perf_counter()
+        try:
+            response = await handler(request)
+            status = response.status
+            return response
+        except web.HTTPException as e:
+            status = e.status
+            raise
+        finally:
+            HTTP_IN_PROGRESS.dec()
+            HTTP_LATENCY.labels(name).observe(time.perf_counter() - begin)
+            HTTP_REQUESTS.labels(name, request.method, status).inc()
+    return middleware
 
 
 class APIServer(ParamFunctionContainer):
     def __init__(self, port, io_loop: asyncio.AbstractEventLoop = None,
-                 redis_pool: aioredis.RedisPool = None):
+                 redis_pool: aioredis.RedisPool = None, host='127.0.0.1', reuse_port=False, load_plugins=True):
+        """
+        :param reuse_port: bind with SO_REUSEPORT so that several worker processes share the port
+        :param load_plugins: run all plugins in this process, False when they run in their own processes
+        """
         super().__init__()
+        self.host = host
         self.port = port
         self.io_loop = io_loop
         if self.io_loop is None:
             self.io_loop = asyncio.new_event_loop()
             asyncio.set_event_loop(self.io_loop)
-        self.redis_pool = redis_pool or self.io_loop.run_until_complete(
-                functools.partial(aioredis.create_pool, ('localhost', 6379),
-                                  db=1, minsize=5, maxsize=10, encoding='utf-8')())
-        self.redis_client = redis.StrictRedis(db=1, decode_responses=True)
-        self.web_app = web.Application()
+        self.redis_pool = redis_pool or self.io_loop.run_until_complete(backend.create_pool(self.io_loop))
+        self.live_hub = LiveDataHub(self.io_loop, self.redis_pool)
+        self.io_loop.run_until_complete(self.live_hub.start())
+        self.reply_dispatcher = ReplyDispatcher(self.io_loop, self.redis_pool, 'CHANNEL:DEVICE_CALL:*',
+                                                'CHANNEL:DEVICE_CTRL:*', 'CHANNEL:FORMULA_CHECK_RESULT:*')
+        self.io_loop.run_until_complete(self.reply_dispatcher.start())
+        self.config_cache = ConfigCache(self.io_loop, self.redis_pool)
+        self.io_loop.run_until_complete(self.config_cache.start())
+        self.inflight_calls = dict()  # device_id:term_id:item_id -> Task
+        self.loop_monitor = LoopMonitor(self.io_loop)
+        self.loop_monitor.start()
+        self.metrics_publisher = metrics.SnapshotPublisher(self.io_loop, self.redis_pool)
+        self.metrics_publisher.add_report('loop', self.loop_monitor.report)
+        self.metrics_publisher.start()
+        self.profiler = profiler.Profiler(self.io_loop)
+        self.web_app = web.Application(middlewares=[metrics_middleware])
         self._add_router()
         self.web_handler = self.web_app.make_handler()
-        self.server = self.io_loop.run_until_complete(self.io_loop.create_server(self.web_handler, '127.0.0.1', port))
-        self._load_plugins()
+        server_args = {'reuse_port': True} if reuse_port else {}
+        self.server = self.io_loop.run_until_complete(
+            self.io_loop.create_server(self.web_handler, host, port, **server_args))
+        self.plugins = list()
+        if load_plugins:
+            self._load_plugins()
 
     def _add_router(self):
         for fun_name, args in self.module_arg_dict.items():
@@ -46,27 +109,29 @@ class APIServer(ParamFunctionContainer):
 
     def _load_plugins(self):
         try:
-            for loader, module_name, is_pkg in pkgutil.iter_modules(plugins.__path__):
-                loader.find_module(module_name).load_module(module_name)
-            for plugin_class in plugins.BaseModule.__subclasses__():
-                if not hasattr(plugin_class, 'not_implemented'):
-                    plugin = plugin_class()
-                    self.io_loop.create_task(plugin.install())
+            for plugin_class in plugins.plugin_classes().values():
+                plugin = plugin_class(self.io_loop)
+                self.plugins.append(plugin)
+                self.io_loop.create_task(plugin.install())
         except Exception as e:
             logger.error("_load_plugins failed: %s", repr(e), exc_info=True)
 
-    @staticmethod
-    async def _find_keys(redis_client, match: str):
-        cursor = None
-        all_keys = set()
-        try:
-            while cursor != 0:
-                res = await redis_client.scan(cursor or b'0', match=match)
-                cursor, keys = res
-                all_keys.update(keys)
-        except Exception as e:
-            logger.error('_find_keys failed: %s', repr(e), exc_info=True)
-        return all_keys
+    async def shutdown(self, timeout=DRAIN_TIMEOUT):
+        """
+        stop accepting connections, wait up to timeout seconds for requests in progress, then release everything
+        """
+        self.server.close()
+        await self.server.wait_closed()
+        await self.live_hub.stop()  # 推送连接不会自己结束, 先关闭
+        await self.web_handler.finish_connections(timeout)
+        await self.web_app.finish()
+        await self.reply_dispatcher.stop()
+        await self.config_cache.stop()
+        await self.metrics_publisher.stop()
+        for plugin in self.plugins:
+            await plugin.uninstall()
+        self.loop_monitor.stop()
+        logger.info('server on %s:%s stopped', self.host, self.port)
 
     @staticmethod
     async def _read_data(request):
@@ -75,6 +140,141 @@ class APIServer(ParamFunctionContainer):
             data = data.decode('utf-8')
         return data
 
+    @staticmethod
+    def _pairs(data_dict):
+        """
+        flatten a dict to the field, value, ... arguments of aioredis hmset
+        """
+        return [value for pair in data_dict.items() for value in pair]
+
+    async def _publish(self, redis_client, channel, msg):
+        """
+        publish a config change, the local cache is invalidated at once instead of waiting for the message
+        """
+        await redis_client.publish(channel, msg)
+        self.config_cache.invalidate(channel)
+
+    @staticmethod
+    def _load_hash(key, not_found):
+        async def load(redis_client):
+            value = await redis_client.hgetall(key)
+            return (200, value) if value else (404, not_found)
+        return load
+
+    @staticmethod
+    def _load_set(key, not_found=None):
+        async def load(redis_client):
+            members = await redis_client.smembers(key)
+            if not members and not_found:
+                return 404, not_found
+            return 200, sort_ids(members)
+        return load
+
+    async def _cached(self, request, key, loader):
+        """
+        response of a config query through the cache, with ETag and If-None-Match support
+        :param loader: coroutine function(redis_client) returning (status, data or error text)
+        """
+        async def load():
+            with (await self.redis_pool) as redis_client:
+                return await loader(redis_client)
+        entry = await self.config_cache.get(key, load)
+        if entry.status != 200:
+            return web.Response(status=entry.status, text=entry.body)
+        headers = {'ETag': entry.etag}
+        if etag_matches(request.headers.get('If-None-Match'), entry.etag):
+            return web.Response(status=304, headers=headers)
+        return await self._respond(request, entry.body, JSON_TYPE, headers, entry.encoded)
+
+    async def _respond(self, request, body, content_type, headers=None, encoded=None):
+        """
+        response with the body compressed as negotiated by Accept-Encoding
+        :param body: str or bytes
+        :param encoded: dict keeping compressed bodies of a cached response, encoding -> bytes
+        """
+        if isinstance(body, str):
+            body = body.encode('utf-8')
+        headers = dict(headers or {}, **{'Content-Type': content_type})
+        if len(body) >= compress.MIN_SIZE:
+            headers['Vary'] = 'Accept-Encoding'
+            encoding = compress.negotiate(request.headers.get('Accept-Encoding'))
+            if encoding is not None:
+                compressed = encoded.get(encoding) if encoded is not None else None
+                if compressed is None:
+                    compressed = await compress.compress(self.io_loop, body, encoding)
+                    if encoded is not None:
+                        encoded[encoding] = compressed
+                body = compressed
+                headers['Content-Encoding'] = encoding
+                if 'ETag' in headers:
+                    headers['ETag'] = 'W/' + headers['ETag']  # 压缩后不再是逐字节相同的内容
+        return web.Response(body=body, headers=headers)
+
+    @staticmethod
+    def _live_args(request):
+        keys = [key.strip() for key in request.GET.get('items', '').split(',') if key.strip()]
+        interval = float(request.GET.get('interval', DEFAULT_INTERVAL))
+        return keys, interval
+
+    @param_function(method='GET', url=r'/metrics')
+    async def get_metrics(self, _):
+        try:
+            with (await self.redis_pool) as redis_client:
+                snapshots = await metrics.collect_all(redis_client)
+            return web.Response(body=metrics.render(snapshots).encode('utf-8'),
+                                headers={'Content-Type': metrics.CONTENT_TYPE})
+        except Exception as e:
+            logger.error('get_metrics failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    @param_function(method='GET', url=r'/api/v1/debug/loop')
+    async def get_loop_health(self, _):
+        try:
+            with (await self.redis_pool) as redis_client:
+                reports = await metrics.collect_reports(redis_client, 'loop', self.loop_monitor.report())
+            return JSON(reports)
+        except Exception as e:
+            logger.error('get_loop_health failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    @staticmethod
+    def _admin_allowed(request):
+        """
+        X-Admin-Token must equal env PYDATACOLL_ADMIN_TOKEN, only loopback clients are allowed when it is not set
+        """
+        token = os.environ.get(ADMIN_TOKEN_ENV)
+        if token:
+            return hmac.compare_digest(request.headers.get('X-Admin-Token', ''), token)
+        peername = request.transport.get_extra_info('peername') if request.transport is not None else None
+        try:
+            return ipaddress.ip_address(peername[0]).is_loopback
+        except (TypeError, IndexError, ValueError):  # unix socket
+            return False
+
+    @param_function(method='POST', url=r'/api/v1/debug/profile')
+    async def profile(self, request):
+        try:
+            if not self._admin_allowed(request):
+                return web.Response(status=403, text='admin token required!')
+            seconds = float(request.GET.get('seconds', PROFILE_SECONDS))
+            profile_format = request.GET.get('format', 'collapsed')
+            if not 0 < seconds <= profiler.MAX_SECONDS:
+                return web.Response(status=400, text='seconds must be in (0, {}]!'.format(profiler.MAX_SECONDS))
+            if profile_format not in profiler.FORMATS:
+                return web.Response(status=400, text='format must be one of {}!'.format(', '.join(profiler.FORMATS)))
+            try:
+                result = await self.profiler.run(seconds, profile_format)
+            except profiler.ProfilerBusy as e:
+                return web.Response(status=409, text=str(e))
+            content_type = 'text/plain; charset=utf-8' if profile_format == 'collapsed' else 'application/octet-stream'
+            return web.Response(body=result, headers={
+                'Content-Type': content_type,
+                'Content-Disposition': 'attachment; filename="{}.{}"'.format(
+                    metrics.process_name().replace('/', '-'), profile_format)})
+        except Exception as e:
+            logger.error('profile failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
     @param_function(method='GET', url=r'/')
     async def get_index(self, request):
         doc_list = ['PyDataColl is running, available API:\n']
@@ -98,11 +298,9 @@ class APIServer(ParamFunctionContainer):
         return JSON(TERM_PROTOCOLS)
 
     @param_function(method='GET', url=r'/api/v1/formulas')
-    async def get_formula_list(self, _):
+    async def get_formula_list(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                formula_list = await redis_client.smembers('SET:FORMULA')
-                return JSON(formula_list)
+            return await self._cached(request, 'SET:FORMULA', self._load_set('SET:FORMULA'))
         except Exception as e:
             logger.error('get_formula_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -110,43 +308,70 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/formulas/{formula_id}')
     async def get_formula(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                formula = await redis_client.hgetall('HS:FORMULA:{}'.format(request.match_info['formula_id']))
-                if not formula:
-                    return web.Response(status=404, text='formula_id not found!')
-                return JSON(formula)
+            key = 'HS:FORMULA:{}'.format(request.match_info['formula_id'])
+            return await self._cached(request, key, self._load_hash(key, 'formula_id not found!'))
         except Exception as e:
             logger.error('get_formula failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
     @param_function(method='GET', url=r'/api/v1/devices')
-    async def get_device_list(self, _):
+    async def get_device_list(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                device_list = await redis_client.smembers('SET:DEVICE')
-                return JSON(device_list)
+            return await self._cached(request, 'SET:DEVICE', self._load_set('SET:DEVICE'))
         except Exception as e:
             logger.error('get_device_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='GET', url=r'/api/v1/connect_stats')
+    async def get_connect_stats(self, _):
+        try:
+            with (await self.redis_pool) as redis_client:
+                stats = await redis_client.hgetall('HS:CONNECT_STATS')
+                shards = dict()
+                for shard in sort_ids(await redis_client.smembers('SET:CONNECT_STATS_SHARD')):
+                    shard_stats = await redis_client.hgetall('HS:CONNECT_STATS:{}'.format(shard))
+                    if shard_stats:
+                        shards[shard] = shard_stats
+                for shard_stats in chain([stats], shards.values()):
+                    for name in ('connect', 'interrogation'):
+                        if name in shard_stats:
+                            shard_stats[name] = json.loads(shard_stats[name])
+                if shards:
+                    # DeviceManager分片运行时汇总各分片, 令牌桶统计是每个分片自己的
+                    stats = {name: sum(int(shard_stats.get(name, 0)) for shard_stats in shards.values())
+                             for name in ('devices', 'connected', 'reconnecting', 'retry_total')}
+                    stats['time'] = min(shard_stats.get('time', '') for shard_stats in shards.values())
+                    stats['shards'] = shards
+                return JSON(stats)
+        except Exception as e:
+            logger.error('get_connect_stats failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    @param_function(method='GET', url=r'/api/v1/interrogation_schedule')
+    async def get_interrogation_schedule(self, _):
+        try:
+            with (await self.redis_pool) as redis_client:
+                schedule = await redis_client.hvals('HS:INTERROGATION_SCHEDULE')
+                for shard in await redis_client.smembers('SET:CONNECT_STATS_SHARD'):
+                    schedule += await redis_client.hvals('HS:INTERROGATION_SCHEDULE:{}'.format(shard))
+                return JSON(sorted((json.loads(info) for info in schedule), key=lambda info: info['next_time'] or ''))
+        except Exception as e:
+            logger.error('get_interrogation_schedule failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
     @param_function(method='GET', url=r'/api/v1/devices/{device_id}')
     async def get_device(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                device = await redis_client.hgetall('HS:DEVICE:{}'.format(request.match_info['device_id']))
-                if not device:
-                    return web.Response(status=404, text='device_id not found!')
-                return JSON(device)
+            key = 'HS:DEVICE:{}'.format(request.match_info['device_id'])
+            return await self._cached(request, key, self._load_hash(key, 'device_id not found!'))
         except Exception as e:
             logger.error('get_device failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
     @param_function(method='GET', url=r'/api/v1/terms')
-    async def get_term_list(self, _):
+    async def get_term_list(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                term_list = await redis_client.smembers('SET:TERM')
-                return JSON(term_list)
+            return await self._cached(request, 'SET:TERM', self._load_set('SET:TERM'))
         except Exception as e:
             logger.error('get_term_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -154,22 +379,16 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/terms/{term_id}')
     async def get_term(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                term_id = request.match_info['term_id']
-                term = await redis_client.hgetall('HS:TERM:{}'.format(term_id))
-                if not term:
-                    return web.Response(status=404, text='term_id not found!')
-                return JSON(term)
+            key = 'HS:TERM:{}'.format(request.match_info['term_id'])
+            return await self._cached(request, key, self._load_hash(key, 'term_id not found!'))
         except Exception as e:
             logger.error('get_term failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
     @param_function(method='GET', url=r'/api/v1/items')
-    async def get_item_list(self, _):
+    async def get_item_list(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                item_list = await redis_client.smembers('SET:ITEM')
-                return JSON(item_list)
+            return await self._cached(request, 'SET:ITEM', self._load_set('SET:ITEM'))
         except Exception as e:
             logger.error('get_item_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -177,12 +396,8 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/items/{item_id}')
     async def get_item(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                item_id = request.match_info['item_id']
-                item = await redis_client.hgetall('HS:ITEM:{}'.format(item_id))
-                if not item:
-                    return web.Response(status=404, text='item_id not found!')
-                return JSON(item)
+            key = 'HS:ITEM:{}'.format(request.match_info['item_id'])
+            return await self._cached(request, key, self._load_hash(key, 'item_id not found!'))
         except Exception as e:
             logger.error('get_item failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -190,13 +405,8 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/devices/{device_id}/terms')
     async def get_device_term_list(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                device_id = request.match_info['device_id']
-                found = await redis_client.exists('SET:DEVICE_TERM:{}'.format(device_id))
-                if not found:
-                    return web.Response(status=404, text='device_id not found!')
-                term_list = await redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
-                return JSON(term_list)
+            key = 'SET:DEVICE_TERM:{}'.format(request.match_info['device_id'])
+            return await self._cached(request, key, self._load_set(key, 'device_id not found!'))
         except Exception as e:
             logger.error('get_device_term_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -204,13 +414,8 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/terms/{term_id}/items')
     async def get_term_item_list(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                term_id = request.match_info['term_id']
-                found = await redis_client.exists('SET:TERM_ITEM:{}'.format(term_id))
-                if not found:
-                    return web.Response(status=404, text='term_id not found!')
-                item_list = await redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id))
-                return JSON(item_list)
+            key = 'SET:TERM_ITEM:{}'.format(request.match_info['term_id'])
+            return await self._cached(request, key, self._load_set(key, 'term_id not found!'))
         except Exception as e:
             logger.error('get_term_item_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -218,19 +423,21 @@ class APIServer(ParamFunctionContainer):
     @param_function(method='GET', url=r'/api/v1/terms/{term_id}/items/{item_id}')
     async def get_term_item(self, request):
         try:
-            with (await self.redis_pool) as redis_client:
-                term_id = request.match_info['term_id']
-                item_id = request.match_info['item_id']
+            term_id = request.match_info['term_id']
+            item_id = request.match_info['item_id']
+
+            async def load(redis_client):
                 found = await redis_client.exists('HS:TERM:{}'.format(term_id))
                 if not found:
-                    return web.Response(status=404, text='term_id not found!')
+                    return 404, 'term_id not found!'
                 found = await redis_client.exists('HS:ITEM:{}'.format(item_id))
                 if not found:
-                    return web.Response(status=404, text='item_id not found!')
+                    return 404, 'item_id not found!'
                 term_item = await redis_client.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
                 if not term_item:
-                    return web.Response(status=404, text='term_item not found!')
-                return JSON(term_item)
+                    return 404, 'term_item not found!'
+                return 200, term_item
+            return await self._cached(request, 'HS:TERM_ITEM:{}:{}'.format(term_id, item_id), load)
         except Exception as e:
             logger.error('get_term_item failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
@@ -242,12 +449,78 @@ class APIServer(ParamFunctionContainer):
                 device_id = request.match_info['device_id']
                 term_id = request.match_info['term_id']
                 item_id = request.match_info['item_id']
+                data_format = request.GET.get('format', 'json')
+                if data_format not in DATA_FORMATS:
+                    return web.Response(status=400, text='unknown format: {}'.format(data_format))
                 data_list = await redis_client.hgetall('HS:DATA:{}:{}:{}'.format(device_id, term_id, item_id))
-                return JSON(data_list)
+            if len(data_list) >= ENCODE_OFFLOAD:
+                body, content_type = await self.io_loop.run_in_executor(
+                    None, self._encode_data, data_list, data_format)
+            else:
+                body, content_type = self._encode_data(data_list, data_format)
+            return await self._respond(request, body, content_type)
         except Exception as e:
             logger.error('get_data_list failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
+    @staticmethod
+    def _encode_data(data_list, data_format):
+        """
+        :param data_list: value of HS:DATA
+        :return: (body, content type), json: {time: value}, columnar: {time: [...], value: [...]} sorted by time,
+            binary: see codec.encode_series
+        """
+        if data_format == 'json':
+            return json.dumps(data_list, ensure_ascii=False), JSON_TYPE
+        times, values = codec.sorted_series(data_list)
+        if data_format == 'columnar':
+            return json.dumps({'time': times, 'value': values}), JSON_TYPE
+        return codec.encode_series(times, values), SERIES_TYPE
+
+    @param_function(method='GET', url=r'/api/v1/datas/export')
+    async def export_data(self, request):
+        resp = None
+        try:
+            data_format = request.GET.get('format', 'ndjson')
+            if data_format not in data_export.FORMATS:
+                return web.Response(status=400, text='unknown format: {}'.format(data_format))
+            patterns = [key.strip() for key in request.GET.get('items', '').split(',') if key.strip()]
+            if not patterns:
+                return web.Response(status=400, text='items is required!')
+            cursor = request.GET.get('cursor')
+            start, end = request.GET.get('start'), request.GET.get('end')
+            try:
+                # 时间按字符串与LST:DATA_TIME比较, 格式不对时范围是错的, 不能返回200
+                for data_time in (start, end, data_export.parse_cursor(cursor)[1] if cursor else None):
+                    if data_time:
+                        codec.parse_time(data_time)
+            except ValueError as e:
+                return web.Response(status=400, text=str(e))
+            with (await self.redis_pool) as redis_client:
+                items = await data_export.expand_items(redis_client, patterns)
+            if cursor and data_export.parse_cursor(cursor)[0] not in items:
+                return web.Response(status=400, text='cursor not in items: {}'.format(cursor))
+            content_type, head, encode = data_export.FORMATS[data_format]
+            resp = web.StreamResponse(headers={'Content-Type': content_type, 'Cache-Control': 'no-cache'})
+            await resp.prepare(request)
+            if not cursor:
+                resp.write(head.encode('utf-8'))
+
+            async def write(rows):
+                resp.write(encode(rows).encode('utf-8'))
+                await resp.drain()  # 等待客户端接收, 缓冲区不随导出范围增长
+
+            count = await data_export.export(self.redis_pool, items, write, start, end, cursor)
+            logger.info('export_data: %s rows of %s items', count, len(items))
+            return resp
+        except Exception as e:
+            logger.error('export_data failed: %s', repr(e), exc_info=True)
+            if resp is None:
+                return web.Response(status=400, text=repr(e))
+            # 已经开始发送, 断开连接使客户端知道导出不完整, 用最后收到的一行作为cursor续传
+            request.transport.close()
+            return resp
+
     @param_function(method='GET', url=r'/api/v1/devices/{device_id}/terms/{term_id}/items/{item_id}/datas/{index}')
     async def get_data(self, request):
         try:
@@ -273,12 +546,15 @@ class APIServer(ParamFunctionContainer):
                 found = await redis_client.exists('HS:FORMULA:{}'.format(formula_dict['id']))
                 if found:
                     return web.Response(status=409, text='formula already exists!')
-                self.redis_client.hmset('HS:FORMULA:{}'.format(formula_dict['id']), formula_dict)
-                await redis_client.sadd('SET:FORMULA', formula_dict['id'])
+                tr = redis_client.multi_exec()
+                tr.hmset('HS:FORMULA:{}'.format(formula_dict['id']), *self._pairs(formula_dict))
+                tr.sadd('SET:FORMULA', formula_dict['id'])
                 for param, param_value in formula_dict.items():
                     if param.startswith('p'):
-                        await redis_client.sadd('SET:FORMULA_PARAM:{}'.format(param_value), formula_dict['id'])
-                await redis_client.publish('CHANNEL:FORMULA_ADD', formula_data)
+                        tr.sadd('SET:FORMULA_PARAM:{}'.format(param_value), formula_dict['id'])
+                key_index.add_data(tr, formula_dict['device_id'], formula_dict['term_id'], formula_dict['item_id'])
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:FORMULA_ADD', formula_data)
                 return web.Response()
         except Exception as e:
             logger.error('create_formula failed: %s', repr(e), exc_info=True)
@@ -307,12 +583,12 @@ class APIServer(ParamFunctionContainer):
                 formula_dict = await redis_client.hgetall('HS:FORMULA:{}'.format(formula_id))
                 if not formula_dict:
                     return web.Response(status=404, text='formula_id not found!')
-                await redis_client.publish('CHANNEL:FORMULA_DEL', json.dumps(formula_id))
                 for param, param_value in formula_dict.items():
                     if param.startswith('p'):
                         await redis_client.srem('SET:FORMULA_PARAM:{}'.format(param_value), formula_id)
                 await redis_client.delete('HS:FORMULA:{}'.format(formula_id))
                 await redis_client.srem('SET:FORMULA', formula_id)
+                await self._publish(redis_client, 'CHANNEL:FORMULA_DEL', json.dumps(formula_id))
                 return web.Response()
         except Exception as e:
             logger.error('del_formula failed: %s', repr(e), exc_info=True)
@@ -328,9 +604,11 @@ class APIServer(ParamFunctionContainer):
                 found = await redis_client.exists('HS:DEVICE:{}'.format(device_dict['id']))
                 if found:
                     return web.Response(status=409, text='device already exists!')
-                self.redis_client.hmset('HS:DEVICE:{}'.format(device_dict['id']), device_dict)
-                await redis_client.sadd('SET:DEVICE', device_dict['id'])
-                await redis_client.publish('CHANNEL:DEVICE_ADD', device_data)
+                tr = redis_client.multi_exec()
+                tr.hmset('HS:DEVICE:{}'.format(device_dict['id']), *self._pairs(device_dict))
+                tr.sadd('SET:DEVICE', device_dict['id'])
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:DEVICE_ADD', device_data)
                 return web.Response()
         except Exception as e:
             logger.error('create_device failed: %s', repr(e), exc_info=True)
@@ -350,8 +628,8 @@ class APIServer(ParamFunctionContainer):
                     await self.del_device(request)
                     await self.create_device(request)
                 else:
-                    self.redis_client.hmset('HS:DEVICE:{}'.format(device_id), device_dict)
-                    await redis_client.publish('CHANNEL:DEVICE_FRESH', device_data)
+                    await redis_client.hmset('HS:DEVICE:{}'.format(device_id), *self._pairs(device_dict))
+                    await self._publish(redis_client, 'CHANNEL:DEVICE_FRESH', device_data)
                 return web.Response()
         except Exception as e:
             logger.error('update_device failed: %s', repr(e), exc_info=True)
@@ -365,31 +643,32 @@ class APIServer(ParamFunctionContainer):
                 device_dict = await redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
                 if not device_dict:
                     return web.Response(status=404, text='device_id not found!')
-                await redis_client.publish('CHANNEL:DEVICE_DEL', json.dumps(device_id))
-                await redis_client.delete('HS:DEVICE:{}'.format(device_id))
-                await redis_client.srem('SET:DEVICE', device_id)
-                # delete all terms connected to that device
                 term_list = await redis_client.smembers('SET:DEVICE_TERM:{}'.format(device_id))
-                for term_id in term_list:
-                    await redis_client.delete('HS:TERM:{}'.format(term_id))
-                    await redis_client.srem('SET:TERM', term_id)
-                    keys = await self._find_keys(redis_client, 'HS:TERM_ITEM:{}:*'.format(term_id))
-                    if keys:
-                        self.redis_client.delete(*keys)
-                    await redis_client.delete('SET:TERM_ITEM:{}'.format(term_id))
-                await redis_client.delete('SET:DEVICE_TERM:{}'.format(device_id))
-                await redis_client.delete('LST:FRAME:{}'.format(device_id))
-                # delete values
-                keys = await self._find_keys(redis_client, 'LST:DATA_TIME:{}:*'.format(device_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                keys = await self._find_keys(redis_client, 'HS:DATA:{}:*'.format(device_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                # delete mapping
-                keys = await self._find_keys(redis_client, 'HS:MAPPING:*:{}:*'.format(device_id))
-                if keys:
-                    self.redis_client.delete(*keys)
+                term_items = await redis_client.smembers(key_index.DEVICE_TERM_ITEM.format(device_id))
+                data_members = await redis_client.smembers(key_index.DEVICE_DATA.format(device_id))
+                mapping_keys = await redis_client.hvals(key_index.DEVICE_MAPPING.format(device_id))
+                # the device and its terms disappear before DEVICE_DEL, so caches reloading on it see them gone
+                tr = redis_client.multi_exec()
+                tr.srem('SET:DEVICE', device_id)
+                if term_list:
+                    tr.srem('SET:TERM', *term_list)
+                tr.delete('HS:DEVICE:{}'.format(device_id), 'SET:DEVICE_TERM:{}'.format(device_id),
+                          *['{}:{}'.format(prefix, term_id) for term_id in term_list
+                            for prefix in ('HS:TERM', 'SET:TERM_ITEM')])
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:DEVICE_DEL', json.dumps(device_id))
+
+                def remove_item_term(tr, member):
+                    term_id, item_id = member.split(':')
+                    tr.srem(key_index.ITEM_TERM.format(item_id), '{}:{}'.format(device_id, term_id))
+                await key_index.execute_chunked(redis_client, set(term_items) | set(data_members), remove_item_term)
+                # delete term_items, values and mapping of the device,
+                # index keys go last and the key list is generated while deleting
+                keys = chain(('HS:TERM_ITEM:{}'.format(member) for member in term_items),
+                             key_index.data_keys(device_id, data_members), mapping_keys,
+                             ('LST:FRAME:{}'.format(device_id), key_index.DEVICE_TERM_ITEM.format(device_id),
+                              key_index.DEVICE_DATA.format(device_id), key_index.DEVICE_MAPPING.format(device_id)))
+                await key_index.delete_keys(redis_client, keys)
                 return web.Response()
         except Exception as e:
             logger.error('del_device failed: %s', repr(e), exc_info=True)
@@ -405,10 +684,12 @@ class APIServer(ParamFunctionContainer):
                 found = await redis_client.exists('HS:TERM:{}'.format(term_dict['id']))
                 if found:
                     return web.Response(status=409, text='term already exists!')
-                self.redis_client.hmset('HS:TERM:{}'.format(term_dict['id']), term_dict)
-                await redis_client.sadd('SET:TERM', term_dict['id'])
-                await redis_client.sadd('SET:DEVICE_TERM:{}'.format(term_dict['device_id']), term_dict['id'])
-                await redis_client.publish('CHANNEL:TERM_ADD"', term_data)
+                tr = redis_client.multi_exec()
+                tr.hmset('HS:TERM:{}'.format(term_dict['id']), *self._pairs(term_dict))
+                tr.sadd('SET:TERM', term_dict['id'])
+                tr.sadd('SET:DEVICE_TERM:{}'.format(term_dict['device_id']), term_dict['id'])
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:TERM_ADD', term_data)
                 return web.Response()
         except Exception as e:
             logger.error('create_term failed: %s', repr(e), exc_info=True)
@@ -427,18 +708,63 @@ class APIServer(ParamFunctionContainer):
                 if str(term_dict['id']) != term_id:
                     await self.del_term(request)
                     await self.create_term(request)
+                elif str(term_dict['device_id']) != old_term['device_id']:
+                    protocol = await redis_client.hget('HS:DEVICE:{}'.format(term_dict['device_id']), 'protocol')
+                    if not protocol:
+                        return web.Response(status=404, text='device_id not found!')
+                    err_rsp = await self._move_term(redis_client, term_id, old_term['device_id'], protocol, term_dict)
+                    if err_rsp is not None:
+                        return err_rsp
+                    await self._publish(redis_client, 'CHANNEL:TERM_DEL', json.dumps(old_term))
+                    await self._publish(redis_client, 'CHANNEL:TERM_ADD', term_data)
                 else:
-                    self.redis_client.hmset('HS:TERM:{}'.format(term_id), term_dict)
-                    if term_dict['device_id'] != old_term['device_id']:
-                        await redis_client.publish('CHANNEL:TERM_DEL', json.dumps(old_term))
-                        await redis_client.publish('CHANNEL:TERM_ADD', term_data)
-                    else:
-                        await redis_client.publish('CHANNEL:TERM_FRESH', term_data)
+                    await redis_client.hmset('HS:TERM:{}'.format(term_id), *self._pairs(term_dict))
+                    await self._publish(redis_client, 'CHANNEL:TERM_FRESH', term_data)
                 return web.Response()
         except Exception as e:
             logger.error('update_term failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
+    async def _move_term(self, redis_client, term_id, old_device_id, protocol, term_dict):
+        """
+        move the term and its term_items to the new device in one transaction, the mappings are recreated as
+        HS:MAPPING:{protocol}:{new device}:{code}, values and their index stay with the old device,
+        whose name is part of their keys
+        :return: error response if a protocol_code is already used on the new device, None if moved
+        """
+        device_id = str(term_dict['device_id'])
+        item_ids = list(await redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id)))
+        term_items = ['{}:{}'.format(term_id, item_id) for item_id in item_ids]
+        mapping_keys = await redis_client.hmget(
+            key_index.DEVICE_MAPPING.format(old_device_id), *term_items) if term_items else []
+        pipe = redis_client.pipeline()
+        futures = [pipe.hgetall('HS:TERM_ITEM:{}'.format(member)) for member in term_items]
+        await pipe.execute()
+        term_item_dicts = [fut.result() for fut in futures]
+        new_mapping_keys = ['HS:MAPPING:{}:{}:{}'.format(protocol.upper(), device_id, term_item_dict['protocol_code'])
+                            if term_item_dict else None for term_item_dict in term_item_dicts]
+        for new_mapping_key in new_mapping_keys:
+            if new_mapping_key and await redis_client.exists(new_mapping_key):
+                return web.Response(status=409, text='{} already exists!'.format(new_mapping_key))
+        tr = redis_client.multi_exec()
+        tr.hmset('HS:TERM:{}'.format(term_id), *self._pairs(term_dict))
+        tr.srem('SET:DEVICE_TERM:{}'.format(old_device_id), term_id)
+        tr.sadd('SET:DEVICE_TERM:{}'.format(device_id), term_id)
+        for item_id, member, mapping_key, term_item_dict, new_mapping_key in zip(
+                item_ids, term_items, mapping_keys, term_item_dicts, new_mapping_keys):
+            tr.srem(key_index.DEVICE_TERM_ITEM.format(old_device_id), member)
+            tr.hdel(key_index.DEVICE_MAPPING.format(old_device_id), member)
+            if mapping_key:
+                tr.delete(mapping_key)
+            if not term_item_dict:
+                continue
+            term_item_dict['device_id'] = device_id
+            pairs = self._pairs(term_item_dict)
+            tr.hmset('HS:TERM_ITEM:{}'.format(member), *pairs)
+            tr.hmset(new_mapping_key, *pairs)
+            key_index.add_term_item(tr, device_id, term_id, item_id, new_mapping_key)
+        await tr.execute()
+
     @param_function(method='DELETE', url=r'/api/v1/terms/{term_id}')
     async def del_term(self, request):
         try:
@@ -448,27 +774,37 @@ class APIServer(ParamFunctionContainer):
                 if not term_info:
                     return web.Response(status=404, text='term_id not found!')
                 device_id = term_info['device_id']
-                await redis_client.publish('CHANNEL:TERM_DEL', json.dumps({'device_id': device_id, 'term_id': term_id}))
-                await redis_client.delete('HS:TERM:{}'.format(term_id))
-                await redis_client.srem('SET:TERM', term_id)
-                await redis_client.srem('SET:DEVICE_TERM:{}'.format(term_info['device_id']), term_id)
-                await redis_client.delete('SET:TERM_ITEM:{}'.format(term_id))
-                # delete all values
-                keys = await self._find_keys(redis_client, 'LST:DATA_TIME:*:{}:*'.format(term_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                keys = await self._find_keys(redis_client, 'HS:DATA:*:{}:*'.format(term_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                # delete from protocols mapping
-                all_keys = set()
-                keys = await self._find_keys(redis_client, 'HS:MAPPING:*')
-                for key in keys:
-                    map_key = await redis_client.hgetall(key)
-                    if str(map_key['term_id']) == term_id:
-                        all_keys.add(key)
-                if all_keys:
-                    self.redis_client.delete(*all_keys)
+                item_ids = await redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id))
+                term_items = ['{}:{}'.format(term_id, item_id) for item_id in item_ids]
+                # a term moved to another device leaves its values (and older mappings) indexed under the old one
+                device_ids = {device_id} | await key_index.term_devices(redis_client, term_id, item_ids)
+                data_members = dict()  # device_id -> members of SET:DEVICE_DATA belonging to the term
+                mapping_keys = list()
+                for term_device_id in sorted(device_ids):
+                    data_members[term_device_id] = await key_index.scan_members(
+                        redis_client, key_index.DEVICE_DATA.format(term_device_id), '{}:'.format(term_id))
+                    if term_items:
+                        mapping_keys.extend(await redis_client.hmget(
+                            key_index.DEVICE_MAPPING.format(term_device_id), *term_items))
+                tr = redis_client.multi_exec()
+                tr.srem('SET:TERM', term_id)
+                for term_device_id in device_ids:
+                    tr.srem('SET:DEVICE_TERM:{}'.format(term_device_id), term_id)
+                tr.delete('HS:TERM:{}'.format(term_id), 'SET:TERM_ITEM:{}'.format(term_id))
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:TERM_DEL',
+                                    json.dumps({'device_id': device_id, 'term_id': term_id}))
+                await key_index.execute_chunked(
+                    redis_client, [(term_device_id, member) for term_device_id, members in data_members.items()
+                                   for member in set(term_items) | set(members)],
+                    lambda tr, record: key_index.remove_term_item(
+                        tr, record[0], term_id, record[1].split(':')[1]))
+                # delete term_items, all values and protocols mapping
+                keys = ['HS:TERM_ITEM:{}'.format(member) for member in term_items]
+                for term_device_id, members in data_members.items():
+                    keys.extend(key_index.data_keys(term_device_id, members))
+                keys.extend(set(mapping_key for mapping_key in mapping_keys if mapping_key))
+                await key_index.delete_keys(redis_client, keys)
                 return web.Response()
         except Exception as e:
             logger.error('del_term failed: %s', repr(e), exc_info=True)
@@ -484,8 +820,11 @@ class APIServer(ParamFunctionContainer):
                 found = await redis_client.exists('HS:ITEM:{}'.format(item_dict['id']))
                 if found:
                     return web.Response(status=409, text='item already exists!')
-                self.redis_client.hmset('HS:ITEM:{}'.format(item_dict['id']), item_dict)
-                await redis_client.sadd('SET:ITEM', item_dict['id'])
+                tr = redis_client.multi_exec()
+                tr.hmset('HS:ITEM:{}'.format(item_dict['id']), *self._pairs(item_dict))
+                tr.sadd('SET:ITEM', item_dict['id'])
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:ITEM_ADD', item_data)
                 return web.Response()
         except Exception as e:
             logger.error('create_item failed: %s', repr(e), exc_info=True)
@@ -505,7 +844,8 @@ class APIServer(ParamFunctionContainer):
                     await self.del_item(request)
                     await self.create_item(request)
                 else:
-                    self.redis_client.hmset('HS:ITEM:{}'.format(item_id), item_dict)
+                    await redis_client.hmset('HS:ITEM:{}'.format(item_id), *self._pairs(item_dict))
+                    await self._publish(redis_client, 'CHANNEL:ITEM_FRESH', item_data)
                 return web.Response()
         except Exception as e:
             logger.error('update_item failed: %s', repr(e), exc_info=True)
@@ -519,32 +859,28 @@ class APIServer(ParamFunctionContainer):
                 found = await redis_client.exists('HS:ITEM:{}'.format(item_id))
                 if not found:
                     return web.Response(status=404, text='item_id not found!')
-                await redis_client.delete('HS:ITEM:{}'.format(item_id))
+                # delete from term->item set and hash, TODO: publish msg to CHANNEL:TERM_ITEM_DEL for each term
+                keys = ['HS:ITEM:{}'.format(item_id), key_index.ITEM_TERM.format(item_id)]
+                device_terms = defaultdict(list)
+                for member in await redis_client.smembers(key_index.ITEM_TERM.format(item_id)):
+                    device_id, term_id = member.split(':')
+                    device_terms[device_id].append('{}:{}'.format(term_id, item_id))
+                for device_id, members in device_terms.items():
+                    mapping_keys = await redis_client.hmget(key_index.DEVICE_MAPPING.format(device_id), *members)
+                    keys.extend(mapping_key for mapping_key in mapping_keys if mapping_key)
+                    keys.extend('HS:TERM_ITEM:{}'.format(member) for member in members)
+                    keys.extend(key_index.data_keys(device_id, members))
                 await redis_client.srem('SET:ITEM', item_id)
-                # delete from term->item set
-                keys = await self._find_keys(redis_client, 'SET:TERM_ITEM:*')
-                for key in keys:
-                    await redis_client.srem(key, item_id)
-                # delete from term->item hash, TODO: publish msg to CHANNEL:TERM_ITEM_DEL
-                keys = await self._find_keys(redis_client, 'HS:TERM_ITEM:*:{}'.format(item_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                # delete from protocols mapping
-                all_keys = set()
-                keys = await self._find_keys(redis_client, 'HS:MAPPING:*')
-                for key in keys:
-                    map_key = await redis_client.hgetall(key)
-                    if map_key and str(map_key['item_id']) == item_id:
-                        all_keys.add(key)
-                if all_keys:
-                    await redis_client.delete(*all_keys)
-                # delete all values
-                keys = await self._find_keys(redis_client, 'LST:DATA_TIME:*:*:{}'.format(item_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                keys = await self._find_keys(redis_client, 'HS:DATA:*:*:{}'.format(item_id))
-                if keys:
-                    self.redis_client.delete(*keys)
+
+                def remove_term_item(tr, device_term):
+                    device_id, term_id = device_term
+                    tr.srem('SET:TERM_ITEM:{}'.format(term_id), item_id)
+                    key_index.remove_term_item(tr, device_id, term_id, item_id)
+                await key_index.execute_chunked(redis_client, [(device_id, member.split(':')[0]) for device_id, members
+                                                               in device_terms.items() for member in members],
+                                                remove_term_item)
+                await key_index.delete_keys(redis_client, keys)
+                await self._publish(redis_client, 'CHANNEL:ITEM_DEL', json.dumps(item_id))
                 return web.Response()
         except Exception as e:
             logger.error('del_item failed: %s', repr(e), exc_info=True)
@@ -574,20 +910,21 @@ class APIServer(ParamFunctionContainer):
                 device_id = term_info['device_id']
                 term_item_dict.update({'device_id': device_id})
                 device_info = await redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
-                self.redis_client.hmset('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), term_item_dict)
-                await redis_client.sadd('SET:TERM_ITEM:{}'.format(term_id), item_id)
+                mapping_key = 'HS:MAPPING:{}:{}:{}'.format(device_info['protocol'].upper(), device_id,
+                                                           term_item_dict['protocol_code'])
+                old_mapping_key = await redis_client.hget(key_index.DEVICE_MAPPING.format(device_id),
+                                                          '{}:{}'.format(term_id, item_id))
+                pairs = self._pairs(term_item_dict)
+                tr = redis_client.multi_exec()
+                tr.hmset('HS:TERM_ITEM:{}:{}'.format(term_id, item_id), *pairs)
+                tr.sadd('SET:TERM_ITEM:{}'.format(term_id), item_id)
                 # delete old mapping
-                all_keys = set()
-                keys = await self._find_keys(redis_client, 'HS:MAPPING:{}:*:*'.format(device_info['protocol'].upper()))
-                for key in keys:
-                    map_key = await redis_client.hgetall(key)
-                    if str(map_key['term_id']) == term_id and str(map_key['item_id']) == item_id:
-                        all_keys.add(key)
-                if all_keys:
-                    self.redis_client.delete(*all_keys)
-                self.redis_client.hmset('HS:MAPPING:{}:{}:{}'.format(device_info['protocol'].upper(), device_id,
-                                                                     term_item_dict['protocol_code']), term_item_dict)
-                await redis_client.publish('CHANNEL:TERM_ITEM_ADD', json.dumps(term_item_dict))
+                if old_mapping_key:
+                    tr.delete(old_mapping_key)
+                tr.hmset(mapping_key, *pairs)
+                key_index.add_term_item(tr, device_id, term_id, item_id, mapping_key)
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:TERM_ITEM_ADD', json.dumps(term_item_dict))
                 return web.Response()
         except Exception as e:
             logger.error('create_term_item failed: %s', repr(e), exc_info=True)
@@ -624,162 +961,290 @@ class APIServer(ParamFunctionContainer):
                 term_info = await redis_client.hgetall('HS:TERM:{}'.format(term_id))
                 device_id = term_info['device_id']
                 device_info = await redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
-                await redis_client.publish('CHANNEL:TERM_ITEM_DEL',
-                                           json.dumps({'device_id': device_id, 'term_id': term_id, 'item_id': item_id}))
-                await redis_client.delete('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
-                await redis_client.srem('SET:TERM_ITEM:{}'.format(term_id), item_id)
-                await redis_client.delete('HS:MAPPING:{}:{}:{}'.format(
-                        device_info['protocol'].upper(), device_id, term_item_dict['protocol_code']))
-                # delete all values
-                keys = await self._find_keys(redis_client, 'LST:DATA_TIME:*:{}:{}'.format(term_id, item_id))
-                if keys:
-                    self.redis_client.delete(*keys)
-                keys = await self._find_keys(redis_client, 'HS:DATA:*:{}:{}'.format(term_id, item_id))
-                if keys:
-                    self.redis_client.delete(*keys)
+                tr = redis_client.multi_exec()
+                tr.srem('SET:TERM_ITEM:{}'.format(term_id), item_id)
+                key_index.remove_term_item(tr, device_id, term_id, item_id)
+                tr.delete('HS:TERM_ITEM:{}:{}'.format(term_id, item_id))
+                await tr.execute()
+                await self._publish(redis_client, 'CHANNEL:TERM_ITEM_DEL',
+                                    json.dumps({'device_id': device_id, 'term_id': term_id, 'item_id': item_id}))
+                # delete mapping and all values
+                keys = ['HS:MAPPING:{}:{}:{}'.format(
+                        device_info['protocol'].upper(), device_id, term_item_dict['protocol_code'])]
+                keys.extend(key_index.data_keys(device_id, ['{}:{}'.format(term_id, item_id)]))
+                await key_index.delete_keys(redis_client, keys)
                 return web.Response()
         except Exception as e:
             logger.error('del_term_item failed: %s', repr(e), exc_info=True)
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='POST', url=r'/api/v1/bulk/{kind}')
+    async def bulk_import(self, request):
+        try:
+            kind = request.match_info['kind']
+            if kind not in bulk_config.KINDS:
+                return web.Response(status=404, text='unknown kind: {}'.format(kind))
+            data = await self._read_data(request)
+            with (await self.redis_pool) as redis_client:
+                rst = await bulk_config.import_records(redis_client, kind, data)
+            self.config_cache.invalidate(bulk_config.CHANNELS[kind])
+            return JSON(rst)
+        except bulk_config.BulkError as e:
+            return JSON({'errors': e.errors}, status=e.status)
+        except Exception as e:
+            logger.error('bulk_import failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    @param_function(method='GET', url=r'/api/v1/bulk/{kind}')
+    async def bulk_export(self, request):
+        try:
+            kind = request.match_info['kind']
+            if kind not in bulk_config.KINDS:
+                return web.Response(status=404, text='unknown kind: {}'.format(kind))
+            with (await self.redis_pool) as redis_client:
+                records = await bulk_config.export_records(redis_client, kind)
+            if request.GET.get('format') == 'ndjson':
+                return await self._respond(
+                    request, ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records),
+                    'application/x-ndjson; charset=utf-8')
+            return await self._respond(request, json.dumps(records, ensure_ascii=False), JSON_TYPE)
+        except Exception as e:
+            logger.error('bulk_export failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+    async def _check_term_item(self, redis_client, data_dict):
+        found = await redis_client.exists('HS:DEVICE:{}'.format(data_dict['device_id']))
+        if not found:
+            return web.Response(status=404, text='device_id not found!')
+        found = await redis_client.exists('HS:TERM:{}'.format(data_dict['term_id']))
+        if not found:
+            return web.Response(status=404, text='term_id not found!')
+        found = await redis_client.exists('HS:ITEM:{}'.format(data_dict['item_id']))
+        if not found:
+            return web.Response(status=404, text='item_id not found!')
+        found = await redis_client.exists('HS:TERM_ITEM:{}:{}'.format(data_dict['term_id'], data_dict['item_id']))
+        if not found:
+            return web.Response(status=404, text='term_item not found!')
+
+    async def _device_request(self, channel, data_dict):
+        # DeviceManager按字符串id查找设备, 数字形式的id统一转为字符串
+        for field in ('device_id', 'term_id', 'item_id'):
+            data_dict[field] = str(data_dict[field])
+        request_id = self.reply_dispatcher.new_request_id()
+        data_dict['request_id'] = request_id
+        rst = await self.reply_dispatcher.request(channel, json.dumps(data_dict), request_id, HANDLER_TIME_OUT)
+        rst = json.loads(rst)
+        rst.pop('request_ids', None)
+        return rst
+
     @param_function(method='POST', url=r'/api/v1/device_call')
     async def device_call(self, request):
-        redis_client = None
-        channel_name = None
         try:
-            redis_client = await self.redis_pool.acquire()
             call_data = await self._read_data(request)
             call_data_dict = json.loads(call_data)
             logger.debug('new call_data arg=%s', call_data_dict)
-            found = await redis_client.exists('HS:DEVICE:{}'.format(call_data_dict['device_id']))
-            if not found:
-                return web.Response(status=404, text='device_id not found!')
-            found = await redis_client.exists('HS:TERM:{}'.format(call_data_dict['term_id']))
-            if not found:
-                return web.Response(status=404, text='term_id not found!')
-            found = await redis_client.exists('HS:ITEM:{}'.format(call_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='item_id not found!')
-            found = await redis_client.exists('HS:TERM_ITEM:{}:{}'.format(
-                    call_data_dict['term_id'], call_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='term_item not found!')
-            await redis_client.publish('CHANNEL:DEVICE_CALL', call_data)
-            channel_name = 'CHANNEL:DEVICE_CALL:{}:{}:{}'.format(
-                    call_data_dict['device_id'], call_data_dict['term_id'], call_data_dict['item_id'])
-            res = await redis_client.subscribe(channel_name)
-            cb = asyncio.futures.Future()
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get_json()
-                    logger.debug('device_call got msg: %s', msg)
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]))
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT)
-            await redis_client.unsubscribe(channel_name)
-            await tsk
-            self.redis_pool.release(redis_client)
+            with (await self.redis_pool) as redis_client:
+                err_rsp = await self._check_term_item(redis_client, call_data_dict)
+                if err_rsp is not None:
+                    return err_rsp
+            # 同一指标的并发召测合并为一次
+            # id可能是数字或字符串, 统一转为字符串, 使1000和"1000"合并
+            call_key = ':'.join(str(call_data_dict[field]) for field in ('device_id', 'term_id', 'item_id'))
+            call_task = self.inflight_calls.get(call_key)
+            if call_task is None:
+                call_task = self.inflight_calls[call_key] = asyncio.ensure_future(
+                        self._device_request('CHANNEL:DEVICE_CALL', call_data_dict), loop=self.io_loop)
+                call_task.add_done_callback(lambda _: self.inflight_calls.pop(call_key, None))
+            rst = await asyncio.shield(call_task, loop=self.io_loop)
+            logger.debug('device_call got msg: %s', rst)
+            if 'err_msg' in rst:
+                return web.Response(status=400, text=rst['err_msg'])
             return JSON(rst)
         except Exception as e:
-            logger.exception(e)
             logger.error('device_call failed: %s', repr(e), exc_info=True)
-            if redis_client and redis_client.in_pubsub and channel_name:
-                await redis_client.unsubscribe(channel_name)
-                self.redis_pool.release(redis_client)
             return web.Response(status=400, text=repr(e))
 
+    async def _device_batch(self, request, channel, extra_fields=()):
+        """
+        validate all items with one pipeline, publish one message per device to `channel`,
+        then wait for every item's reply by its own request id
+        :return: result list in the same order as request
+        """
+        waiters = list()
+        try:
+            item_list = json.loads(await self._read_data(request))
+            logger.debug('new %s arg count=%s', channel, len(item_list))
+            rst_list = [{'device_id': str(item['device_id']), 'term_id': str(item['term_id']),
+                         'item_id': str(item['item_id']), 'status': 'not_found'} for item in item_list]
+            with (await self.redis_pool) as redis_client:
+                pipe = redis_client.pipeline()
+                futures = [pipe.exists('HS:DEVICE:{}'.format(rst['device_id'])) for rst in rst_list] + \
+                          [pipe.exists('HS:TERM_ITEM:{}:{}'.format(rst['term_id'], rst['item_id'])) for rst in rst_list]
+                await pipe.execute()
+                found_list = [fut.result() for fut in futures]
+            device_batch = defaultdict(list)
+            for idx, rst in enumerate(rst_list):
+                if found_list[idx] and found_list[len(rst_list) + idx]:
+                    request_id = self.reply_dispatcher.new_request_id()
+                    waiters.append((request_id, self.reply_dispatcher.expect(request_id), rst))
+                    batch_item = {'term_id': rst['term_id'], 'item_id': rst['item_id'], 'request_id': request_id}
+                    batch_item.update({field: item_list[idx][field] for field in extra_fields})
+                    device_batch[rst['device_id']].append(batch_item)
+            with (await self.redis_pool) as redis_client:
+                for device_id, items in device_batch.items():
+                    await redis_client.publish(channel, json.dumps({'device_id': device_id, 'items': items}))
+            if waiters:
+                await asyncio.wait([fut for _, fut, _ in waiters], timeout=HANDLER_TIME_OUT, loop=self.io_loop)
+            for _, fut, rst in waiters:
+                if not fut.done():
+                    rst['status'] = 'timeout'
+                    continue
+                reply = json.loads(fut.result())
+                if 'err_msg' in reply:
+                    rst.update({'status': 'error', 'err_msg': reply['err_msg']})
+                else:
+                    rst.update({'status': 'ok', 'time': reply['time'], 'value': reply['value']})
+            return JSON(rst_list)
+        except Exception as e:
+            logger.error('%s batch failed: %s', channel, repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+        finally:
+            for request_id, fut, _ in waiters:
+                self.reply_dispatcher.discard(request_id, fut)
+
+    @param_function(method='POST', url=r'/api/v1/device_call/batch')
+    async def device_call_batch(self, request):
+        """
+        request body: [{device_id: xxx, term_id: xxx, item_id: xxx}, ...]
+        response body: [{device_id: xxx, term_id: xxx, item_id: xxx, status: ok|not_found|timeout|error,
+                         time: xxx, value: xxx, err_msg: xxx}, ...], same order as request
+        """
+        return await self._device_batch(request, 'CHANNEL:DEVICE_CALL_BATCH')
+
+    @param_function(method='POST', url=r'/api/v1/device_ctrl/batch')
+    async def device_ctrl_batch(self, request):
+        """
+        request body: [{device_id: xxx, term_id: xxx, item_id: xxx, value: xxx}, ...]
+        response body: same as device_call_batch
+        """
+        return await self._device_batch(request, 'CHANNEL:DEVICE_CTRL_BATCH', ('value',))
+
     @param_function(method='POST', url=r'/api/v1/device_ctrl')
     async def device_ctrl(self, request):
-        redis_client = None
-        channel_name = None
         try:
-            redis_client = await self.redis_pool.acquire()
             ctrl_data = await self._read_data(request)
             ctrl_data_dict = json.loads(ctrl_data)
             logger.debug('new ctrl_data arg=%s', ctrl_data_dict)
-            found = await redis_client.exists('HS:DEVICE:{}'.format(ctrl_data_dict['device_id']))
-            if not found:
-                return web.Response(status=404, text='device_id not found!')
-            found = await redis_client.exists('HS:TERM:{}'.format(ctrl_data_dict['term_id']))
-            if not found:
-                return web.Response(status=404, text='term_id not found!')
-            found = await redis_client.exists('HS:ITEM:{}'.format(ctrl_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='item_id not found!')
-            found = await redis_client.exists(
-                    'HS:TERM_ITEM:{}:{}'.format(ctrl_data_dict['term_id'], ctrl_data_dict['item_id']))
-            if not found:
-                return web.Response(status=404, text='term_item not found!')
-            await redis_client.publish('CHANNEL:DEVICE_CTRL', ctrl_data)
-            channel_name = 'CHANNEL:DEVICE_CTRL:{}:{}:{}'.format(
-                    ctrl_data_dict['device_id'], ctrl_data_dict['term_id'], ctrl_data_dict['item_id'])
-            res = await redis_client.subscribe(channel_name)
-            cb = asyncio.futures.Future()
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get_json()
-                    logger.debug('device_ctrl got msg: %s', msg)
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]))
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT)
-            await redis_client.unsubscribe(channel_name)
-            await tsk
-            self.redis_pool.release(redis_client)
+            with (await self.redis_pool) as redis_client:
+                err_rsp = await self._check_term_item(redis_client, ctrl_data_dict)
+                if err_rsp is not None:
+                    return err_rsp
+            rst = await self._device_request('CHANNEL:DEVICE_CTRL', ctrl_data_dict)
+            logger.debug('device_ctrl got msg: %s', rst)
+            if 'err_msg' in rst:
+                return web.Response(status=400, text=rst['err_msg'])
             return JSON(rst)
         except Exception as e:
-            logger.exception(e)
             logger.error('device_ctrl failed: %s', repr(e), exc_info=True)
-            if redis_client and redis_client.in_pubsub and channel_name:
-                await redis_client.unsubscribe(channel_name)
-                self.redis_pool.release(redis_client)
             return web.Response(status=400, text=repr(e))
 
     @param_function(method='POST', url=r'/api/v1/formula_check')
     async def formula_check(self, request):
-        redis_client = None
-        channel_name = None
         try:
-            redis_client = await self.redis_pool.acquire()
             formula_data = await self._read_data(request)
             formula_dict = json.loads(formula_data)
             logger.debug('formula_check arg=%s', formula_dict)
-            channel_name = 'CHANNEL:FORMULA_CHECK_RESULT:{}'.format(len(formula_dict['formula']))
-            res = await redis_client.subscribe(channel_name)
-            cb = asyncio.futures.Future()
-
-            async def reader(ch):
-                while await ch.wait_message():
-                    msg = await ch.get(encoding='utf-8')
-                    if not cb.done():
-                        cb.set_result(msg)
-
-            tsk = asyncio.ensure_future(reader(res[0]))
-            with (await self.redis_pool) as pub_client:
-                await pub_client.publish('CHANNEL:FORMULA_CHECK', formula_data)
-            rst = await asyncio.wait_for(cb, HANDLER_TIME_OUT)
-            await redis_client.unsubscribe(channel_name)
-            await tsk
-            self.redis_pool.release(redis_client)
-            return web.Response(status=200, text=rst)
-        except Exception as e:
-            logger.exception(e)
+            request_id = self.reply_dispatcher.new_request_id()
+            formula_dict['request_id'] = request_id
+            rst = await self.reply_dispatcher.request('CHANNEL:FORMULA_CHECK', json.dumps(formula_dict), request_id,
+                                                      HANDLER_TIME_OUT)
+            return web.Response(status=200, text=json.loads(rst)['rst'])
+        except Exception as e:
             logger.error('formula_check failed: %s', repr(e), exc_info=True)
-            if redis_client and redis_client.in_pubsub and channel_name:
-                await redis_client.unsubscribe(channel_name)
-                self.redis_pool.release(redis_client)
             return web.Response(status=400, text=repr(e))
 
+    @param_function(method='GET', url=r'/api/v1/live/ws')
+    async def live_ws(self, request):
+        ws = web.WebSocketResponse()
+        client = None
+        try:
+            keys, interval = self._live_args(request)
+            await ws.prepare(request)
+
+            async def send(text):
+                if text is None:
+                    ws.ping()
+                else:
+                    ws.send_str(text)
+
+            client = self.live_hub.add_client(send, request.transport, interval)
+            self.live_hub.subscribe(client, *keys)
+            while True:
+                msg = await ws.receive()
+                if msg.tp != aiohttp.MsgType.text:
+                    break
+                cmd = json.loads(msg.data)
+                if cmd.get('subscribe'):
+                    self.live_hub.subscribe(client, *cmd['subscribe'])
+                if cmd.get('unsubscribe'):
+                    self.live_hub.unsubscribe(client, *cmd['unsubscribe'])
+        except Exception as e:
+            logger.error('live_ws failed: %s', repr(e), exc_info=True)
+        finally:
+            client and client.close()
+        return ws
+
+    @param_function(method='GET', url=r'/api/v1/live/sse')
+    async def live_sse(self, request):
+        try:
+            keys, interval = self._live_args(request)
+            if not keys:
+                return web.Response(status=400, text='items is required!')
+            resp = web.StreamResponse(headers={'Cache-Control': 'no-cache'})
+            resp.content_type = 'text/event-stream'
+            await resp.prepare(request)
+
+            async def send(text):
+                resp.write(b': ping\n\n' if text is None else 'data: {}\n\n'.format(text).encode())
+                await resp.drain()
+
+            client = self.live_hub.add_client(send, request.transport, interval)
+            self.live_hub.subscribe(client, *keys)
+            await client.task
+            return resp
+        except Exception as e:
+            logger.error('live_sse failed: %s', repr(e), exc_info=True)
+            return web.Response(status=400, text=repr(e))
+
+
+def run_until_signal(io_loop: asyncio.AbstractEventLoop, shutdown):
+    """
+    run io_loop until SIGTERM/SIGINT, then run shutdown() and close the loop
+    :param shutdown: coroutine function
+    """
+    def on_signal(callback):
+        for sig in (signal.SIGTERM, signal.SIGINT):
+            try:
+                io_loop.add_signal_handler(sig, callback)
+            except (NotImplementedError, RuntimeError):  # Windows只能用KeyboardInterrupt
+                pass
+
+    on_signal(io_loop.stop)
+    try:
+        io_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        on_signal(lambda: None)  # 停止过程中再收到信号(如launcher转发的SIGTERM)时不打断
+        io_loop.run_until_complete(shutdown())
+        io_loop.close()
+
 
-def run_server(port=8080):
-    api_server = APIServer(port)
+def run_server(port=8080, host='127.0.0.1', reuse_port=False, load_plugins=True, drain_timeout=DRAIN_TIMEOUT):
+    api_server = APIServer(port, host=host, reuse_port=reuse_port, load_plugins=load_plugins)
+    api_server.profiler.install_signal()
     logger.info('serving on %s', api_server.server.sockets[0].getsockname())
-    asyncio.get_event_loop().run_forever()
+    run_until_signal(api_server.io_loop, lambda: api_server.shutdown(drain_timeout))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,190 @@
+"""
+多进程部署: 多个API工作进程通过SO_REUSEPORT共享同一端口, 每个插件在自己的进程中运行, 互不争抢CPU
+
+    python -m pydatacoll.launcher                                         # 1个API进程, 每个插件1个进程
+    python -m pydatacoll.launcher --bind 0.0.0.0 --port 8080 --workers 4 --plugin DeviceManager=4 --plugin FormulaCalc
+    python -m pydatacoll.launcher --workers 2 --no-plugins                # 插件在其他机器上运行
+
+--plugin不指定时运行全部插件. shardable的插件(DeviceManager, DBSaver)可以运行多个进程, 按device_id分片(BaseModule.owns),
+其他插件只能运行1个进程.
+子进程意外退出时重新启动. 收到SIGTERM/SIGINT时转发给所有子进程: API进程停止接受连接, 等待处理中的请求
+最多--drain-timeout秒后退出; 插件进程uninstall后退出; 超时未退出的子进程被强制结束.
+memory://后端不能跨进程共享数据, 此时在本进程中运行单个APIServer(含插件).
+分析某个子进程的性能: kill -USR1 <pid> 采样, kill -USR2 <pid> 运行cProfile, 见pydatacoll.utils.profiler.
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import signal
+import socket
+import time
+from collections import OrderedDict
+
+from pydatacoll import api_server, plugins
+from pydatacoll.utils import backend, metrics, profiler
+from pydatacoll.utils.loop_monitor import LoopMonitor
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('Launcher')
+
+SUPERVISE_INTERVAL = 0.5  # 检查子进程的间隔(秒)
+RESTART_DELAY = 1  # 子进程退出后重新启动前的等待(秒), 连续退出时加倍, 最多MAX_RESTART_DELAY
+MAX_RESTART_DELAY = 30
+EXIT_GRACE = 5  # drain_timeout之后再等待子进程退出的时间(秒)
+
+
+def run_api(name, *args):
+    metrics.set_process(name)
+    api_server.run_server(*args)
+
+
+def run_plugin(name, shard=0, shards=1):
+    metrics.set_process('{}-{}'.format(name, shard))
+    io_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(io_loop)
+    plugin = plugins.plugin_classes()[name](io_loop, shard=shard, shards=shards)
+    io_loop.run_until_complete(plugin.install())
+    monitor = LoopMonitor(io_loop)
+    monitor.start()
+    publisher = metrics.SnapshotPublisher(io_loop, plugin.redis_pool)
+    publisher.add_report('loop', monitor.report)
+    publisher.start()
+    profiler.Profiler(io_loop).install_signal()
+
+    async def shutdown():
+        await publisher.stop()
+        await plugin.uninstall()
+        monitor.stop()
+    api_server.run_until_signal(io_loop, shutdown)
+
+
+def parse_plugins(specs, available):
+    """
+    :param specs: list of `Name` or `Name=processes`, empty for one process of every plugin
+    :param available: OrderedDict returned by plugins.plugin_classes()
+    :return: OrderedDict, name -> processes, raise ValueError
+    """
+    if not specs:
+        return OrderedDict((name, 1) for name in available)
+    counts = OrderedDict()
+    for spec in specs:
+        name, _, count = spec.partition('=')
+        if name not in available:
+            raise ValueError('unknown plugin: {}, available: {}'.format(name, ', '.join(available)))
+        count = int(count or 1)
+        if count < 1:
+            raise ValueError('processes of {} must be positive'.format(name))
+        if count > 1 and not available[name].shardable:
+            raise ValueError('{} can only run in one process'.format(name))
+        counts[name] = count
+    return counts
+
+
+class Launcher(object):
+    def __init__(self, host, port, workers=1, plugin_counts=None, drain_timeout=api_server.DRAIN_TIMEOUT):
+        self.drain_timeout = drain_timeout
+        self.stopping = False
+        # 进程名 -> (target, args)
+        self.specs = OrderedDict(('api-{}'.format(idx), (run_api, (
+            'api-{}'.format(idx), port, host, workers > 1, False, drain_timeout))) for idx in range(workers))
+        for name, count in (plugin_counts or {}).items():
+            for shard in range(count):
+                self.specs['{}-{}'.format(name, shard)] = (run_plugin, (name, shard, count))
+        self.processes = dict()  # 进程名 -> multiprocessing.Process
+        self.start_time = dict()  # 进程名 -> 最近一次启动的时间
+        self.restart_delay = dict()  # 进程名 -> 最近一次重启前的等待(秒)
+        self.restart_time = dict()  # 进程名 -> 可以重启的时间
+
+    def _start(self, name):
+        target, args = self.specs[name]
+        process = multiprocessing.Process(target=target, args=args, name=name)
+        process.start()
+        self.processes[name] = process
+        logger.info('%s started, pid=%s', name, process.pid)
+
+    def _stop(self, *_):
+        self.stopping = True
+
+    def supervise(self):
+        while not self.stopping:
+            now = time.monotonic()
+            for name in self.specs:
+                process = self.processes.get(name)
+                if process is None:
+                    if now >= self.restart_time.get(name, now):
+                        self._start(name)
+                        self.start_time[name] = now
+                    continue
+                if process.is_alive():
+                    continue
+                process.join()
+                self.processes.pop(name)
+                if now - self.start_time[name] > MAX_RESTART_DELAY:
+                    delay = RESTART_DELAY  # 运行了一段时间才退出, 不是连续失败
+                else:
+                    delay = min(self.restart_delay.get(name, RESTART_DELAY / 2) * 2, MAX_RESTART_DELAY)
+                self.restart_delay[name] = delay
+                self.restart_time[name] = now + delay
+                logger.warning('%s exited with code %s, restart in %ss', name, process.exitcode, delay)
+            time.sleep(SUPERVISE_INTERVAL)
+
+    def shutdown(self):
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        deadline = time.monotonic() + self.drain_timeout + EXIT_GRACE
+        for name, process in self.processes.items():
+            process.join(max(deadline - time.monotonic(), 0))
+            if process.is_alive():
+                logger.warning('%s did not exit in time, killed', name)
+                os.kill(process.pid, signal.SIGKILL)
+                process.join()
+        self.processes.clear()
+        logger.info('all processes stopped')
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        for sig_name in ('SIGUSR1', 'SIGUSR2'):  # 性能分析的信号应发给子进程, 发给本进程时忽略
+            if hasattr(signal, sig_name):
+                signal.signal(getattr(signal, sig_name), signal.SIG_IGN)
+        try:
+            self.supervise()
+        finally:
+            self.shutdown()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run API workers and plugins in separate processes')
+    parser.add_argument('--bind', default='127.0.0.1', help='address API workers listen on')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--workers', type=int, default=1, help='number of API worker processes')
+    parser.add_argument('--plugin', action='append', default=[], metavar='NAME[=PROCESSES]',
+                        help='plugin to run, can be repeated, default: one process of every plugin')
+    parser.add_argument('--no-plugins', action='store_true', help='run API workers only')
+    parser.add_argument('--drain-timeout', type=float, default=api_server.DRAIN_TIMEOUT,
+                        help='seconds to wait for requests in progress on shutdown')
+    parser.add_argument('--redis', help='backend url, default env PYDATACOLL_REDIS or ' + backend.DEFAULT_URL)
+    args = parser.parse_args(argv)
+    if args.redis:
+        backend.configure(args.redis)
+        os.environ['PYDATACOLL_REDIS'] = args.redis
+    if args.workers < 1:
+        parser.error('--workers must be positive')
+    if args.workers > 1 and not hasattr(socket, 'SO_REUSEPORT'):
+        parser.error('SO_REUSEPORT is not supported on this platform, use --workers 1')
+    if backend.is_memory():
+        logger.warning('%s can not be shared between processes, run a single APIServer with plugins',
+                       backend.current_url())
+        api_server.run_server(args.port, args.bind, drain_timeout=args.drain_timeout)
+        return
+    try:
+        plugin_counts = OrderedDict() if args.no_plugins else parse_plugins(args.plugin, plugins.plugin_classes())
+    except ValueError as e:
+        parser.error(str(e))
+    Launcher(args.bind, args.port, args.workers, plugin_counts, args.drain_timeout).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -1,42 +1,100 @@
 import asyncio
-import functools
+import importlib
+import pkgutil
+import time
+import zlib
 from abc import abstractmethod, ABCMeta
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
 import aioredis
 
+from pydatacoll.utils import backend, codec, metrics
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.utils.func_container import ParamFunctionContainer
 
 logger = my_logger.get_logger('BaseModule')
 
+PENDING = metrics.gauge('pydatacoll_plugin_pending_messages', 'messages dispatched to plugin handlers, not finished',
+                        ('plugin',))
+HANDLER_LATENCY = metrics.histogram('pydatacoll_plugin_handler_seconds', 'time from dispatch to handler finished',
+                                    ('plugin', 'channel'))
+
+
+def shard_of(device_id, shards):
+    """
+    :return: index of the process handling device_id when a plugin runs as `shards` processes
+    """
+    return zlib.crc32(str(device_id).encode('utf-8')) % shards
+
+
+def plugin_classes():
+    """
+    import all modules of this package
+    :return: OrderedDict, class name -> implemented BaseModule subclass
+    """
+    for _, module_name, _ in pkgutil.iter_modules(__path__):
+        try:
+            importlib.import_module('{}.{}'.format(__name__, module_name))
+        except Exception as e:
+            logger.error('load plugin module %s failed: %s', module_name, repr(e), exc_info=True)
+    return OrderedDict((plugin_class.__name__, plugin_class) for plugin_class in BaseModule.__subclasses__()
+                       if not hasattr(plugin_class, 'not_implemented'))
+
 
 class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
+    shardable = False  # 能否按device_id分成多个进程运行, 见owns()
+
     def __init__(self, io_loop: asyncio.AbstractEventLoop = None,
-                 redis_pool: aioredis.RedisPool = None):
+                 redis_pool: aioredis.RedisPool = None, shard=0, shards=1):
         super().__init__()
+        if shards > 1 and not self.shardable:
+            raise ValueError('{} can not run in {} shards'.format(type(self).__name__, shards))
+        self.shard = shard
+        self.shards = shards
         self.io_loop = io_loop or asyncio.get_event_loop()
         self.redis_pool = redis_pool
         self._redis_pool = self.redis_pool
         if self.redis_pool is None:
-            self.redis_pool = self._redis_pool = self.io_loop.run_until_complete(
-                    functools.partial(
-                            aioredis.create_pool, ('localhost', 6379), db=1, minsize=5, maxsize=10, encoding='utf-8')())
+            self.redis_pool = self._redis_pool = self.io_loop.run_until_complete(backend.create_pool(self.io_loop))
         self.initialized = False
         self.sub_client = None
         self.sub_channels = list()
         self.channel_router = dict()
+        self.duplicates = codec.DuplicateFilter()  # 同一个点的二进制和JSON两份只处理先到的
         self._register_channel()
+        self._pending = PENDING.labels(type(self).__name__)
+        self._latency = {channel: HANDLER_LATENCY.labels(type(self).__name__, channel)
+                         for channel in self.channel_router}
         # logger.info('plugin %s initialized', type(self).__name__)
 
+    def owns(self, device_id):
+        """
+        whether this process handles device_id, every process of a sharded plugin receives all messages
+        """
+        return self.shards == 1 or shard_of(device_id, self.shards) == self.shard
+
     def _register_channel(self):
         for fun_name, args in self.module_arg_dict.items():
             if 'channel' not in args:
                 raise Exception("wrong param_function prototype, need param: 'channel'")
             self.channel_router[args['channel']] = getattr(self, fun_name)
 
+    def _patterns(self):
+        """
+        :return: patterns to subscribe, handlers of CHANNEL:DEVICE_DATA:* also receive binary batches
+        """
+        patterns = list(self.channel_router)
+        if codec.DATA_PATTERN in self.channel_router:
+            patterns.append(codec.BIN_PATTERN)
+        return patterns
+
     async def install(self):
         try:
             self.sub_client = await self.redis_pool.acquire()
-            self.sub_channels = await self.sub_client.psubscribe(*[a['channel'] for a in self.module_arg_dict.values()])
+            self.sub_channels = await self.sub_client.psubscribe(*self._patterns())
             for channel in self.sub_channels:
                 asyncio.ensure_future(self._msg_reader(channel))
             await self.start()
@@ -48,7 +106,7 @@ class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
     async def uninstall(self):
         try:
             await self.stop()
-            await self.sub_client.punsubscribe(*[a['channel'] for a in self.module_arg_dict.values()])
+            await self.sub_client.punsubscribe(*self._patterns())
             self.redis_pool.release(self.sub_client)
             await self._redis_pool.clear()
             self.initialized = False
@@ -57,13 +115,37 @@ class BaseModule(ParamFunctionContainer, metaclass=ABCMeta):
             logger.error('plugin %s uninstall failed: %s', type(self).__name__, repr(e), exc_info=True)
 
     async def _msg_reader(self, ch):
+        channel = ch.name.decode()
         while await ch.wait_message():
-            real_channel, msg = await ch.get_json()
-            channel = ch.name.decode()
-            # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, channel, msg)
-            self.io_loop.create_task(self.channel_router[channel](real_channel, msg))
+            try:
+                real_channel, msg = await ch.get()
+                if channel == codec.BIN_PATTERN:
+                    device_id, points = codec.decode_batch(msg)
+                    for point in points:
+                        data_channel, data_dict = codec.to_message(device_id, point)
+                        if self.duplicates.first(data_channel, data_dict['time'], True):
+                            self._dispatch(codec.DATA_PATTERN, data_channel, data_dict)
+                    continue
+                msg = json.loads(msg.decode('utf-8'))
+                if channel == codec.DATA_PATTERN and not self.duplicates.first(real_channel, msg.get('time'), False):
+                    continue
+                # logger.debug("%s channel[%s] Got Message:%s", type(self).__name__, channel, msg)
+                self._dispatch(channel, real_channel, msg)
+            except Exception as e:
+                logger.error('%s read channel[%s] failed: %s', type(self).__name__, channel, repr(e), exc_info=True)
         logger.debug('%s quit msg_reader!', type(self).__name__)
 
+    def _dispatch(self, channel, real_channel, msg):
+        self._pending.inc()
+        self.io_loop.create_task(self._handle(channel, real_channel, msg, time.perf_counter()))
+
+    async def _handle(self, channel, real_channel, msg, dispatch_time):
+        try:
+            await self.channel_router[channel](real_channel, msg)
+        finally:
+            self._pending.dec()
+            self._latency[channel].observe(time.perf_counter() - dispatch_time)
+
     @abstractmethod
     async def start(self):
         pass
@@ -1,5 +1,6 @@
 from collections import namedtuple
 import math
+import time
 
 try:
     import ujson as json
@@ -7,11 +8,15 @@ except ImportError:
     import json
 import aiomysql
 from pydatacoll.plugins import BaseModule
+from pydatacoll.utils import metrics
 from pydatacoll.utils.func_container import param_function
 import pydatacoll.utils.logger as my_logger
 
 logger = my_logger.get_logger('DBSaver')
 
+ROWS = metrics.counter('pydatacoll_db_save_rows_total', 'rows written to mysql')
+SAVE_LATENCY = metrics.histogram('pydatacoll_db_save_seconds', 'time of executing and committing db_save_sql')
+
 PLUGIN_PARAM = dict(
         host='127.0.0.1', port=3306,
         user='pydatacoll', password='pydatacoll',
@@ -20,6 +25,7 @@ PLUGIN_PARAM = dict(
 
 
 class DBSaver(BaseModule):
+    shardable = True
     mysql_pool = None
 
     async def start(self):
@@ -34,6 +40,8 @@ class DBSaver(BaseModule):
     @param_function(channel='CHANNEL:DEVICE_DATA:*')
     async def save_mysql(self, channel, data_dict):
         try:
+            if not self.owns(data_dict['device_id']):
+                return
             logger.debug('save_mysql: got msg, channel=%s, dat_dict=%s', channel, data_dict)
             param = namedtuple('Param', data_dict.keys())(**data_dict)
             with (await self.redis_pool) as redis_client:
@@ -52,8 +60,10 @@ class DBSaver(BaseModule):
                         cur = await conn.cursor()
                         save_sql = term_item['db_save_sql'].format(PARAM=param)
                         logger.debug('save_mysql: saving data, sql=%s', save_sql)
-                        await cur.execute(save_sql)
+                        begin = time.perf_counter()
+                        ROWS.inc(await cur.execute(save_sql) or 0)
                         await conn.commit()
+                        SAVE_LATENCY.observe(time.perf_counter() - begin)
                         await conn.ensure_closed()
                         self.mysql_pool.release(conn)
         except Exception as ee:
@@ -1,19 +1,34 @@
+import asyncio
+import datetime
 import importlib
+try:
+    import ujson as json
+except ImportError:
+    import json
 
 from pydatacoll.plugins import BaseModule
+from pydatacoll.protocols.iec104.scheduler import InterrogationScheduler
 from pydatacoll.utils.func_container import param_function
+from pydatacoll.utils.rate_limit import TokenBucket
 import pydatacoll.utils.logger as my_logger
 
 logger = my_logger.get_logger('DeviceManager')
+STATS_INTERVAL = 10  # 连接统计和召唤计划写入redis, 及重新读取召唤分组周期的间隔(秒)
+STATS_SHARD = 'SET:CONNECT_STATS_SHARD'  # 分片运行时各分片的统计写入HS:CONNECT_STATS:{shard}
 
 
 class DeviceManager(BaseModule):
+    shardable = True
     device_dict = dict()
     protocol_dict = dict()
+    stats_task = None
 
     async def start(self):
+        self.stats_task = self.io_loop.create_task(self.save_stats())
         try:
             with (await self.redis_pool) as redis_client:
+                group_intervals = await redis_client.hgetall('HS:INTERROGATION_GROUP')
+                InterrogationScheduler.of(self.io_loop).set_group_intervals(group_intervals)
                 device_dict = await redis_client.smembers('SET:DEVICE')
                 for device_id in device_dict:
                     device_dict = await redis_client.hgetall('HS:DEVICE:{}'.format(device_id))
@@ -23,12 +38,67 @@ class DeviceManager(BaseModule):
             logger.error('init_devices failed: %s', repr(ee), exc_info=True)
 
     async def stop(self):
-        await self.del_device()
+        if self.stats_task is not None:
+            self.stats_task.cancel()
+            self.stats_task = None
+        await self.del_device(None)
+
+    def connect_stats(self):
+        stats = {'devices': 0, 'connected': 0, 'reconnecting': 0, 'retry_total': 0}
+        for device in self.device_dict.values():
+            device_stats = device.connect_stats()
+            if not device_stats:
+                continue
+            stats['devices'] += 1
+            stats['connected'] += 1 if device_stats['connected'] else 0
+            stats['reconnecting'] += 1 if device_stats['reconnecting'] else 0
+            stats['retry_total'] += device_stats['retry_count']
+        for name, bucket_stats in TokenBucket.all_stats(self.io_loop).items():
+            stats[name] = json.dumps(bucket_stats)
+        stats['time'] = datetime.datetime.now().isoformat()
+        return stats
+
+    async def save_stats(self):
+        while True:
+            try:
+                await asyncio.sleep(STATS_INTERVAL, loop=self.io_loop)
+                with (await self.redis_pool) as redis_client:
+                    # 分组周期的修改没有通知, 定期重新读取
+                    group_intervals = await redis_client.hgetall('HS:INTERROGATION_GROUP')
+                InterrogationScheduler.of(self.io_loop).set_group_intervals(group_intervals)
+                stats = self.connect_stats()
+                pairs = [value for pair in stats.items() for value in pair]
+                schedule_pairs = list()
+                for info in InterrogationScheduler.of(self.io_loop).schedule_list():
+                    schedule_pairs += ['{}:{}'.format(info['device_id'], info['name']), json.dumps(info)]
+                stats_key, schedule_key = 'HS:CONNECT_STATS', 'HS:INTERROGATION_SCHEDULE'
+                if self.shards > 1:
+                    stats_key += ':{}'.format(self.shard)
+                    schedule_key += ':{}'.format(self.shard)
+                with (await self.redis_pool) as redis_client:
+                    tr = redis_client.multi_exec()
+                    tr.delete(stats_key, schedule_key)
+                    tr.hmset(stats_key, *pairs)
+                    if schedule_pairs:
+                        tr.hmset(schedule_key, *schedule_pairs)
+                    if self.shards > 1:
+                        # 分片数减少后, 多余分片的统计自动过期; 未分片时的召唤计划不再更新, 删除
+                        tr.delete('HS:INTERROGATION_SCHEDULE')
+                        tr.sadd(STATS_SHARD, self.shard)
+                        tr.expire(stats_key, STATS_INTERVAL * 3)
+                        tr.expire(schedule_key, STATS_INTERVAL * 3)
+                    await tr.execute()
+            except asyncio.CancelledError:
+                break
+            except Exception as ee:
+                logger.error('save_stats failed: %s', repr(ee), exc_info=True)
 
     @param_function(channel='CHANNEL:DEVICE_FRESH')
     async def fresh_device(self, _, device_dict):
         try:
             device_id = str(device_dict['id'])
+            if not self.owns(device_id):
+                return
             device = self.device_dict.get(device_id)
             if device is not None:
                 if str(device.info['id']) != str(device_dict['id']) or \
@@ -74,6 +144,12 @@ class DeviceManager(BaseModule):
         if device is not None:
             device.fresh_task(term_dict=term_dict, term_item_dict=None, delete=False)
 
+    @param_function(channel='CHANNEL:TERM_FRESH')
+    async def fresh_term(self, _, term_dict):
+        device = self.device_dict.get(term_dict['device_id'])
+        if device is not None:
+            device.fresh_task(term_dict=term_dict, term_item_dict=None, delete=False)
+
     @param_function(channel='CHANNEL:TERM_DEL')
     async def del_term(self, _, term_dict):
         device = self.device_dict.get(term_dict['device_id'])
@@ -92,22 +168,77 @@ class DeviceManager(BaseModule):
         if device is not None:
             device.fresh_task(term_dict=None, term_item_dict=term_item_dict, delete=True)
 
+    @param_function(channel='CHANNEL:DEVICE_BULK')
+    async def bulk_fresh(self, _, bulk_dict):
+        device = self.device_dict.get(str(bulk_dict['device_id']))
+        if device is not None:
+            device.fresh_bulk(bulk_dict.get('terms', []), bulk_dict.get('term_items', []))
+
+    async def reply_not_found(self, method, device_id, items):
+        """
+        reply err_msg for each item of a device not in device_dict, so the api returns at once instead of timeout
+        """
+        with (await self.redis_pool) as redis_client:
+            for item in items:
+                if not item.get('request_id'):
+                    continue
+                await redis_client.publish('CHANNEL:DEVICE_{}:{}:{}:{}'.format(
+                        method.upper(), device_id, item['term_id'], item['item_id']), json.dumps({
+                    'device_id': device_id, 'term_id': item['term_id'], 'item_id': item['item_id'],
+                    'request_ids': [item['request_id']], 'err_msg': 'device not found!'}))
+
     @param_function(channel='CHANNEL:DEVICE_CALL')
     async def device_call(self, _, call_dict):
         try:
+            if not self.owns(call_dict['device_id']):
+                return
             device = self.device_dict.get(call_dict['device_id'])
+            if device is None:
+                await self.reply_not_found('call', call_dict['device_id'], [call_dict])
+                return
             await device.call_data(call_dict)
         except Exception as ee:
             logger.error('device_call failed: %s', repr(ee), exc_info=True)
 
+    @param_function(channel='CHANNEL:DEVICE_CALL_BATCH')
+    async def device_call_batch(self, _, batch_dict):
+        try:
+            if not self.owns(batch_dict['device_id']):
+                return
+            device = self.device_dict.get(batch_dict['device_id'])
+            if device is None:
+                await self.reply_not_found('call', batch_dict['device_id'], batch_dict['items'])
+                return
+            await device.call_data_batch(batch_dict['items'])
+        except Exception as ee:
+            logger.error('device_call_batch failed: %s', repr(ee), exc_info=True)
+
     @param_function(channel='CHANNEL:DEVICE_CTRL')
     async def device_ctrl(self, _, ctrl_dict):
         try:
+            if not self.owns(ctrl_dict['device_id']):
+                return
             device = self.device_dict.get(ctrl_dict['device_id'])
+            if device is None:
+                await self.reply_not_found('ctrl', ctrl_dict['device_id'], [ctrl_dict])
+                return
             await device.ctrl_data(ctrl_dict)
         except Exception as ee:
             logger.error('device_ctrl failed: %s', repr(ee), exc_info=True)
 
+    @param_function(channel='CHANNEL:DEVICE_CTRL_BATCH')
+    async def device_ctrl_batch(self, _, batch_dict):
+        try:
+            if not self.owns(batch_dict['device_id']):
+                return
+            device = self.device_dict.get(batch_dict['device_id'])
+            if device is None:
+                await self.reply_not_found('ctrl', batch_dict['device_id'], batch_dict['items'])
+                return
+            await device.ctrl_data_batch(batch_dict['items'])
+        except Exception as ee:
+            logger.error('device_ctrl_batch failed: %s', repr(ee), exc_info=True)
+
 
 if __name__ == '__main__':
     import asyncio
@@ -4,6 +4,7 @@ import functools
 from collections import namedtuple
 import math
 import datetime
+import time
 try:
     import ujson as json
 except ImportError:
@@ -12,16 +13,21 @@ from pydatacoll.utils.asteval import Interpreter
 import numpy as np
 import pandas as pd
 from pydatacoll.plugins import BaseModule
+from pydatacoll.utils import metrics
+from pydatacoll.utils.codec import DataPublisher
 from pydatacoll.utils.func_container import param_function
 import pydatacoll.utils.logger as my_logger
 
 logger = my_logger.get_logger('FormulaCalc')
 
+EVAL_LATENCY = metrics.histogram('pydatacoll_formula_eval_seconds', 'time of evaluating a formula', ('formula_id',))
+
 
 class FormulaCalc(BaseModule):
     formula_dict = dict()  # HS:TERM_ITEM:{term_id}:{item_id} -> value of HS:FORMULA:{formula_id}
     pandas_dict = dict()  # HS:DATA:{formula_id}:{term_id}:{item_id} -> pandas.Series
     interp = Interpreter(use_numpy=False)
+    data_publisher = DataPublisher()
 
     async def start(self):
         try:
@@ -70,8 +76,10 @@ class FormulaCalc(BaseModule):
     async def del_formula(self, _, formula_id=None):
         if formula_id is None:
             self.formula_dict.clear()
+            EVAL_LATENCY.children.clear()
         else:
             self.formula_dict.pop(formula_id)
+            EVAL_LATENCY.remove(formula_id)
 
     @param_function(channel='CHANNEL:DEVICE_DATA:*')
     async def param_update(self, channel: bytes, data_dict: dict):
@@ -114,17 +122,20 @@ class FormulaCalc(BaseModule):
                     if param in self.interp.symtable:
                         del self.interp.symtable[param]
                     self.interp.symtable[param] = self.pandas_dict[param_value]
+            begin = time.perf_counter()
             value = self.interp(formula['formula'])
+            EVAL_LATENCY.labels(formula_id).observe(time.perf_counter() - begin)
             logger.debug("calculate formula=%s, value=%s, type(value)=%s", formula['formula'], value, type(value))
             if isinstance(value, Number):
-                time_str = datetime.datetime.now().isoformat()
+                data_time = datetime.datetime.now()
                 value = float(value)
             elif isinstance(value, pd.Series):
-                time_str = value.index[0].isoformat()
+                data_time = value.index[0].to_pydatetime()
                 value = float(value[0])
             else:
                 logger.warn('calculate value type=%s, ignored.', type(value))
                 return
+            time_str = data_time.isoformat()
             with (await self.redis_pool) as redis_client:
                 last_value = await redis_client.hget('HS:DATA:{}'.format(formula['result']), time_str)
                 if last_value and math.isclose(value, float(last_value), rel_tol=1e-04):
@@ -132,9 +143,8 @@ class FormulaCalc(BaseModule):
                     return
                 await redis_client.hset("HS:DATA:{}".format(formula['result']), time_str, value)
                 await redis_client.rpush("LST:DATA_TIME:{}".format(formula['result']), time_str)
-                await redis_client.publish("CHANNEL:DEVICE_DATA:{}".format(formula['result']), json.dumps({
-                    'device_id': formula['device_id'], 'term_id': formula['term_id'],
-                    'item_id': formula['item_id'], 'time': time_str, 'value': value}))
+                await self.data_publisher.publish(redis_client, formula['device_id'], [
+                    (formula['term_id'], formula['item_id'], data_time, value)])
         except Exception as ee:
             logger.error('calc failed: %s', repr(ee), exc_info=True)
 
@@ -142,9 +152,10 @@ class FormulaCalc(BaseModule):
     async def formula_check(self, _, check_dict: dict):
         try:
             with (await self.redis_pool) as redis_client:
+                request_id = check_dict.pop('request_id', None)
                 check_rst = self.do_check(**check_dict)
-                pub_ch = "CHANNEL:FORMULA_CHECK_RESULT:{}".format(len(check_dict['formula']))
-                await redis_client.publish(pub_ch, check_rst)
+                pub_ch = "CHANNEL:FORMULA_CHECK_RESULT:{}".format(request_id)
+                await redis_client.publish(pub_ch, json.dumps({'request_ids': [request_id], 'rst': check_rst}))
         except Exception as ee:
             logger.error('param_update failed: %s', repr(ee), exc_info=True)
 
@@ -2,8 +2,6 @@ import asyncio
 import datetime
 
 import aioredis
-import functools
-import redis
 
 try:
     import ujson as json
@@ -11,9 +9,19 @@ except ImportError:
     import json
 from abc import ABCMeta, abstractmethod
 
+from pydatacoll.utils import backend, metrics
+from pydatacoll.utils.codec import DataPublisher
 from pydatacoll.utils import logger as my_logger
 
 logger = my_logger.get_logger('BaseDevice')
+REQUEST_TIME_OUT = 10  # 召测/控制请求等待设备应答的最长时间, 超时后同一指标的召测不再合并
+
+FRAMES = metrics.counter('pydatacoll_device_frames_total', 'frames exchanged with devices', ('protocol', 'direction'))
+FRAME_BYTES = metrics.counter('pydatacoll_device_frame_bytes_total', 'bytes of frames exchanged with devices',
+                              ('protocol', 'direction'))
+FRAME_DECODE = metrics.histogram('pydatacoll_device_frame_decode_seconds', 'time to parse a received frame',
+                                 ('protocol',), buckets=(.00005, .0001, .00025, .0005, .001, .0025, .005, .01, .025))
+POINTS = metrics.counter('pydatacoll_device_points_total', 'data points processed', ('protocol', 'method'))
 
 
 class BaseDevice(object, metaclass=ABCMeta):
@@ -23,12 +31,61 @@ class BaseDevice(object, metaclass=ABCMeta):
         self.device_info = device_info
         self.device_id = self.device_info['id']
         self.io_loop = io_loop or asyncio.get_event_loop()
-        self.redis_pool = redis_pool or self.io_loop.run_until_complete(
-                functools.partial(
-                        aioredis.create_pool, ('localhost', 6379), db=1, minsize=5, maxsize=10, encoding='utf-8')())
-        self.redis_client = redis.StrictRedis(db=1, decode_responses=True)
+        self.redis_pool = redis_pool or self.io_loop.run_until_complete(backend.create_pool(self.io_loop))
+        self.redis_client = backend.sync_client()
+        self.data_publisher = DataPublisher()
+        # method -> (term_id, item_id) -> list of (request time, request_id)
+        self.pending_requests = {'call': dict(), 'ctrl': dict()}
+
+    def push_request_id(self, method, term_id, item_id, request_id):
+        """
+        :return: True if an unexpired request of the same term_item is waiting for the device reply
+        """
+        now = self.io_loop.time()
+        pending = self.pending_requests[method].setdefault((str(term_id), str(item_id)), list())
+        while pending and now - pending[0][0] >= REQUEST_TIME_OUT:
+            pending.pop(0)
+        waiting = len(pending) > 0
+        pending.append((now, request_id))
+        return waiting
+
+    def pop_request_ids(self, method, term_id, item_id):
+        """
+        :return: request ids the device reply belongs to, all waiters for 'call', the earliest one for 'ctrl'
+        """
+        key = (str(term_id), str(item_id))
+        pending = self.pending_requests.get(method, {}).get(key)
+        if not pending:
+            return []
+        now = self.io_loop.time()
+        while pending and now - pending[0][0] >= REQUEST_TIME_OUT:
+            pending.pop(0)
+        if method == 'call':
+            request_ids = [request_id for _, request_id in pending]
+            pending.clear()
+        else:
+            request_ids = [pending.pop(0)[1]] if pending else []
+        if not pending:
+            del self.pending_requests[method][key]
+        return [request_id for request_id in request_ids if request_id]
+
+    async def reply_error(self, method, term_id, item_id, err_msg):
+        request_ids = self.pop_request_ids(method, term_id, item_id)
+        if not request_ids:
+            return
+        try:
+            with (await self.redis_pool) as redis_client:
+                await redis_client.publish('CHANNEL:DEVICE_{}:{}:{}:{}'.format(
+                        method.upper(), self.device_id, term_id, item_id), json.dumps({
+                    'device_id': self.device_id, 'term_id': term_id, 'item_id': item_id,
+                    'request_ids': request_ids, 'err_msg': err_msg}))
+        except Exception as e:
+            logger.error("device[%s] reply_error failed: %s", self.device_id, repr(e))
 
     async def save_frame(self, frame, send=True):
+        direction = 'send' if send is True else 'recv'
+        FRAMES.labels(self.device_info['protocol'], direction).inc()
+        FRAME_BYTES.labels(self.device_info['protocol'], direction).inc(len(frame))
         try:
             with (await self.redis_pool) as redis_client:
                 await redis_client.rpush("LST:FRAME:{}".format(self.device_id),
@@ -38,44 +95,115 @@ class BaseDevice(object, metaclass=ABCMeta):
         except Exception as e:
             logger.error("device[%s] save_frame failed: %s", self.device_id, repr(e))
 
-    # 召测
+    # 召测, 同一指标未应答的召测只向设备发送一次, 应答时回传所有request_id
     async def call_data(self, call_dict):
+        term_id = call_dict['term_id']
+        item_id = call_dict['item_id']
         try:
+            if self.push_request_id('call', term_id, item_id, call_dict.get('request_id')):
+                logger.debug('device[%s] call_data, term_item(%s,%s) is calling, merged', self.device_id, term_id,
+                             item_id)
+                return
             if not self.connected:
                 raise Exception('device not connected!')
-            term_id = call_dict['term_id']
-            item_id = call_dict['item_id']
             with (await self.redis_pool) as redis_client:
                 term_item = await redis_client.hgetall('HS:TERM_ITEM:{term_id}:{item_id}'.format(
                         term_id=term_id, item_id=item_id))
                 logger.debug('device[%s] call_data, term_item=%s', self.device_id, term_item)
                 if not term_item:
-                    logger.error('device[%s] HS:TERM_ITEM:{%s}:{%s} not found!', self.device_id, term_id, item_id)
-                    return
+                    raise Exception('HS:TERM_ITEM:{}:{} not found!'.format(term_id, item_id))
                 frame = self.prepare_call_frame(term_item)
                 await self.send_frame(frame)
         except Exception as e:
             logger.error('device[%s] call_data failed: %s', self.device_id, repr(e))
+            await self.reply_error('call', term_id, item_id, str(e))
+
+    # 批量召测, 一次取出所有指标配置, 由send_frames按设备能力流水线发送
+    async def call_data_batch(self, call_list):
+        """
+        :param call_list: [{term_id: xxx, item_id: xxx, request_id: xxx}, ...]
+        """
+        to_call = list()
+        for call_dict in call_list:
+            if not self.push_request_id('call', call_dict['term_id'], call_dict['item_id'],
+                                        call_dict.get('request_id')):
+                to_call.append((call_dict['term_id'], call_dict['item_id']))
+        try:
+            if not to_call:
+                return
+            if not self.connected:
+                raise Exception('device not connected!')
+            with (await self.redis_pool) as redis_client:
+                pipe = redis_client.pipeline()
+                futures = [pipe.hgetall('HS:TERM_ITEM:{}:{}'.format(term_id, item_id)) for term_id, item_id in to_call]
+                await pipe.execute()
+            frames = list()
+            for (term_id, item_id), fut in zip(to_call, futures):
+                term_item = fut.result()
+                if not term_item:
+                    await self.reply_error('call', term_id, item_id, 'HS:TERM_ITEM:{}:{} not found!'.format(
+                            term_id, item_id))
+                    continue
+                frames.append(self.prepare_call_frame(term_item))
+            logger.debug('device[%s] call_data_batch, frame count=%s', self.device_id, len(frames))
+            await self.send_frames(frames)
+        except Exception as e:
+            logger.error('device[%s] call_data_batch failed: %s', self.device_id, repr(e))
+            for term_id, item_id in to_call:
+                await self.reply_error('call', term_id, item_id, str(e))
 
     # 控制
     async def ctrl_data(self, ctrl_dict):
+        term_id = ctrl_dict['term_id']
+        item_id = ctrl_dict['item_id']
         try:
+            self.push_request_id('ctrl', term_id, item_id, ctrl_dict.get('request_id'))
             if not self.connected:
                 raise Exception('device not connected!')
-            term_id = ctrl_dict['term_id']
-            item_id = ctrl_dict['item_id']
             value = ctrl_dict['value']
             with (await self.redis_pool) as redis_client:
                 term_item = await redis_client.hgetall('HS:TERM_ITEM:{term_id}:{item_id}'.format(
                                 term_id=term_id, item_id=item_id))
                 logger.debug('device[%s] ctrl_data, term_item=%s, value=%s', self.device_id, term_item, value)
                 if not term_item:
-                    logger.error('device[%s] HS:TERM_ITEM:{%s}:{%s} not found!', self.device_id, term_id, item_id)
-                    return
+                    raise Exception('HS:TERM_ITEM:{}:{} not found!'.format(term_id, item_id))
                 frame = self.prepare_ctrl_frame(term_item, value)
                 await self.send_frame(frame)
         except Exception as e:
             logger.error('device[%s] ctrl_data failed: %s', self.device_id, repr(e))
+            await self.reply_error('ctrl', term_id, item_id, str(e))
+
+    # 批量控制, 一次取出所有指标配置, 由prepare_ctrl_frames按设备能力合并为多信息对象帧
+    async def ctrl_data_batch(self, ctrl_list):
+        """
+        :param ctrl_list: [{term_id: xxx, item_id: xxx, value: xxx, request_id: xxx}, ...]
+        """
+        for ctrl_dict in ctrl_list:
+            self.push_request_id('ctrl', ctrl_dict['term_id'], ctrl_dict['item_id'], ctrl_dict.get('request_id'))
+        try:
+            if not self.connected:
+                raise Exception('device not connected!')
+            with (await self.redis_pool) as redis_client:
+                pipe = redis_client.pipeline()
+                futures = [pipe.hgetall('HS:TERM_ITEM:{}:{}'.format(ctrl_dict['term_id'], ctrl_dict['item_id']))
+                           for ctrl_dict in ctrl_list]
+                await pipe.execute()
+            to_ctrl = list()
+            for ctrl_dict, fut in zip(ctrl_list, futures):
+                term_item = fut.result()
+                if not term_item:
+                    await self.reply_error('ctrl', ctrl_dict['term_id'], ctrl_dict['item_id'],
+                                           'HS:TERM_ITEM:{}:{} not found!'.format(ctrl_dict['term_id'],
+                                                                                 ctrl_dict['item_id']))
+                    continue
+                to_ctrl.append((term_item, ctrl_dict['value']))
+            frames = self.prepare_ctrl_frames(to_ctrl)
+            logger.debug('device[%s] ctrl_data_batch, frame count=%s', self.device_id, len(frames))
+            await self.send_frames(frames)
+        except Exception as e:
+            logger.error('device[%s] ctrl_data_batch failed: %s', self.device_id, repr(e))
+            for ctrl_dict in ctrl_list:
+                await self.reply_error('ctrl', ctrl_dict['term_id'], ctrl_dict['item_id'], str(e))
 
     # TODO: fixme
     def change_device_status(self, on_line):
@@ -97,6 +225,7 @@ class BaseDevice(object, metaclass=ABCMeta):
             return
         try:
             with (await self.redis_pool) as redis_client:
+                points = list()  # 'data'的数据汇总成一批发布
                 for data_time, protocol_code, data_value in data_pairs:
                     map_key = 'HS:MAPPING:{}:{}:{}'.format(self.device_info['protocol'].upper(),
                                                            self.device_id, protocol_code)
@@ -106,12 +235,6 @@ class BaseDevice(object, metaclass=ABCMeta):
                         continue
                     if 'coefficient' in term_item and 'base_val' in term_item:
                         data_value = data_value * float(term_item['coefficient']) + float(term_item['base_val'])
-                    json_data = json.dumps({
-                        'device_id': self.device_id, 'term_id': term_item['term_id'], 'item_id': term_item['item_id'],
-                        'time': data_time.isoformat(), 'value': data_value,
-                    })
-                    pub_channel = 'CHANNEL:DEVICE_{}:{}:{}:{}'.format(
-                            method.upper(), self.device_id, term_item['term_id'], term_item['item_id'])
                     if method == 'data':
                         data_key = "{}:{}:{}".format(
                                 self.device_id, term_item['term_id'], term_item['item_id'])
@@ -123,8 +246,20 @@ class BaseDevice(object, metaclass=ABCMeta):
                         #         {'warn_msg': check_result, 'device_id': self.device_id, 'term_id': term_item['term_id'],
                         #          'item_id': term_item['item_id'], 'time': data_time, 'value': data_value})
                         #     await redis_client.publish('CHANNEL:WARNING', warn_msg)
+                        points.append((term_item['term_id'], term_item['item_id'], data_time, data_value))
+                        continue
+                    pub_data = {
+                        'device_id': self.device_id, 'term_id': term_item['term_id'], 'item_id': term_item['item_id'],
+                        'time': data_time.isoformat(), 'value': data_value,
+                        'request_ids': self.pop_request_ids(method, term_item['term_id'], term_item['item_id']),
+                    }
+                    json_data = json.dumps(pub_data)
+                    pub_channel = 'CHANNEL:DEVICE_{}:{}:{}:{}'.format(
+                            method.upper(), self.device_id, term_item['term_id'], term_item['item_id'])
                     rst = await redis_client.publish(pub_channel, json_data)
                     logger.debug('pub to %s, val=%s, rst=%s', pub_channel, json_data, rst)
+                await self.data_publisher.publish(redis_client, self.device_id, points)
+            POINTS.labels(self.device_info['protocol'], method).inc(len(data_pairs))
         except Exception as e:
             logger.exception(e)
 
@@ -137,10 +272,33 @@ class BaseDevice(object, metaclass=ABCMeta):
         """
         pass
 
+    async def send_frames(self, frames):
+        """
+        :param frames: frames send to remote device, protocol may send them in pipeline
+        :return: None
+        """
+        for frame in frames:
+            await self.send_frame(frame)
+
+    def connect_stats(self):
+        """
+        :return: dict of link statistics, empty if the device holds no connection
+        """
+        return {}
+
     @abstractmethod
     def fresh_task(self, term_dict, term_item_dict, delete=False):
         pass
 
+    def fresh_bulk(self, term_list, term_item_list):
+        """
+        many terms/term_items of this device added at once, devices may override to refresh only once
+        """
+        for term_dict in term_list:
+            self.fresh_task(term_dict, None)
+        for term_item_dict in term_item_list:
+            self.fresh_task(None, term_item_dict)
+
     @abstractmethod
     def prepare_call_frame(self, term_item_dict):
         """
@@ -158,6 +316,13 @@ class BaseDevice(object, metaclass=ABCMeta):
         """
         pass
 
+    def prepare_ctrl_frames(self, ctrl_list):
+        """
+        :param ctrl_list: list of (term_item_dict, value)
+        :return: frames used in call self.send_frames, one frame per ctrl unless the device packs them
+        """
+        return [self.prepare_ctrl_frame(term_item_dict, value) for term_item_dict, value in ctrl_list]
+
     @abstractmethod
     def disconnect(self, reconnect=False):
         pass
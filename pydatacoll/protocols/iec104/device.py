@@ -1,42 +1,66 @@
 import asyncio
-from collections import deque
+import time
+from collections import deque, OrderedDict
 import aioredis
 
-from pydatacoll.protocols import BaseDevice
+from pydatacoll.protocols import BaseDevice, FRAME_DECODE
+from pydatacoll.utils.rate_limit import Backoff, TokenBucket
+from pydatacoll.utils.timer_wheel import TimerWheel
 import pydatacoll.utils.logger as my_logger
 from .frame import *
+from .scheduler import InterrogationScheduler
 
 logger = my_logger.get_logger('IEC104Device')
 
+# I帧发送优先级, 数值越小越优先
+SEND_PRIORITY_CTRL = 0  # 遥控、设点命令及其执行帧
+SEND_PRIORITY_CALL = 1  # 总召唤、电能量召唤、时钟同步等系统命令
+SEND_PRIORITY_READ = 2  # 读命令
+
+DECODE_METRIC = FRAME_DECODE.labels('iec104')
+
 
 class IEC104Device(BaseDevice):
     def __init__(self, device_info: dict, io_loop: asyncio.AbstractEventLoop,
                  redis_pool: aioredis.RedisPool):
         super(IEC104Device, self).__init__(device_info, io_loop, redis_pool)
-        self.coll_interval = datetime.timedelta(minutes=15)
         self.ssn = 0
         self.rsn = 0
         self.k = 0
         self.w = 0
-        self.send_list = deque()
+        self.started = False  # 收到STARTDT_CON后才允许发送I帧
+        self.send_queues = tuple(deque() for _ in range(SEND_PRIORITY_READ + 1))  # 按优先级排队等待发送的I帧
+        self.unacked = deque()  # 已发送未被确认的I帧: (ssn, 发送时间, TYP)
+        self.u_unconfirmed = dict()  # 已发送未被确认的U帧: UFrame -> 发送时间
         self.last_call_all_time_begin = None
         self.last_call_all_time_end = None
         self.connect_retry_count = 0
+        self.backoff = Backoff()
+        self.connect_limiter = TokenBucket.of(self.io_loop, 'connect')
+        self.scheduler = InterrogationScheduler.of(self.io_loop)
+        self.group_tasks = dict()  # 分组召唤任务名 -> 周期(秒), 来自所属终端的配置
+        self.io_loop.create_task(self.load_groups())
         self.user_canceled = False
         self.reader = None
         self.writer = None
         self.reconnect_handler = self.io_loop.call_soon(lambda: self.io_loop.create_task(self.reconnect()))
-        self.task_handler = None
         self.receive_handler = None
+        timer_wheel = TimerWheel.of(self.io_loop)
+        self.timers = {timer_id: timer_wheel.timer(getattr(self, "on_timer{}".format(timer_id.name[-1])))
+                       for timer_id in (IECParam.T1, IECParam.T2, IECParam.T3)}
 
     async def reconnect(self):
         try:
             if self.reconnect_handler:
                 self.reconnect_handler = None
             self.user_canceled = False
-            self.reader, self.writer = await asyncio.wait_for(
-                    asyncio.open_connection(self.device_info['ip'], self.device_info['port'], loop=self.io_loop),
-                    timeout=IECParam.T0)
+            await self.connect_limiter.acquire()
+            if self.device_info.get('unix_socket'):
+                connection = asyncio.open_unix_connection(self.device_info['unix_socket'], loop=self.io_loop)
+            else:
+                connection = asyncio.open_connection(self.device_info['ip'], self.device_info['port'],
+                                                     loop=self.io_loop)
+            self.reader, self.writer = await asyncio.wait_for(connection, timeout=IECParam.T0)
             self.change_device_status(on_line=True)
             self.receive_handler = self.io_loop.create_task(self.receive())
             await self.send_frame(iec_104.init_frame(UFrame.STARTDT_ACT))
@@ -44,8 +68,9 @@ class IEC104Device(BaseDevice):
             logger.warning('device[%s] connect timeout, try reconnect..', self.device_id)
             self.disconnect(reconnect=True)
         except Exception as e:
-            logger.warning("device[%s] connect to %s:%s failed: %s, connect_retry_count=%s",
-                           self.device_id, self.device_info['ip'], self.device_info['port'], repr(e),
+            logger.warning("device[%s] connect to %s failed: %s, connect_retry_count=%s", self.device_id,
+                           self.device_info.get('unix_socket') or '{}:{}'.format(
+                               self.device_info.get('ip'), self.device_info.get('port')), repr(e),
                            self.connect_retry_count)
             self.disconnect(reconnect=True)
 
@@ -55,7 +80,10 @@ class IEC104Device(BaseDevice):
             if self.reconnect_handler:
                 self.reconnect_handler.cancel()
         elif self.reconnect_handler is None:
-            self.reconnect_handler = self.io_loop.call_later(3, lambda: self.io_loop.create_task(self.reconnect()))
+            delay = self.backoff.next_delay()
+            logger.debug('device[%s] reconnect in %.1fs', self.device_id, delay)
+            self.reconnect_handler = self.io_loop.call_later(
+                    delay, lambda: self.io_loop.create_task(self.reconnect()))
             self.connect_retry_count += 1
         self.stop_timer(IECParam.T1)
         self.stop_timer(IECParam.T2)
@@ -68,7 +96,12 @@ class IEC104Device(BaseDevice):
         self.rsn = 0
         self.k = 0
         self.w = 0
-        self.send_list.clear()
+        self.started = False
+        self.scheduler.remove(self)
+        for queue in self.send_queues:
+            queue.clear()
+        self.unacked.clear()
+        self.u_unconfirmed.clear()
 
     def inc_ssn(self):
         self.ssn = self.ssn + 1 if self.ssn < 32767 else 0
@@ -78,17 +111,34 @@ class IEC104Device(BaseDevice):
         self.rsn = self.rsn + 1 if self.rsn < 32767 else 0
         return self.rsn
 
-    def start_timer(self, timer_id):
-        self.stop_timer(timer_id)
-        setattr(self, "{}".format(timer_id.name.lower()),
-                self.io_loop.call_later(timer_id, getattr(self, "on_timer{}".format(timer_id.name[-1]))))
+    def start_timer(self, timer_id, delay=None):
+        self.timers[timer_id].start(timer_id if delay is None else max(delay, 0))
 
     def stop_timer(self, timer_id):
-        if hasattr(self, "{}".format(timer_id.name.lower())):
-            timeout_handler = getattr(self, "{}".format(timer_id.name.lower()))
-            if timeout_handler:
-                timeout_handler.cancel()
-                setattr(self, "{}".format(timer_id.name.lower()), None)
+        self.timers[timer_id].stop()
+
+    def reset_t1(self):
+        """
+        T1 guards the oldest frame still waiting for confirmation, restart it whenever frames are acknowledged
+        """
+        send_times = list(self.u_unconfirmed.values())
+        if self.unacked:
+            send_times.append(self.unacked[0][1])
+        if send_times:
+            self.start_timer(IECParam.T1, min(send_times) + IECParam.T1 - self.io_loop.time())
+        else:
+            self.stop_timer(IECParam.T1)
+
+    def ack_frames(self, outstanding):
+        """
+        peer acknowledged all I-frames except the last `outstanding` ones
+        """
+        while len(self.unacked) > outstanding:
+            self.unacked.popleft()
+        self.k = outstanding
+        self.reset_t1()
+        if self.k < IECParam.K and any(self.send_queues):
+            self.io_loop.create_task(self.send_pending())
 
     # def on_timer0(self):
     #     logger.debug('device[%s] T0 timeout', self.device_id)
@@ -116,7 +166,9 @@ class IEC104Device(BaseDevice):
             self.start_timer(IECParam.T3)
             self.receive_handler = self.io_loop.create_task(self.receive())
             logger.debug("device[%s] recv: %s", self.device_id, data.hex())
+            begin = time.perf_counter()
             frame = iec_104.parse(data)
+            DECODE_METRIC.observe(time.perf_counter() - begin)
             self.io_loop.create_task(self.save_frame(data, send=False))
             if isinstance(frame.APCI1, UFrame):
                 await self.handle_u(frame)
@@ -125,15 +177,16 @@ class IEC104Device(BaseDevice):
                              self.device_id, (self.ssn, frame.APCI2), (self.rsn, frame.APCI1), (self.k, self.w))
                 # S or I, check rsn, ssn first
                 bad_frame = False
-                if self.ssn < frame.APCI2:
+                outstanding = (self.ssn - frame.APCI2) % 32768
+                if outstanding > len(self.unacked):
                     bad_frame = True
                 else:
-                    self.k = self.ssn - frame.APCI2
+                    self.ack_frames(outstanding)
                 if frame.APCI1 != 'S':
                     if self.rsn != frame.APCI1:
                         bad_frame = True
                     else:
-                        self.rsn += 1
+                        self.inc_rsn()
                         self.w += 1
                 if bad_frame:
                     logger.error("device[%s] I_frame mismatch! try reconnect..", self.device_id)
@@ -162,31 +215,37 @@ class IEC104Device(BaseDevice):
             logger.debug("device[%s] got U_FRAME: %s", self.device_id, frame.APCI1.name)
             if frame.APCI1 == UFrame.STARTDT_ACT:
                 # 对方也发送了STARTDT, 删除之前自己发送的STARTDT
-                if self.send_list and self.send_list[0].APCI1 == UFrame.STARTDT_ACT:
+                if self.u_unconfirmed.pop(UFrame.STARTDT_ACT, None) is not None:
                     logger.info('device[%s] remote side send STARTDT_ACT too, ignored mine', self.device_id)
-                    self.send_list.popleft()
-                    self.stop_timer(IECParam.T1)
+                    self.reset_t1()
                 await self.send_frame(iec_104.init_frame(UFrame.STARTDT_CON))
+                self.started = True
+                self.backoff.reset()
                 self.io_loop.create_task(self.run_task())
-                self.io_loop.create_task(self.check_to_send(frame))
+                self.io_loop.create_task(self.send_pending())
             elif frame.APCI1 == UFrame.STARTDT_CON:
+                self.u_unconfirmed.pop(UFrame.STARTDT_ACT, None)
+                self.reset_t1()
+                self.started = True
+                self.backoff.reset()
                 self.io_loop.create_task(self.run_task())
-                self.io_loop.create_task(self.check_to_send(frame))
+                self.io_loop.create_task(self.send_pending())
             elif frame.APCI1 == UFrame.TESTFR_ACT:
                 # 对方也发送了TESTFR_ACT, 删除之前自己发送的TESTFR_ACT
-                if self.send_list and self.send_list[0].APCI1 == UFrame.TESTFR_ACT:
+                if self.u_unconfirmed.pop(UFrame.TESTFR_ACT, None) is not None:
                     logger.info('device[%s] remote side send TESTFR_ACT too, ignored mine', self.device_id)
-                    self.send_list.popleft()
-                    self.stop_timer(IECParam.T1)
+                    self.reset_t1()
                 await self.send_frame(iec_104.init_frame(UFrame.TESTFR_CON))
             elif frame.APCI1 == UFrame.TESTFR_CON:
-                self.io_loop.create_task(self.check_to_send(frame))
+                self.u_unconfirmed.pop(UFrame.TESTFR_ACT, None)
+                self.reset_t1()
             elif frame.APCI1 == UFrame.STOPDT_ACT:
                 await self.send_frame(iec_104.init_frame(UFrame.STOPDT_CON))
                 logger.debug("device[%s] receive STOPDT_ACT.", self.device_id)
                 self.disconnect()
             elif frame.APCI1 == UFrame.STOPDT_CON:
-                self.stop_timer(IECParam.T1)
+                self.u_unconfirmed.pop(UFrame.STOPDT_ACT, None)
+                self.reset_t1()
                 logger.debug("device[%s] receive STOPDT_CON.", self.device_id)
                 self.disconnect()
         except Exception as e:
@@ -201,21 +260,18 @@ class IEC104Device(BaseDevice):
             if self.w >= IECParam.W:
                 logger.debug("self.w,Param_S=%s, send S_frame", (self.w, IECParam.W.value))
                 await self.send_frame(iec_104.init_frame("S", self.rsn))
-            if frame.ASDU.Cause in (Cause.actcon, Cause.req):
-                self.stop_timer(IECParam.T1)
-                self.io_loop.create_task(self.check_to_send(frame))
             if frame.ASDU.Cause in (Cause.spont, Cause.introgen, Cause.reqcogen) or \
+                    Cause.inro1 <= frame.ASDU.Cause <= Cause.inro16 or \
+                    Cause.reqco1 <= frame.ASDU.Cause <= Cause.reqco4 or \
                     (frame.ASDU.Cause == Cause.req and TYP.M_SP_NA_1 <= frame.ASDU.TYP <= TYP.M_EP_TD_1) or \
                     (frame.ASDU.Cause == Cause.actcon and TYP.C_SC_NA_1 <= frame.ASDU.TYP <= TYP.C_SE_TC_1 and
                      frame.ASDU.data[0].SE == 0):
-                idx = 0
                 data_pairs = set()
-                for data in frame.ASDU.data:
+                for idx, data in enumerate(frame.ASDU.data):
                     # TODO 实现完整的品质描述词判断
                     if hasattr(data, "IV") and data.IV != 0:
                         continue
                     data_addr = data.Address if frame.ASDU.SQ == 0 else frame.ASDU.StartAddress + idx
-                    idx += 1
                     data_time = data.CP56Time2a if hasattr(data, "CP56Time2a") else data.CP24Time2a \
                         if hasattr(data, "CP24Time2a") else datetime.datetime.now()
                     data_pairs.add((data_time, data_addr, data.Value))
@@ -227,11 +283,18 @@ class IEC104Device(BaseDevice):
                 if TYP.C_SC_NA_1 <= frame.ASDU.TYP <= TYP.C_SE_TC_1 and frame.ASDU.data[0].SE == 1:
                     send_data = frame
                     send_data.ASDU.Cause = Cause.act
-                    send_data.ASDU.data[0].SE = 0  # 执行
+                    for data in send_data.ASDU.data:
+                        data.SE = 0  # 执行
                     await self.send_frame(send_data)
             elif frame.ASDU.Cause == Cause.actterm:
                 if frame.ASDU.TYP == TYP.C_CI_NA_1:  # 电能脉冲召唤命令
-                    self.last_call_all_time_end = datetime.datetime.now()
+                    if 1 <= frame.ASDU.data[0].RQT <= 4:
+                        self.scheduler.finish(self, 'counter{}'.format(frame.ASDU.data[0].RQT))
+                    else:
+                        self.last_call_all_time_end = datetime.datetime.now()
+                        self.scheduler.finish(self, 'station')
+                elif frame.ASDU.TYP == TYP.C_IC_NA_1 and 21 <= frame.ASDU.data[0].QOI <= 36:  # 分组召唤
+                    self.scheduler.finish(self, 'group{}'.format(frame.ASDU.data[0].QOI - 20))
             elif frame.ASDU.Cause == Cause.act:
                 logger.warn('device[%s] handle_i: act frame not allowed!', self.device_id)
             # TODO: 完成尚未实现的I帧
@@ -242,103 +305,181 @@ class IEC104Device(BaseDevice):
             logger.error("device[%s] handle_i failed: %s", self.device_id, repr(e), exc_info=True)
             self.disconnect(reconnect=True)
 
-    # TODO：优化发送逻辑
+    @staticmethod
+    def send_priority(frame):
+        if TYP.C_SC_NA_1 <= frame.ASDU.TYP <= TYP.C_SE_TC_1 or frame.ASDU.Cause != Cause.act:
+            return SEND_PRIORITY_CTRL
+        if frame.ASDU.TYP == TYP.C_RD_NA_1:
+            return SEND_PRIORITY_READ
+        return SEND_PRIORITY_CALL
+
     async def send_frame(self, frame, check=True):
+        """
+        S and U frames are written at once, I frames are queued by priority and sent by send_pending
+        """
         if frame is None:
             return
-        stream_write = False
-        encode_frame = None
         try:
             # send S
             if frame.APCI1 == "S":
                 self.stop_timer(IECParam.T2)
                 frame.APCI2 = self.rsn
-                encode_frame = iec_104.build_isu(frame)
-                self.writer.write(encode_frame)
-                await self.writer.drain()
                 self.w = 0
-                stream_write = True
+                await self.write_frames([iec_104.build_isu(frame)], 'S')
             # send U
             elif isinstance(frame.APCI1, UFrame):
-                if not check or not self.send_list:
-                    encode_frame = iec_104.build_isu(frame)
-                    self.writer.write(encode_frame)
-                    await self.writer.drain()
-                    stream_write = True
-                    if frame.APCI1 in (UFrame.STARTDT_ACT, UFrame.TESTFR_ACT):
-                        self.start_timer(IECParam.T1)
-                if check and frame.APCI1 in (
-                        UFrame.STARTDT_ACT, UFrame.TESTFR_ACT):
-                    self.send_list.append(frame)
+                if frame.APCI1 in (UFrame.STARTDT_ACT, UFrame.TESTFR_ACT, UFrame.STOPDT_ACT):
+                    self.u_unconfirmed[frame.APCI1] = self.io_loop.time()
+                    self.reset_t1()
+                await self.write_frames([iec_104.build_isu(frame)], frame.APCI1)
             # send I
             else:
-                if check is False or not self.send_list or frame.ASDU.Cause not in (Cause.act,):
-                    self.stop_timer(IECParam.T2)
-                    frame.APCI1 = self.ssn
-                    frame.APCI2 = self.rsn
-                    encode_frame = iec_104.build_isu(frame)
-                    if self.k >= IECParam.K:
-                        logger.warn('self.k,ParamK=%s, continue send..', (self.k, IECParam.K))
-                    self.writer.write(encode_frame)
-                    await self.writer.drain()
-                    self.inc_ssn()
-                    self.k += 1
-                    self.w = 0
-                    stream_write = True
-                    if frame.ASDU.Cause in (Cause.act,):
-                        self.start_timer(IECParam.T1)
-                if check and frame.ASDU.Cause in (Cause.act,):
-                    self.send_list.append(frame)
-            if stream_write:
-                logger.debug("device[%s] send_frame(%s): %s", self.device_id,
-                             frame.APCI1 if frame.APCI1 == "S" or isinstance(frame.APCI1, UFrame) else
-                             frame.ASDU.TYP, encode_frame.hex())
-                self.io_loop.create_task(self.save_frame(encode_frame, send=True))
-            logger.debug("device[%s] after send_frame: send_list=%s", self.device_id,
-                         [frm.APCI1 if frm.APCI1 == 'S' or isinstance(frm.APCI1, UFrame) else
-                          frm.ASDU.TYP for frm in self.send_list])
+                self.send_queues[self.send_priority(frame)].append(frame)
+                await self.send_pending()
         except Exception as e:
             logger.error("device[%s] send_frame failed: %s", self.device_id, repr(e), exc_info=True)
             self.disconnect(reconnect=True)
 
-    async def check_to_send(self, frame):
+    async def send_frames(self, frames):
+        for frame in frames:
+            self.send_queues[self.send_priority(frame)].append(frame)
+        await self.send_pending()
+
+    async def send_pending(self):
+        """
+        fill the k window with queued I frames, higher priority first, all frames written in one call
+        """
         try:
-            self.stop_timer(IECParam.T1)
-            if not self.send_list or frame is None:
+            encode_list = list()
+            now = self.io_loop.time()
+            while self.started and self.k < IECParam.K:
+                queue = next((queue for queue in self.send_queues if queue), None)
+                if queue is None:
+                    break
+                frame = queue.popleft()
+                frame.APCI1 = self.ssn
+                frame.APCI2 = self.rsn
+                encode_list.append(iec_104.build_isu(frame))
+                self.unacked.append((self.ssn, now, frame.ASDU.TYP))
+                self.inc_ssn()
+                self.k += 1
+            if not encode_list:
                 return
-            if isinstance(frame.APCI1, UFrame) and frame.APCI1 in \
-                    (UFrame.STARTDT_CON, UFrame.TESTFR_CON, UFrame.STOPDT_CON):
-                pop_frame = self.send_list.popleft()
-                logger.debug('device[%s] check_to_send: remove U_Frame %s', self.device_id, pop_frame.APCI1.name)
-                await self.send_frame(self.send_list[0] if self.send_list else None, check=False)
-            elif frame.ASDU.TYP == self.send_list[0].ASDU.TYP \
-                    or frame.ASDU.Cause == Cause.req and self.send_list[0].ASDU.TYP == TYP.C_RD_NA_1:
-                pop_frame = self.send_list.popleft()
-                logger.debug('device[%s] check_to_send: remove I_Frame %s', self.device_id, pop_frame.ASDU.TYP.name)
-                await self.send_frame(self.send_list[0] if self.send_list else None, check=False)
+            self.stop_timer(IECParam.T2)
+            self.w = 0
+            self.reset_t1()
+            await self.write_frames(encode_list, 'I')
         except Exception as e:
-            logger.error("device[%s] check_to_send failed: %s", self.device_id, repr(e), exc_info=True)
+            logger.error("device[%s] send_pending failed: %s", self.device_id, repr(e), exc_info=True)
             self.disconnect(reconnect=True)
 
+    async def write_frames(self, encode_list, frame_type):
+        self.writer.write(b''.join(encode_list))
+        await self.writer.drain()
+        for encode_frame in encode_list:
+            logger.debug("device[%s] send_frame(%s): %s", self.device_id, frame_type, encode_frame.hex())
+            self.io_loop.create_task(self.save_frame(encode_frame, send=True))
+
     async def run_task(self):
-        now = datetime.datetime.now()
-        self.last_call_all_time_end = self.last_call_all_time_end or now
-        if self.last_call_all_time_end + self.coll_interval <= now:
-            self.last_call_all_time_begin = now
-            # 103 时钟同步命令
-            await self.send_frame(iec_104.init_frame(self.ssn, self.rsn, TYP.C_CS_NA_1, Cause.act))
-            # 100 总召唤
-            await self.send_frame(iec_104.init_frame(self.ssn, self.rsn, TYP.C_IC_NA_1, Cause.act))
-            # 101 电能量召唤
-            await self.send_frame(iec_104.init_frame(self.ssn, self.rsn, TYP.C_CI_NA_1, Cause.act))
-        if self.task_handler:
-            self.task_handler.cancel()
-        time_delta = self.last_call_all_time_end + self.coll_interval - now
-        self.task_handler = self.io_loop.call_later(
-                time_delta.seconds, lambda: self.io_loop.create_task(self.run_task()))
+        self.scheduler.add(self, 'station', self.scheduler.device_interval(self.device_info))
+        for name, interval in self.group_tasks.items():
+            self.scheduler.add(self, name, interval)
+
+    @staticmethod
+    def parse_groups(value, max_group):
+        """
+        :param value: term config like '1:60,2:3600', group number and its interval in seconds
+        :return: dict of group number -> interval
+        """
+        groups = dict()
+        for group_conf in (value or '').split(','):
+            if not group_conf.strip():
+                continue
+            try:
+                group, interval = group_conf.split(':')
+                group, interval = int(group), float(interval)
+                if not 1 <= group <= max_group or interval <= 0:
+                    raise ValueError(group_conf)
+                groups[group] = interval
+            except ValueError:
+                logger.warning('invalid group config: %s', group_conf)
+        return groups
+
+    async def load_groups(self):
+        """
+        collect interrogation groups (QOI 21~36) and counter groups (RQT 1~4) of all terms of this device,
+        the shortest interval wins when terms share a group
+        """
+        try:
+            with (await self.redis_pool) as redis_client:
+                term_list = await redis_client.smembers('SET:DEVICE_TERM:{}'.format(self.device_id))
+                pipe = redis_client.pipeline()
+                futures = [pipe.hmget('HS:TERM:{}'.format(term_id), 'interrogation_groups', 'counter_groups')
+                           for term_id in term_list]
+                await pipe.execute()
+            group_tasks = dict()
+            for fut in futures:
+                interrogation_groups, counter_groups = fut.result()
+                for prefix, groups in (('group', self.parse_groups(interrogation_groups, 16)),
+                                       ('counter', self.parse_groups(counter_groups, 4))):
+                    for group, interval in groups.items():
+                        name = '{}{}'.format(prefix, group)
+                        group_tasks[name] = min(interval, group_tasks.get(name, interval))
+            for name in set(self.group_tasks) - set(group_tasks):
+                self.scheduler.remove(self, name)
+            self.group_tasks = group_tasks
+            if self.started:
+                for name, interval in group_tasks.items():
+                    self.scheduler.add(self, name, interval)
+            logger.debug('device[%s] group tasks: %s', self.device_id, group_tasks)
+        except Exception as e:
+            logger.error('device[%s] load_groups failed: %s', self.device_id, repr(e), exc_info=True)
+
+    async def interrogate(self, name):
+        """
+        called by the scheduler when the task is due
+        :return: False if nothing was sent, the scheduler then releases the slot at once
+        """
+        if not self.started:
+            return False
+        if name.startswith('group'):
+            # 分组召唤, QOI=21~36
+            frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_IC_NA_1, Cause.act)
+            frame.ASDU.data[0].QOI = 20 + int(name[5:])
+            await self.send_frame(frame)
+            return True
+        if name.startswith('counter'):
+            # 计数量分组召唤, RQT=1~4
+            frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_CI_NA_1, Cause.act)
+            frame.ASDU.data[0].RQT = int(name[7:])
+            await self.send_frame(frame)
+            return True
+        self.last_call_all_time_begin = datetime.datetime.now()
+        # 103 时钟同步命令
+        frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_CS_NA_1, Cause.act)
+        frame.ASDU.data[0].CP56Time2a = self.last_call_all_time_begin
+        await self.send_frame(frame)
+        # 100 总召唤
+        frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_IC_NA_1, Cause.act)
+        frame.ASDU.data[0].QOI = 20
+        await self.send_frame(frame)
+        # 101 电能量召唤
+        frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_CI_NA_1, Cause.act)
+        frame.ASDU.data[0].RQT = 5
+        await self.send_frame(frame)
+        return True
+
+    def connect_stats(self):
+        return {'connected': self.connected, 'retry_count': self.connect_retry_count,
+                'backoff_delay': round(self.backoff.delay, 3), 'reconnecting': self.reconnect_handler is not None}
 
     def fresh_task(self, term_dict, term_item_dict, delete=False):
-        pass
+        if term_dict is not None:
+            self.io_loop.create_task(self.load_groups())
+
+    def fresh_bulk(self, term_list, term_item_list):
+        if term_list:
+            self.io_loop.create_task(self.load_groups())
 
     def prepare_call_frame(self, term_item_dict):
         frame = iec_104.init_frame(self.ssn, self.rsn, TYP.C_RD_NA_1, Cause.act)  # 102 读命令
@@ -351,3 +492,29 @@ class IEC104Device(BaseDevice):
         frame.ASDU.data[0].Value = value
         frame.ASDU.data[0].SE = 1
         return frame
+
+    def prepare_ctrl_frames(self, ctrl_list):
+        """
+        set-points of the same type are packed into multi-object ASDUs
+        when the device allows it by `max_command_objects` (default 1)
+        """
+        max_command_objects = int(self.device_info.get('max_command_objects') or 1)
+        frames = list()
+        typ_objects = OrderedDict()
+        for term_item_dict, value in ctrl_list:
+            typ = TYP(int(term_item_dict['code_type']))
+            if max_command_objects > 1 and typ in MULTI_OBJECT_TYPES:
+                typ_objects.setdefault(typ, list()).append((int(term_item_dict['protocol_code']), value))
+            else:
+                frames.append(self.prepare_ctrl_frame(term_item_dict, value))
+        for typ, objects in typ_objects.items():
+            chunk_size = min(max_command_objects, max_objects(typ))
+            for begin in range(0, len(objects), chunk_size):
+                chunk = objects[begin:begin + chunk_size]
+                frame = iec_104.init_frame(self.ssn, self.rsn, typ, Cause.act, SQ_COUNT=len(chunk))
+                for data, (address, value) in zip(frame.ASDU.data, chunk):
+                    data.Address = address
+                    data.Value = value
+                    data.SE = 1
+                frames.append(frame)
+        return frames
@@ -788,3 +788,21 @@ iec_104 = Struct(
 
 setattr(Struct, "init_frame", classmethod(init_frame))
 setattr(Struct, "build_isu", classmethod(build_isu))
+
+MAX_APDU_LENGTH = 255  # 启动字符1 + 长度1 + 控制域4 + ASDU最长249
+MAX_SQ_COUNT = 127
+# 允许一个ASDU中包含多个信息对象的命令类型(设定值命令), 还需设备支持, 见HS:DEVICE的max_command_objects
+MULTI_OBJECT_TYPES = (TYP.C_SE_NA_1, TYP.C_SE_NB_1, TYP.C_SE_NC_1, TYP.C_SE_TA_1, TYP.C_SE_TB_1, TYP.C_SE_TC_1)
+_object_size = dict()
+
+
+def max_objects(typ, sq=0):
+    """
+    :return: max count of information objects of type `typ` fit in one APDU
+    """
+    if (typ, sq) not in _object_size:
+        one = len(iec_104.build_isu(iec_104.init_frame(0, 0, typ, Cause.act, SQ_COUNT=1, SQ=sq)))
+        two = len(iec_104.build_isu(iec_104.init_frame(0, 0, typ, Cause.act, SQ_COUNT=2, SQ=sq)))
+        _object_size[(typ, sq)] = (one - (two - one), two - one)
+    head_size, object_size = _object_size[(typ, sq)]
+    return min(MAX_SQ_COUNT, (MAX_APDU_LENGTH - head_size) // object_size)
@@ -0,0 +1,160 @@
+import asyncio
+import datetime
+import heapq
+import time
+import weakref
+import zlib
+
+from pydatacoll.utils.rate_limit import TokenBucket
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('InterrogationScheduler')
+
+DEFAULT_INTERVAL = 15 * 60  # 默认召唤周期(秒)
+MAX_RUNNING = 20  # 同时进行中的召唤数上限
+RUN_TIME_OUT = 120  # 召唤在此时间内未结束则视为完成, 释放名额
+TICK = 1  # 调度精度(秒)
+
+
+class ScheduleEntry(object):
+    __slots__ = ('device', 'name', 'interval', 'phase', 'next_time', 'run_time', 'run_count')
+
+    def __init__(self, device, name, interval):
+        self.device = device
+        self.name = name
+        self.interval = interval
+        # 相位由设备id和任务名散列得到, 各设备的召唤均匀分布在周期内, 且进程重启后保持不变
+        self.phase = zlib.crc32('{}:{}'.format(device.device_id, name).encode()) % int(interval * 1000) / 1000
+        self.next_time = None
+        self.run_time = None  # 本次召唤开始时间, None表示未在进行
+        self.run_count = 0
+
+    def next_slot(self, now):
+        return now - (now - self.phase) % self.interval + self.interval
+
+    def info(self):
+        return {'device_id': self.device.device_id, 'name': self.name, 'interval': self.interval,
+                'phase': self.phase, 'run_count': self.run_count, 'running': self.run_time is not None,
+                'next_time': datetime.datetime.fromtimestamp(self.next_time).isoformat() if self.next_time else None}
+
+
+class InterrogationScheduler(object):
+    """
+    process-wide interrogation scheduler: every (device, task) runs at its own phase of the interval in wall clock
+    time, due tasks beyond MAX_RUNNING wait in FIFO order until a running one finishes or times out,
+    the device runs the task by `await device.interrogate(name)` and reports the end by `finish(device, name)`
+    """
+    _schedulers = weakref.WeakKeyDictionary()
+
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, max_running=MAX_RUNNING):
+        self.io_loop = io_loop
+        self.max_running = max_running
+        self.limiter = TokenBucket.of(io_loop, 'interrogation')
+        self.entries = dict()  # (device_id, name) -> ScheduleEntry
+        self.heap = list()  # (next_time, device_id, name)
+        self.ready = list()  # 已到期但等待名额的任务
+        self.running = set()
+        self.group_intervals = dict()  # 设备分组 -> 召唤周期(秒), 来自HS:INTERROGATION_GROUP
+        self.tick_handler = None
+
+    @classmethod
+    def of(cls, io_loop: asyncio.AbstractEventLoop):
+        scheduler = cls._schedulers.get(io_loop)
+        if scheduler is None:
+            scheduler = cls._schedulers[io_loop] = cls(io_loop)
+        return scheduler
+
+    def device_interval(self, device_info: dict):
+        """
+        :return: interrogation interval in seconds, device field `interrogation_interval` first,
+                 then interval of the device group `interrogation_group`, DEFAULT_INTERVAL at last
+        """
+        interval = device_info.get('interrogation_interval') or \
+            self.group_intervals.get(device_info.get('interrogation_group'))
+        return float(interval) if interval else DEFAULT_INTERVAL
+
+    def set_group_intervals(self, group_intervals: dict):
+        """
+        replace the group intervals, station interrogation of scheduled devices is rescheduled if its interval changes
+        """
+        if group_intervals == self.group_intervals:
+            return
+        self.group_intervals = dict(group_intervals)
+        for (_, name), entry in list(self.entries.items()):
+            if name == 'station':
+                self.add(entry.device, name, self.device_interval(entry.device.device_info))
+
+    def add(self, device, name, interval):
+        key = (device.device_id, name)
+        entry = self.entries.get(key)
+        if entry is not None and entry.interval == interval and entry.device is device:
+            return
+        self.remove(device, name)
+        entry = self.entries[key] = ScheduleEntry(device, name, interval)
+        entry.next_time = entry.next_slot(time.time())
+        heapq.heappush(self.heap, (entry.next_time, device.device_id, name))
+        if self.tick_handler is None:
+            self.tick_handler = self.io_loop.call_later(TICK, self.on_tick)
+
+    def remove(self, device, name=None):
+        keys = [(device.device_id, name)] if name is not None else \
+            [key for key in self.entries if key[0] == device.device_id]
+        for key in keys:
+            entry = self.entries.pop(key, None)
+            if entry is not None:
+                self.running.discard(key)
+        # 堆中残留的条目在到期时丢弃
+
+    def finish(self, device, name):
+        key = (device.device_id, name)
+        entry = self.entries.get(key)
+        if entry is not None and entry.device is device:
+            entry.run_time = None
+        if key in self.running:
+            self.running.discard(key)
+            self.io_loop.call_soon(self.on_tick, False)
+
+    def on_tick(self, periodic=True):
+        if periodic:
+            self.tick_handler = None
+        now = time.time()
+        for key in list(self.running):
+            entry = self.entries.get(key)
+            if entry is None or entry.run_time is None or now - entry.run_time >= RUN_TIME_OUT:
+                if entry is not None and entry.run_time is not None:
+                    logger.warning('device[%s] interrogation %s timeout', key[0], key[1])
+                    entry.run_time = None
+                self.running.discard(key)
+        while self.heap and self.heap[0][0] <= now:
+            next_time, device_id, name = heapq.heappop(self.heap)
+            entry = self.entries.get((device_id, name))
+            if entry is None or entry.next_time != next_time:
+                continue
+            if entry not in self.ready:
+                self.ready.append(entry)
+            entry.next_time = entry.next_slot(now)
+            heapq.heappush(self.heap, (entry.next_time, device_id, name))
+        while self.ready and len(self.running) < self.max_running:
+            entry = self.ready.pop(0)
+            key = (entry.device.device_id, entry.name)
+            if self.entries.get(key) is not entry or key in self.running:
+                continue
+            self.running.add(key)
+            entry.run_time = now
+            entry.run_count += 1
+            self.io_loop.create_task(self.run(entry))
+        if periodic and self.entries and self.tick_handler is None:
+            self.tick_handler = self.io_loop.call_later(TICK, self.on_tick)
+
+    async def run(self, entry: ScheduleEntry):
+        try:
+            await self.limiter.acquire()
+            if not await entry.device.interrogate(entry.name):
+                self.finish(entry.device, entry.name)
+        except Exception as e:
+            logger.error('device[%s] interrogation %s failed: %s', entry.device.device_id, entry.name, repr(e),
+                         exc_info=True)
+            self.finish(entry.device, entry.name)
+
+    def schedule_list(self):
+        return sorted((entry.info() for entry in self.entries.values()), key=lambda info: info['next_time'] or '')
@@ -10,8 +10,39 @@ REDIS_KEY = {
             # 可选（某些设备可以不填，下同）
             'ip': 'IP地址',
             'port': '端口',
+            'unix_socket': 'unix socket路径, 填写时代替ip和port连接',
             'identify': '唯一标识',
             'status': '在线状态：值=[on, off]',
+            'interrogation_interval': '召唤周期(秒), 不填则使用所属分组或默认周期',
+            'interrogation_group': '召唤分组, 周期见HS:INTERROGATION_GROUP',
+            'max_command_objects': '一个设定值命令帧中最多包含的信息对象数, 默认1',
+        },
+        "HS:CONNECT_STATS": {
+            # 由DeviceManager定期写入
+            'devices': '有连接的设备数',
+            'connected': '在线设备数',
+            'reconnecting': '等待重连的设备数',
+            'retry_total': '累计重连次数',
+            'connect': '建立连接令牌桶统计(json)',
+            'interrogation': '总召唤令牌桶统计(json)',
+            'time': '统计时间',
+        },
+        "HS:CONNECT_STATS:{shard}": {
+            # DeviceManager分片运行时(pydatacoll.launcher)每个分片写入, 字段同上, 过期时间3个统计周期
+        },
+        "HS:METRICS": {
+            # 每个进程定期写入, 见pydatacoll.utils.metrics
+            '{host}/{process}': '性能指标快照(json): time, families, reports',
+        },
+        "HS:INTERROGATION_GROUP": {
+            '{group}': '设备分组的召唤周期(秒), 设备通过interrogation_group字段指定分组, 修改后由DeviceManager定期重新读取',
+        },
+        "HS:INTERROGATION_SCHEDULE": {
+            # 由DeviceManager定期写入
+            '{device_id}:{name}': '召唤计划(json): device_id, name, interval, phase, next_time, running, run_count',
+        },
+        "HS:INTERROGATION_SCHEDULE:{shard}": {
+            # DeviceManager分片运行时每个分片写入, 字段同上
         },
         "HS:TERM:{term_id}": {
             # 必填
@@ -22,6 +53,8 @@ REDIS_KEY = {
             # 可选
             'address': '终端地址',
             'identify': '唯一标识',
+            'interrogation_groups': '分组召唤(QOI=21~36)配置, 格式: 组号:周期(秒),... 组号=1~16, eg: 1:60,2:3600',
+            'counter_groups': '计数量分组召唤(RQT=1~4)配置, 格式同上, 组号=1~4',
         },
         "HS:ITEM:{item_id}": {
             # 必填
@@ -45,6 +78,10 @@ REDIS_KEY = {
         "HS:MAPPING:{protocol_name}:{device_id}:{protocol_code}": {
             '同上',
         },
+        "HS:DEVICE_MAPPING:{device_id}": {
+            # 反向索引, 见pydatacoll.utils.key_index
+            '{term_id}:{item_id}': 'HS:MAPPING:{protocol_name}:{device_id}:{protocol_code}',
+        },
         "HS:DATA:{device_id}:{term_id}:{item_id}": {
             'datetime.isoformat()': 'value',  # eg: '2015-12-01T08:50:15.000002': 123.4
         },
@@ -81,6 +118,19 @@ REDIS_KEY = {
 
         "SET:FORMULA":
             '计算公式主键id列表, eg: [1,2,3]',
+
+        "SET:CONNECT_STATS_SHARD":
+            'DeviceManager分片运行时写过统计的分片, eg: [0,1,2]',
+
+        # 反向索引, 与配置在同一事务中写入, 删除时使用, 可用pydatacoll.utils.key_index重建
+        "SET:DEVICE_TERM_ITEM:{device_id}":
+            '设备的终端指标, eg: ["10:1000", "10:2000"]',
+
+        "SET:DEVICE_DATA:{device_id}":
+            '设备可能存在的HS:DATA及LST:DATA_TIME(含计算结果), eg: ["10:1000", "40:1000"]',
+
+        "SET:ITEM_TERM:{item_id}":
+            '用到该指标的设备及终端(含计算结果), eg: ["1:10", "3:40"]',
     },
 
     "list": {
@@ -104,9 +154,21 @@ REDIS_KEY = {
         "CHANNEL:TERM_ADD":
             '添加终端,消息内容: HS:TERM:{term_id}的值',
 
+        "CHANNEL:TERM_FRESH":
+            '更新终端,消息内容: HS:TERM:{term_id}的值',
+
         "CHANNEL:TERM_DEL":
             '删除终端,消息内容: {device_id:xxx, term_id:xxx}',
 
+        "CHANNEL:ITEM_ADD":
+            '添加指标,消息内容: HS:ITEM:{item_id}的值',
+
+        "CHANNEL:ITEM_FRESH":
+            '更新指标,消息内容: HS:ITEM:{item_id}的值',
+
+        "CHANNEL:ITEM_DEL":
+            '删除指标(及其终端指标),消息内容: item_id',
+
         "CHANNEL:TERM_ITEM_ADD":
             '终端指标关联,消息内容: HS:TERM_ITEM:{term_id}:{item_id}的值',
 
@@ -114,19 +176,34 @@ REDIS_KEY = {
             '终端指标解除关联,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx}',
 
         "CHANNEL:DEVICE_CALL":
-            '设备数据招测,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx}',
+            '设备数据招测,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx, request_id:xxx}',
+
+        "CHANNEL:DEVICE_CALL_BATCH":
+            '设备批量招测,消息内容: {device_id:xxx, items:[{term_id:xxx, item_id:xxx, request_id:xxx}, ...]},'
+            '每个指标的结果分别在CHANNEL:DEVICE_CALL:{device_id}:{term_id}:{item_id}返回',
 
         "CHANNEL:DEVICE_CTRL":
-            '设备控制,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx, value:xxx}',
+            '设备控制,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx, value:xxx, request_id:xxx}',
+
+        "CHANNEL:DEVICE_CTRL_BATCH":
+            '设备批量控制,消息内容: {device_id:xxx, items:[{term_id:xxx, item_id:xxx, value:xxx, request_id:xxx}, ...]},'
+            '每个指标的结果分别在CHANNEL:DEVICE_CTRL:{device_id}:{term_id}:{item_id}返回',
+
+        "CHANNEL:DEVICE_BULK":
+            '批量导入终端/终端指标, 每个设备一条, 消息内容: {device_id:xxx, terms:[HS:TERM的值], term_items:[HS:TERM_ITEM的值]}',
 
         "CHANNEL:DEVICE_CALL:{device_id}:{term_id}:{item_id}":
-            '招测返回,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx, time:xxx, value:xxx}',
+            '招测返回,消息内容: {device_id:xxx, term_id:xxx, item_id:xxx, time:xxx, value:xxx, request_ids:[xxx]},'
+            '失败时: {device_id:xxx, term_id:xxx, item_id:xxx, request_ids:[xxx], err_msg:xxx}',
 
         "CHANNEL:DEVICE_CTRL:{device_id}:{term_id}:{item_id}":
             '控制返回,消息内容: 同上',
 
         "CHANNEL:DEVICE_DATA:{device_id}:{term_id}:{item_id}":
-            '采集数据,消息内容: 同上',
+            '采集数据,消息内容: 同上, 没有外部订阅者时暂停发布(定期试探), 内部订阅者使用CHANNEL:DEVICE_DATA_BIN',
+
+        "CHANNEL:DEVICE_DATA_BIN:{device_id}":
+            '采集数据的二进制批次,格式及订阅规则见pydatacoll.utils.codec',
 
         "CHANNEL:WARNING:{device_id}:{term_id}:{item_id}":
             '报警数据,消息内容: 同上+{warn_msg:xxx}',
@@ -141,9 +218,9 @@ REDIS_KEY = {
             '删除计算公式,消息内容: formula_id',
 
         "CHANNEL:FORMULA_CHECK":
-            "计算公式校验,消息内容: {'formula': xxx, 'p0':xxx, ...}",
+            "计算公式校验,消息内容: {'formula': xxx, 'p0':xxx, ..., 'request_id': xxx}",
 
-        "CHANNEL:FORMULA_CHECK_RESULT:{formula_length}":
-            "计算公式校验结果,消息内容: {'rst': xxx, 'err_msg':xxx}"
+        "CHANNEL:FORMULA_CHECK_RESULT:{request_id}":
+            "计算公式校验结果,消息内容: {'rst': xxx, 'request_ids': [xxx]}"
     }
 }
@@ -0,0 +1,76 @@
+"""
+redis连接的创建入口, 所有组件通过这里取得连接池和同步客户端
+
+地址由环境变量PYDATACOLL_REDIS或configure()指定:
+    redis://localhost:6379/1    redis服务器及db(默认)
+    memory://                   进程内存储(mem_redis), 用于测试、性能测试及单进程部署, 同一名字共享同一份数据
+    memory://name
+"""
+import asyncio
+import os
+from urllib.parse import urlparse
+
+import pydatacoll.utils.logger as my_logger
+from pydatacoll.utils.mem_redis import MemoryStore, MemoryPool, MemorySyncClient
+
+logger = my_logger.get_logger('Backend')
+
+DEFAULT_URL = 'redis://localhost:6379/1'
+_url = os.environ.get('PYDATACOLL_REDIS', DEFAULT_URL)
+_memory_stores = dict()  # name -> MemoryStore
+
+
+def configure(url):
+    global _url
+    _url = url
+    logger.info('redis backend: %s', url)
+
+
+def current_url():
+    return _url
+
+
+def is_memory():
+    return urlparse(_url).scheme == 'memory'
+
+
+def memory_store(name=None):
+    """
+    :return: the MemoryStore shared by everything configured with memory://name in this process
+    """
+    if name is None:
+        name = urlparse(_url).netloc
+    store = _memory_stores.get(name)
+    if store is None:
+        store = _memory_stores[name] = MemoryStore()
+    return store
+
+
+def _redis_address():
+    url = urlparse(_url)
+    db = int(url.path.strip('/') or 0)
+    return url.hostname or 'localhost', url.port or 6379, db
+
+
+async def create_pool(io_loop: asyncio.AbstractEventLoop = None, minsize=5, maxsize=10):
+    """
+    :return: aioredis pool decoding responses with utf-8, or its in-process equivalent
+    """
+    io_loop = io_loop or asyncio.get_event_loop()
+    if is_memory():
+        return MemoryPool(memory_store(), io_loop, minsize=minsize, maxsize=maxsize)
+    import aioredis
+    host, port, db = _redis_address()
+    return await aioredis.create_pool((host, port), db=db, minsize=minsize, maxsize=maxsize,
+                                      encoding='utf-8', loop=io_loop)
+
+
+def sync_client():
+    """
+    :return: redis.StrictRedis decoding responses, or its in-process equivalent
+    """
+    if is_memory():
+        return MemorySyncClient(memory_store())
+    import redis
+    host, port, db = _redis_address()
+    return redis.StrictRedis(host=host, port=port, db=db, decode_responses=True)
@@ -0,0 +1,259 @@
+"""
+设备/终端/指标/终端指标的批量导入导出
+
+导入内容为JSON数组或NDJSON(每行一个对象), 先整体校验(必填字段, 重复, 已存在, 引用是否存在),
+有任何错误则不写入; 校验通过后按CHUNK_SIZE条一个事务写入, 并为每个受影响的设备只发布一条变更消息:
+    devices         每个设备一条CHANNEL:DEVICE_ADD(与单个创建相同)
+    terms           每个设备一条CHANNEL:DEVICE_BULK, {device_id:xxx, terms:[...], term_items:[]}
+    term_items      每个设备一条CHANNEL:DEVICE_BULK, {device_id:xxx, terms:[], term_items:[...]}
+    items           每个指标一条CHANNEL:ITEM_ADD(与单个创建相同)
+"""
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from pydatacoll.resources.protocol import DEVICE_PROTOCOLS
+from pydatacoll.utils import key_index
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('BulkConfig')
+
+CHUNK_SIZE = 1000  # 每个事务/pipeline包含的记录数
+MAX_ERRORS = 100  # 最多返回的错误数
+
+# kind -> 变更消息通道
+CHANNELS = {
+    'devices': 'CHANNEL:DEVICE_ADD',
+    'terms': 'CHANNEL:DEVICE_BULK',
+    'items': 'CHANNEL:ITEM_ADD',
+    'term_items': 'CHANNEL:DEVICE_BULK',
+}
+
+# kind -> (主键格式, 主键列表, 必填字段)
+KINDS = OrderedDict([
+    ('devices', ('HS:DEVICE:{id}', 'SET:DEVICE', ('id', 'name', 'protocol'))),
+    ('terms', ('HS:TERM:{id}', 'SET:TERM', ('id', 'name', 'device_id', 'protocol'))),
+    ('items', ('HS:ITEM:{id}', 'SET:ITEM', ('id', 'name'))),
+    ('term_items', ('HS:TERM_ITEM:{term_id}:{item_id}', None, ('term_id', 'item_id', 'protocol_code'))),
+])
+
+
+class BulkError(Exception):
+    def __init__(self, errors, status=400):
+        super().__init__('{} errors'.format(len(errors)))
+        self.errors = errors[:MAX_ERRORS]
+        self.status = status
+
+
+def _chunks(lst, size=CHUNK_SIZE):
+    for idx in range(0, len(lst), size):
+        yield lst[idx:idx + size]
+
+
+def parse_records(text: str):
+    """
+    :param text: JSON array or NDJSON
+    :return: list of (record number, dict), raise BulkError
+    """
+    errors = list()
+    if text.lstrip().startswith('['):
+        try:
+            records = list(enumerate(json.loads(text), 1))
+        except ValueError as e:
+            raise BulkError([{'record': 0, 'error': 'invalid json: {}'.format(e)}])
+    else:
+        records = list()
+        for line_no, line in enumerate(text.splitlines(), 1):
+            if not line.strip():
+                continue
+            try:
+                records.append((line_no, json.loads(line)))
+            except ValueError as e:
+                errors.append({'record': line_no, 'error': 'invalid json: {}'.format(e)})
+    for no, record in records:
+        if not isinstance(record, dict):
+            errors.append({'record': no, 'error': 'record must be an object'})
+        elif any(not isinstance(value, (str, int, float)) or isinstance(value, bool) for value in record.values()):
+            errors.append({'record': no, 'error': 'values must be strings or numbers'})
+    if errors:
+        raise BulkError(errors)
+    if not records:
+        raise BulkError([{'record': 0, 'error': 'no record found'}])
+    return records
+
+
+async def _exists(redis_client, keys):
+    """
+    :return: list of bool, checked with pipelined EXISTS
+    """
+    rst = list()
+    for chunk in _chunks(keys):
+        pipe = redis_client.pipeline()
+        futures = [pipe.exists(key) for key in chunk]
+        await pipe.execute()
+        rst.extend([bool(await fut) for fut in futures])
+    return rst
+
+
+async def _hget_all(redis_client, keys, field):
+    rst = list()
+    for chunk in _chunks(keys):
+        pipe = redis_client.pipeline()
+        futures = [pipe.hget(key, field) for key in chunk]
+        await pipe.execute()
+        rst.extend([await fut for fut in futures])
+    return rst
+
+
+async def _missing(redis_client, key_format, ids):
+    ids = sorted(set(ids))
+    return {ids[idx] for idx, found in enumerate(await _exists(redis_client, [key_format.format(i) for i in ids]))
+            if not found}
+
+
+async def validate(redis_client, kind, records):
+    """
+    check everything before writing
+    :param records: list of (record number, dict), values of term_items get `device_id` filled in
+    :return: context needed by write(), raise BulkError
+    """
+    key_format, _, required = KINDS[kind]
+    errors = list()
+    conflicts = list()
+    seen = dict()
+    for no, record in records:
+        missing = [field for field in required if str(record.get(field, '')) == '']
+        if missing:
+            errors.append({'record': no, 'error': 'missing fields: {}'.format(', '.join(missing))})
+            continue
+        key = key_format.format(**record)
+        if key in seen:
+            errors.append({'record': no, 'error': 'duplicate of record {}'.format(seen[key])})
+        seen[key] = no
+        if kind == 'devices' and record['protocol'] not in DEVICE_PROTOCOLS:
+            errors.append({'record': no, 'error': 'unknown protocol: {}'.format(record['protocol'])})
+    if errors:
+        raise BulkError(errors)
+    for (no, record), found in zip(records, await _exists(redis_client, list(seen))):
+        if found:
+            conflicts.append({'record': no, 'error': '{} already exists'.format(key_format.format(**record))})
+
+    context = dict()
+    if kind == 'terms':
+        missing = await _missing(redis_client, 'HS:DEVICE:{}', [str(r['device_id']) for _, r in records])
+        errors.extend({'record': no, 'error': 'device_id not found: {}'.format(r['device_id'])}
+                      for no, r in records if str(r['device_id']) in missing)
+    elif kind == 'term_items':
+        missing = await _missing(redis_client, 'HS:ITEM:{}', [str(r['item_id']) for _, r in records])
+        errors.extend({'record': no, 'error': 'item_id not found: {}'.format(r['item_id'])}
+                      for no, r in records if str(r['item_id']) in missing)
+        term_ids = sorted({str(r['term_id']) for _, r in records})
+        term_device = dict(zip(term_ids, await _hget_all(
+            redis_client, ['HS:TERM:{}'.format(term_id) for term_id in term_ids], 'device_id')))
+        device_ids = sorted({device_id for device_id in term_device.values() if device_id})
+        device_protocol = dict(zip(device_ids, await _hget_all(
+            redis_client, ['HS:DEVICE:{}'.format(device_id) for device_id in device_ids], 'protocol')))
+        codes = dict()
+        for no, record in records:
+            device_id = term_device[str(record['term_id'])]
+            if not device_id or not device_protocol.get(device_id):
+                errors.append({'record': no, 'error': 'term_id not found: {}'.format(record['term_id'])})
+                continue
+            record['device_id'] = device_id
+            code_key = (device_id, str(record['protocol_code']))
+            if code_key in codes:
+                errors.append({'record': no, 'error': 'protocol_code {} of device {} used by record {}'.format(
+                    record['protocol_code'], device_id, codes[code_key])})
+            codes[code_key] = no
+        mapping_keys = OrderedDict(('HS:MAPPING:{}:{}:{}'.format(device_protocol[device_id].upper(), device_id, code),
+                                    no) for (device_id, code), no in codes.items())
+        for (key, no), found in zip(mapping_keys.items(), await _exists(redis_client, list(mapping_keys))):
+            if found:
+                conflicts.append({'record': no, 'error': '{} already exists'.format(key)})
+        context['device_protocol'] = device_protocol
+    if errors:
+        raise BulkError(errors)
+    if conflicts:
+        raise BulkError(conflicts, status=409)
+    return context
+
+
+async def write(redis_client, kind, records, context):
+    """
+    :return: dict for the consolidated events, device_id -> changed terms/term_items, or id -> created device/item
+    """
+    key_format, id_set, _ = KINDS[kind]
+    changes = OrderedDict()
+    for chunk in _chunks([record for _, record in records]):
+        tr = redis_client.multi_exec()
+        index = key_index.IndexCollector()  # 集合按key合并成一条SADD
+        for record in chunk:
+            pairs = [value for pair in record.items() for value in pair]
+            tr.hmset(key_format.format(**record), *pairs)
+            if id_set is not None:
+                index.sadd(id_set, record['id'])
+            if kind == 'terms':
+                index.sadd('SET:DEVICE_TERM:{}'.format(record['device_id']), record['id'])
+                changes.setdefault(str(record['device_id']), {'terms': [], 'term_items': []})['terms'].append(record)
+            elif kind == 'term_items':
+                device_id = record['device_id']
+                mapping_key = 'HS:MAPPING:{}:{}:{}'.format(
+                    context['device_protocol'][device_id].upper(), device_id, record['protocol_code'])
+                tr.hmset(mapping_key, *pairs)
+                index.sadd('SET:TERM_ITEM:{}'.format(record['term_id']), record['item_id'])
+                key_index.add_term_item(index, device_id, record['term_id'], record['item_id'], mapping_key)
+                changes.setdefault(device_id, {'terms': [], 'term_items': []})['term_items'].append(record)
+            else:
+                changes[str(record['id'])] = record
+        index.flush(tr)
+        await tr.execute()
+    return changes
+
+
+async def publish(redis_client, kind, changes):
+    for key, change in changes.items():
+        if kind in ('devices', 'items'):
+            await redis_client.publish(CHANNELS[kind], json.dumps(change))
+        else:
+            await redis_client.publish(CHANNELS[kind], json.dumps(dict(change, device_id=key)))
+
+
+async def import_records(redis_client, kind, text):
+    """
+    :return: result dict, raise BulkError
+    """
+    records = parse_records(text)
+    context = await validate(redis_client, kind, records)
+    changes = await write(redis_client, kind, records, context)
+    await publish(redis_client, kind, changes)
+    logger.info('bulk import %s: %s records, %s events', kind, len(records), len(changes))
+    return {'kind': kind, 'created': len(records), 'devices': len(changes) if kind != 'items' else 0}
+
+
+async def export_keys(redis_client, kind):
+    key_format, id_set, _ = KINDS[kind]
+    if id_set is not None:
+        return [key_format.format(id=i) for i in sorted(await redis_client.smembers(id_set))]
+    keys = list()
+    for term_id in sorted(await redis_client.smembers('SET:TERM')):
+        keys.extend(key_format.format(term_id=term_id, item_id=item_id)
+                    for item_id in sorted(await redis_client.smembers('SET:TERM_ITEM:{}'.format(term_id))))
+    return keys
+
+
+async def export_records(redis_client, kind):
+    """
+    :return: list of dict, read by pipelined HGETALL
+    """
+    records = list()
+    for chunk in _chunks(await export_keys(redis_client, kind)):
+        pipe = redis_client.pipeline()
+        futures = [pipe.hgetall(key) for key in chunk]
+        await pipe.execute()
+        for fut in futures:
+            record = await fut
+            if record:
+                records.append(record)
+    return records
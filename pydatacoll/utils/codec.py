@@ -0,0 +1,223 @@
+"""
+采集数据在内部通道上的二进制编码
+
+CHANNEL:DEVICE_DATA_BIN:{device_id} 每条消息是同一设备的一批数据:
+    头部  magic(2s)=b'PD', version(B), device_id(I), count(H)
+    记录  term_id(I), item_id(I), time(q, 1970-01-01起的微秒数, 与isoformat使用同一本地时钟), value(d), is_int(B)
+id需为整数, value需为int或float(int的绝对值不超过2**53, 解码后仍为int); 无法编码的批次只发JSON
+
+协商规则:
+    内部订阅者同时psubscribe CHANNEL:DEVICE_DATA_BIN:* 和 CHANNEL:DEVICE_DATA:*, 用DuplicateFilter去重:
+    同一个点(指标及时间相同)在DEDUP_WINDOW秒内既从二进制批次又从JSON收到时, 只处理先到的一份;
+    其他JSON(只发JSON的批次, 外部发布的数据)照常处理
+    发布者先发二进制批次, 再按点发JSON; JSON的接收数减去二进制的接收数即外部JSON订阅者数,
+    没有外部订阅者的JSON通道暂停发布, 每JSON_PROBE_INTERVAL秒重新试探一次
+
+历史数据查询的二进制格式(application/x-pydatacoll-series), 一个指标按时间排序的数据, 按列存放:
+    头部  magic(2s)=b'PS', version(B), count(I)
+    时间  count个q, 1970-01-01起的微秒数
+    数值  count个d
+"""
+import datetime
+import struct
+import time
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('DataCodec')
+
+DATA_PATTERN = 'CHANNEL:DEVICE_DATA:*'
+DATA_CHANNEL = 'CHANNEL:DEVICE_DATA:{}:{}:{}'
+BIN_PATTERN = 'CHANNEL:DEVICE_DATA_BIN:*'
+BIN_CHANNEL = 'CHANNEL:DEVICE_DATA_BIN:{}'
+JSON_PROBE_INTERVAL = 5  # 无外部订阅者的JSON通道重新试探的间隔(秒)
+DEDUP_WINDOW = 5  # 同一个点的二进制和JSON两份在此时间(秒)内到达才视为副本
+DEDUP_MAX = 100000  # DuplicateFilter最多记住的点数
+
+MAGIC = b'PD'
+VERSION = 2
+SERIES_VERSION = 1
+HEADER = struct.Struct('<2sBIH')
+RECORD = struct.Struct('<IIqdB')
+MAX_BATCH = 0xffff  # count字段的上限
+MAX_INT = 2 ** 53  # float64能精确表示的整数上限
+SERIES_MAGIC = b'PS'
+SERIES_HEADER = struct.Struct('<2sBI')
+EPOCH = datetime.datetime(1970, 1, 1)
+ONE_US = datetime.timedelta(microseconds=1)
+
+
+def encode_batch(device_id, points):
+    """
+    :param device_id: int or numeric str
+    :param points: list of (term_id, item_id, data_time: naive datetime, value: int or float)
+    :return: bytes, raise ValueError if ids are not integers, a value is of other types or too many points
+    """
+    if len(points) > MAX_BATCH:
+        raise ValueError('batch too large: {}'.format(len(points)))
+    try:
+        return HEADER.pack(MAGIC, VERSION, int(device_id), len(points)) + b''.join(
+            RECORD.pack(int(term_id), int(item_id), (data_time - EPOCH) // ONE_US, value, _is_int(value))
+            for term_id, item_id, data_time, value in points)
+    except (TypeError, struct.error) as e:
+        raise ValueError('can not encode batch of device[{}]: {}'.format(device_id, e))
+
+
+def _is_int(value):
+    """
+    :return: 1 for int, 0 for float, raise TypeError for other types, they keep their type only in JSON
+    """
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError('value {!r} is not int or float'.format(value))
+    if isinstance(value, int):
+        if abs(value) > MAX_INT:
+            raise TypeError('int value {} is too large'.format(value))
+        return 1
+    return 0
+
+
+def decode_batch(data: bytes):
+    """
+    :return: (device_id: str, list of (term_id: str, item_id: str, data_time: datetime, value: int or float))
+    """
+    magic, version, device_id, count = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise ValueError('unknown batch header: {}, version={}'.format(magic, version))
+    if len(data) != HEADER.size + count * RECORD.size:
+        raise ValueError('batch length mismatch: {} points in {} bytes'.format(count, len(data)))
+    return str(device_id), [(str(term_id), str(item_id), EPOCH + us * ONE_US, int(value) if is_int else value)
+                            for term_id, item_id, us, value, is_int in RECORD.iter_unpack(data[HEADER.size:])]
+
+
+def to_message(device_id, point):
+    """
+    :return: (channel: bytes, data_dict) the same as a JSON message on CHANNEL:DEVICE_DATA
+    """
+    term_id, item_id, data_time, value = point
+    return DATA_CHANNEL.format(device_id, term_id, item_id).encode(), {
+        'device_id': device_id, 'term_id': term_id, 'item_id': item_id,
+        'time': data_time.isoformat(), 'value': value}
+
+
+def parse_time(text):
+    """
+    :param text: datetime.isoformat() of a naive datetime, eg: '2015-12-01T08:50:15.000002'
+    :return: microseconds since EPOCH
+    """
+    try:
+        # 按字符串比较时间, 分隔符不同(如空格代替T)的时间不能与isoformat比较
+        if text[4] + text[7] + text[10] + text[13] + text[16] != '--T::' or len(text) > 19 and text[19] != '.':
+            raise ValueError('not isoformat')
+        data_time = datetime.datetime(int(text[0:4]), int(text[5:7]), int(text[8:10]), int(text[11:13]),
+                                      int(text[14:16]), int(text[17:19]), int(text[20:26].ljust(6, '0')))
+    except (TypeError, ValueError, IndexError) as e:
+        raise ValueError('invalid time: {}, {}'.format(text, e))
+    return (data_time - EPOCH) // ONE_US
+
+
+def sorted_series(data_dict):
+    """
+    :param data_dict: value of HS:DATA, isoformat time -> value
+    :return: (list of time str, list of float) sorted by time
+    """
+    times = sorted(data_dict)  # 同一格式的isoformat按字符串排序即按时间排序
+    return times, [float(data_dict[data_time]) for data_time in times]
+
+
+def encode_series(times, values):
+    """
+    :param times: list of isoformat time str
+    :param values: list of float
+    :return: bytes
+    """
+    count = len(times)
+    return SERIES_HEADER.pack(SERIES_MAGIC, SERIES_VERSION, count) + \
+        struct.pack('<{}q'.format(count), *[parse_time(data_time) for data_time in times]) + \
+        struct.pack('<{}d'.format(count), *values)
+
+
+def decode_series(data: bytes):
+    """
+    :return: (list of datetime, list of float)
+    """
+    magic, version, count = SERIES_HEADER.unpack_from(data)
+    if magic != SERIES_MAGIC or version != SERIES_VERSION:
+        raise ValueError('unknown series header: {}, version={}'.format(magic, version))
+    if len(data) != SERIES_HEADER.size + count * 16:
+        raise ValueError('series length mismatch: {} points in {} bytes'.format(count, len(data)))
+    times = struct.unpack_from('<{}q'.format(count), data, SERIES_HEADER.size)
+    values = struct.unpack_from('<{}d'.format(count), data, SERIES_HEADER.size + count * 8)
+    return [EPOCH + us * ONE_US for us in times], list(values)
+
+
+class DataPublisher(object):
+    """
+    publish points of one device as a binary batch, and as JSON per point while someone outside listens
+    """
+    def __init__(self, probe_interval=JSON_PROBE_INTERVAL):
+        self.probe_interval = probe_interval
+        self.json_idle = dict()  # JSON channel -> 在此时间(monotonic)之前不发布
+
+    async def publish(self, redis_client, device_id, points):
+        """
+        :param points: list of (term_id, item_id, data_time: datetime, value)
+        :return: None
+        """
+        if not points:
+            return
+        bin_receivers = 0
+        try:
+            bin_receivers = await redis_client.publish(BIN_CHANNEL.format(device_id), encode_batch(device_id, points))
+            now = time.monotonic()
+        except ValueError as e:
+            logger.warning('publish binary failed, fallback to JSON: %s', repr(e))
+            now = None
+        for term_id, item_id, data_time, value in points:
+            channel = DATA_CHANNEL.format(device_id, term_id, item_id)
+            if now is not None and self.json_idle.get(channel, 0) > now:
+                continue
+            rst = await redis_client.publish(channel, json.dumps({
+                'device_id': device_id, 'term_id': term_id, 'item_id': item_id,
+                'time': data_time.isoformat(), 'value': value}))
+            if now is None or rst > bin_receivers:
+                self.json_idle.pop(channel, None)
+            else:
+                self.json_idle[channel] = now + self.probe_interval
+
+
+class DuplicateFilter(object):
+    """
+    subscribers of both CHANNEL:DEVICE_DATA_BIN:* and CHANNEL:DEVICE_DATA:* receive a point twice while someone
+    outside listens to JSON, keep the copy arriving first and drop the other one, whichever encoding it is.
+    a point is forgotten after window seconds or when more than max_points are remembered
+    """
+    def __init__(self, window=DEDUP_WINDOW, max_points=DEDUP_MAX):
+        self.window = window
+        self.max_points = max_points
+        self.recent = OrderedDict()  # (key, time) -> (到期时间(monotonic), 是否来自二进制批次), 先到期的在前
+
+    def first(self, key, data_time, binary):
+        """
+        :param key: channel or `device_id:term_id:item_id` of the point, the same for both encodings
+        :param data_time: isoformat time of the point
+        :param binary: whether the point comes from a binary batch
+        :return: False if the other encoding of the point has been received
+        """
+        now = time.monotonic()
+        recent = self.recent
+        while recent:
+            expire, _ = recent[next(iter(recent))]
+            if expire > now and len(recent) < self.max_points:
+                break
+            recent.popitem(last=False)
+        point = (key, data_time)
+        seen = recent.pop(point, None)
+        if seen is not None and seen[1] != binary:
+            return False
+        recent[point] = (now + self.window, binary)
+        return True
@@ -0,0 +1,52 @@
+"""
+HTTP响应体压缩, 按请求的Accept-Encoding协商gzip或deflate
+
+小于MIN_SIZE的响应体不压缩; 不小于OFFLOAD_SIZE的在线程池中压缩(zlib压缩时释放GIL), 不占用事件循环
+"""
+import asyncio
+import gzip
+import zlib
+from collections import OrderedDict
+
+MIN_SIZE = 1024
+OFFLOAD_SIZE = 64 * 1024
+LEVEL = 6
+
+# 编码名 -> 压缩函数, q值相同时靠前的优先
+ENCODINGS = OrderedDict([
+    ('gzip', lambda body: gzip.compress(body, LEVEL)),
+    ('deflate', lambda body: zlib.compress(body, LEVEL)),
+])
+
+
+def negotiate(accept_encoding):
+    """
+    :param accept_encoding: value of Accept-Encoding header, eg: `gzip;q=0.8, deflate, br`
+    :return: 'gzip', 'deflate' or None
+    """
+    if not accept_encoding:
+        return None
+    weights = dict()
+    for part in accept_encoding.split(','):
+        name, *params = [value.strip() for value in part.split(';')]
+        weight = 1.0
+        for param in params:
+            if param.startswith('q='):
+                try:
+                    weight = float(param[2:])
+                except ValueError:
+                    weight = 0.0
+        weights[name.lower()] = weight
+    best, best_weight = None, 0.0
+    for name in ENCODINGS:
+        weight = weights.get(name, weights.get('*', 0.0))
+        if weight > best_weight:
+            best, best_weight = name, weight
+    return best
+
+
+async def compress(io_loop: asyncio.AbstractEventLoop, body: bytes, encoding):
+    func = ENCODINGS[encoding]
+    if len(body) >= OFFLOAD_SIZE:
+        return await io_loop.run_in_executor(None, func, body)
+    return func(body)
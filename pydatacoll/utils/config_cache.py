@@ -0,0 +1,158 @@
+"""
+API服务器的配置缓存
+
+设备/终端/指标/终端指标/计算公式的查询结果按redis key缓存序列化后的响应体及其ETag,
+订阅配置变更通道, 收到消息时删除受影响的缓存(INVALIDATE); API服务器自己修改配置后也立即删除, 不等待消息返回.
+订阅断开期间不缓存; 加载过程中收到变更消息时, 加载结果不放入缓存.
+"""
+import asyncio
+import hashlib
+from collections import OrderedDict, namedtuple
+try:
+    import ujson as json
+except ImportError:
+    import json
+import aioredis
+
+from pydatacoll.utils import metrics
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('ConfigCache')
+
+MAX_ENTRIES = 10000
+LOOKUPS = metrics.counter('pydatacoll_config_cache_lookups_total', 'config cache lookups by result', ('result',))
+
+# 变更通道 -> 需要删除的缓存key前缀
+INVALIDATE = OrderedDict([
+    ('CHANNEL:DEVICE_ADD', ('HS:DEVICE:', 'SET:DEVICE')),
+    ('CHANNEL:DEVICE_FRESH', ('HS:DEVICE:',)),
+    ('CHANNEL:DEVICE_DEL', ('HS:DEVICE:', 'SET:DEVICE', 'HS:TERM:', 'SET:TERM', 'HS:TERM_ITEM:')),
+    ('CHANNEL:DEVICE_BULK', ('HS:TERM:', 'SET:TERM', 'SET:DEVICE_TERM:', 'HS:TERM_ITEM:')),
+    ('CHANNEL:TERM_ADD', ('HS:TERM:', 'SET:TERM', 'SET:DEVICE_TERM:')),
+    ('CHANNEL:TERM_FRESH', ('HS:TERM:', 'SET:DEVICE_TERM:')),
+    ('CHANNEL:TERM_DEL', ('HS:TERM:', 'SET:TERM', 'SET:DEVICE_TERM:', 'HS:TERM_ITEM:')),
+    ('CHANNEL:TERM_ITEM_ADD', ('HS:TERM_ITEM:', 'SET:TERM_ITEM:')),
+    ('CHANNEL:TERM_ITEM_DEL', ('HS:TERM_ITEM:', 'SET:TERM_ITEM:')),
+    ('CHANNEL:ITEM_ADD', ('HS:ITEM:', 'SET:ITEM')),
+    ('CHANNEL:ITEM_FRESH', ('HS:ITEM:',)),
+    ('CHANNEL:ITEM_DEL', ('HS:ITEM:', 'SET:ITEM', 'HS:TERM_ITEM:', 'SET:TERM_ITEM:')),
+    ('CHANNEL:FORMULA_ADD', ('HS:FORMULA:', 'SET:FORMULA')),
+    ('CHANNEL:FORMULA_FRESH', ('HS:FORMULA:',)),
+    ('CHANNEL:FORMULA_DEL', ('HS:FORMULA:', 'SET:FORMULA')),
+])
+
+# status=200时body为JSON, 否则为错误信息; encoded: 压缩编码 -> 压缩后的body, 随条目一起淘汰
+CacheEntry = namedtuple('CacheEntry', 'status body etag encoded')
+
+
+def make_etag(body: str):
+    return '"{}"'.format(hashlib.sha1(body.encode('utf-8')).hexdigest())
+
+
+def etag_matches(if_none_match, etag):
+    """
+    :param if_none_match: value of If-None-Match header, eg: `"abc", W/"def"` or `*`
+    """
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(','):
+        tag = tag.strip()
+        if tag == '*' or tag == etag or tag.startswith('W/') and tag[2:] == etag:
+            return True
+    return False
+
+
+def sort_ids(id_list):
+    """
+    members of a SET in a stable order (numeric ids by value), so the ETag of a list does not change with SMEMBERS order
+    """
+    return sorted(id_list, key=lambda value: (len(value), value))
+
+
+class ConfigCache(object):
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, redis_pool: aioredis.RedisPool, max_entries=MAX_ENTRIES):
+        self.io_loop = io_loop
+        self.redis_pool = redis_pool
+        self.max_entries = max_entries
+        self.entries = OrderedDict()  # redis key -> CacheEntry, 按LRU淘汰
+        self.generation = 0  # 每次失效加1
+        self.sub_client = None
+        self.hits = 0
+        self.misses = 0
+        self._hit_metric = LOOKUPS.labels('hit')
+        self._miss_metric = LOOKUPS.labels('miss')
+
+    @property
+    def active(self):
+        return self.sub_client is not None
+
+    async def start(self):
+        if self.sub_client is not None:
+            return
+        try:
+            self.sub_client = await self.redis_pool.acquire()
+            channels = await self.sub_client.subscribe(*INVALIDATE)
+            for channel in channels:
+                self.io_loop.create_task(self._msg_reader(channel))
+            logger.info('config cache started')
+        except Exception as e:
+            self.sub_client = None
+            logger.error('config cache start failed, caching disabled: %s', repr(e), exc_info=True)
+
+    async def stop(self):
+        if self.sub_client is not None:
+            sub_client, self.sub_client = self.sub_client, None
+            await sub_client.unsubscribe(*INVALIDATE)
+            self.redis_pool.release(sub_client)
+        self.clear()
+
+    def clear(self):
+        self.generation += 1
+        self.entries.clear()
+
+    def invalidate(self, channel):
+        prefixes = INVALIDATE.get(channel)
+        if not prefixes:
+            return
+        self.generation += 1
+        for key in [key for key in self.entries if key.startswith(prefixes)]:
+            del self.entries[key]
+
+    async def get(self, key, loader):
+        """
+        :param loader: coroutine function returning (status, data), data is dumped to JSON when status is 200
+        :return: CacheEntry
+        """
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.hits += 1
+            self._hit_metric.inc()
+            self.entries.move_to_end(key)
+            return entry
+        self.misses += 1
+        self._miss_metric.inc()
+        generation = self.generation
+        status, data = await loader()
+        if status == 200:
+            body = json.dumps(data, ensure_ascii=False)
+            entry = CacheEntry(status, body, make_etag(body), dict())
+        else:
+            entry = CacheEntry(status, data, None, None)
+        if self.active and generation == self.generation:
+            self.entries[key] = entry
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        return entry
+
+    async def _msg_reader(self, ch):
+        while await ch.wait_message():
+            try:
+                await ch.get()
+                self.invalidate(ch.name.decode())
+            except Exception as e:
+                logger.error('config cache invalidate failed: %s', repr(e), exc_info=True)
+        # 订阅断开后无法得知变更, 停止缓存
+        if self.sub_client is not None:
+            logger.warning('config cache subscription closed, caching disabled')
+            self.sub_client = None
+        self.clear()
@@ -0,0 +1,145 @@
+"""
+历史数据的流式导出
+
+按指标顺序导出, 每个指标内按时间顺序, 时间范围为[start, end). LST:DATA_TIME是按时间追加的, 先用LINDEX二分查找起点,
+再每次LRANGE读CHUNK_SIZE个时间并HMGET对应的HS:DATA, 写出一段后等待客户端接收(drain), 内存占用与范围大小无关.
+每段重新从连接池取连接, 长时间的导出不独占连接.
+
+指标写作 device_id:term_id:item_id, 可用glob, 如 1:*:* 或 *:10:1000, 按SET:DEVICE及SET:DEVICE_DATA:{device_id}展开.
+断点续传: cursor为最后收到的一行的 device_id:term_id:item_id:time, 从该行之后继续.
+"""
+import asyncio
+import csv
+import fnmatch
+import io
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from pydatacoll.utils.config_cache import sort_ids
+
+CHUNK_SIZE = 1000  # 每段读取的数据点数
+FIELDS = ('device_id', 'term_id', 'item_id', 'time', 'value')
+
+
+def _ndjson(rows):
+    return ''.join(json.dumps(dict(zip(FIELDS, row))) + '\n' for row in rows)
+
+
+def _csv(rows):
+    output = io.StringIO()
+    csv.writer(output, lineterminator='\n').writerows(rows)
+    return output.getvalue()
+
+
+# 格式 -> (content type, 开头, 一段数据的编码函数)
+FORMATS = {
+    'ndjson': ('application/x-ndjson; charset=utf-8', '', _ndjson),
+    'csv': ('text/csv; charset=utf-8', ','.join(FIELDS) + '\n', _csv),
+}
+
+
+def _is_glob(text):
+    return any(char in text for char in '*?[')
+
+
+def parse_cursor(cursor):
+    """
+    :return: (`device_id:term_id:item_id`, time)
+    """
+    parts = cursor.split(':', 3)
+    if len(parts) != 4 or not all(parts):
+        raise ValueError('invalid cursor: {}'.format(cursor))
+    return ':'.join(parts[:3]), parts[3]
+
+
+async def expand_items(redis_client, patterns):
+    """
+    :param patterns: list of `device_id:term_id:item_id`, glob allowed
+    :return: list of `device_id:term_id:item_id` without duplicates, in the order of patterns
+    """
+    items = list()
+    for pattern in patterns:
+        parts = pattern.split(':')
+        if len(parts) != 3 or not all(parts):
+            raise ValueError('invalid item: {}'.format(pattern))
+        if not _is_glob(pattern):
+            items.append(pattern)
+            continue
+        device_ids = [parts[0]]
+        if _is_glob(parts[0]):
+            device_ids = fnmatch.filter(sort_ids(await redis_client.smembers('SET:DEVICE')), parts[0])
+        member_pattern = '{}:{}'.format(parts[1], parts[2])
+        for device_id in device_ids:
+            members = await redis_client.smembers('SET:DEVICE_DATA:{}'.format(device_id))
+            members = fnmatch.filter(members, member_pattern)
+            items.extend('{}:{}'.format(device_id, member) for member in
+                         sorted(members, key=lambda member: [(len(part), part) for part in member.split(':')]))
+    return list(OrderedDict.fromkeys(items))
+
+
+async def _bisect(redis_client, key, time_str, right=False):
+    """
+    :return: index of the first time in LST:DATA_TIME >= time_str (> time_str if right), found by LINDEX
+    """
+    low, high = 0, await redis_client.llen(key)
+    while low < high:
+        middle = (low + high) // 2
+        value = await redis_client.lindex(key, middle)
+        if value < time_str or right and value == time_str:
+            low = middle + 1
+        else:
+            high = middle
+    return low
+
+
+async def export(redis_pool, items, write, start=None, end=None, cursor=None, chunk_size=CHUNK_SIZE):
+    """
+    :param items: list of `device_id:term_id:item_id`
+    :param write: coroutine function(rows), rows is a list of (device_id, term_id, item_id, time, value)
+    :param start: isoformat time, inclusive
+    :param end: isoformat time, exclusive
+    :param cursor: resume after this row, see parse_cursor()
+    :return: number of rows written
+    """
+    after = None
+    if cursor:
+        cursor_item, after = parse_cursor(cursor)
+        if cursor_item not in items:
+            raise ValueError('cursor item not in items: {}'.format(cursor_item))
+        items = items[items.index(cursor_item):]
+    count = 0
+    for item in items:
+        device_id, term_id, item_id = item.split(':')
+        time_key, data_key = 'LST:DATA_TIME:{}'.format(item), 'HS:DATA:{}'.format(item)
+        with (await redis_pool) as redis_client:
+            if after is not None and (not start or after >= start):
+                idx = await _bisect(redis_client, time_key, after, right=True)
+            elif start:
+                idx = await _bisect(redis_client, time_key, start)
+            else:
+                idx = 0
+        after = None
+        last_time = None
+        while True:
+            with (await redis_pool) as redis_client:
+                times = await redis_client.lrange(time_key, idx, idx + chunk_size - 1)
+                if end:
+                    times = [data_time for data_time in times if data_time < end]
+                values = await redis_client.hmget(data_key, *times) if times else []
+            rows = list()
+            for data_time, value in zip(times, values):
+                if value is None or data_time == last_time:  # 同一时间重复追加的只导出一次
+                    continue
+                last_time = data_time
+                rows.append((device_id, term_id, item_id, data_time, float(value)))
+            if rows:
+                await write(rows)
+                count += len(rows)
+            if len(times) < chunk_size:
+                break
+            idx += chunk_size
+            await asyncio.sleep(0)
+    return count
@@ -0,0 +1,251 @@
+"""
+配置数据的反向索引, 删除设备/终端/指标时据此找到相关的key, 不再SCAN整个keyspace
+
+    SET:DEVICE_TERM_ITEM:{device_id}    设备的所有终端指标, 成员: {term_id}:{item_id}
+    SET:DEVICE_DATA:{device_id}         设备可能存在的HS:DATA/LST:DATA_TIME, 成员: {term_id}:{item_id}
+    HS:DEVICE_MAPPING:{device_id}       设备的协议映射, {term_id}:{item_id} -> HS:MAPPING:{protocol}:{device_id}:{code}
+    SET:ITEM_TERM:{item_id}             用到该指标的终端指标及计算结果, 成员: {device_id}:{term_id}
+
+索引与HS:TERM_ITEM/HS:FORMULA在同一事务中写入, 数据key的名字是确定的, 创建时即可登记.
+升级旧数据或索引损坏时重建(会SCAN一次整个keyspace):
+    python -m pydatacoll.utils.key_index                                  # 使用PYDATACOLL_REDIS
+    python -m pydatacoll.utils.key_index --redis redis://localhost:6379/1 --dry-run
+"""
+import argparse
+import asyncio
+from collections import defaultdict
+from itertools import islice
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from pydatacoll.utils import backend
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('KeyIndex')
+
+DEVICE_TERM_ITEM = 'SET:DEVICE_TERM_ITEM:{}'
+DEVICE_DATA = 'SET:DEVICE_DATA:{}'
+DEVICE_MAPPING = 'HS:DEVICE_MAPPING:{}'
+ITEM_TERM = 'SET:ITEM_TERM:{}'
+INDEX_PATTERNS = ('SET:DEVICE_TERM_ITEM:*', 'SET:DEVICE_DATA:*', 'HS:DEVICE_MAPPING:*', 'SET:ITEM_TERM:*')
+# 大批量操作分段执行, 每段之间主动让出事件循环, 后端立即返回时(memory://)也不会长时间占用
+DELETE_CHUNK = 500  # 每条UNLINK/DEL命令最多删除的key数, 每个分段事务最多包含的记录数
+DELETE_WINDOW = 8  # 同时在途的删除命令数
+SCAN_COUNT = 1000
+
+_use_unlink = True  # redis<4.0不支持UNLINK, 第一次失败后改用DEL
+
+
+def add_term_item(tr, device_id, term_id, item_id, mapping_key=None):
+    """
+    queue index writes of a term_item on a multi_exec/pipeline
+    """
+    member = '{}:{}'.format(term_id, item_id)
+    tr.sadd(DEVICE_TERM_ITEM.format(device_id), member)
+    tr.sadd(DEVICE_DATA.format(device_id), member)
+    tr.sadd(ITEM_TERM.format(item_id), '{}:{}'.format(device_id, term_id))
+    if mapping_key:
+        tr.hset(DEVICE_MAPPING.format(device_id), member, mapping_key)
+
+
+def remove_term_item(tr, device_id, term_id, item_id):
+    member = '{}:{}'.format(term_id, item_id)
+    tr.srem(DEVICE_TERM_ITEM.format(device_id), member)
+    tr.srem(DEVICE_DATA.format(device_id), member)
+    tr.srem(ITEM_TERM.format(item_id), '{}:{}'.format(device_id, term_id))
+    tr.hdel(DEVICE_MAPPING.format(device_id), member)
+
+
+def add_data(tr, device_id, term_id, item_id):
+    """
+    queue index writes of data not belonging to a term_item, eg: formula result
+    """
+    tr.sadd(DEVICE_DATA.format(device_id), '{}:{}'.format(term_id, item_id))
+    tr.sadd(ITEM_TERM.format(item_id), '{}:{}'.format(device_id, term_id))
+
+
+def data_keys(device_id, members):
+    """
+    :param members: iterable of `{term_id}:{item_id}`
+    :return: generator of HS:DATA and LST:DATA_TIME keys
+    """
+    for member in members:
+        yield 'HS:DATA:{}:{}'.format(device_id, member)
+        yield 'LST:DATA_TIME:{}:{}'.format(device_id, member)
+
+
+async def scan_members(redis_client, key, prefix='', suffix=''):
+    """
+    members of a large index set starting with prefix and ending with suffix, read by SSCAN in SCAN_COUNT steps
+    """
+    members = list()
+    cursor = None
+    while cursor != 0:
+        cursor, found = await redis_client.sscan(key, cursor or 0, match=prefix + '*' + suffix, count=SCAN_COUNT)
+        members.extend(found)
+        await asyncio.sleep(0)
+    return members
+
+
+async def term_devices(redis_client, term_id, item_ids):
+    """
+    :return: set of device_id listed for the term in SET:ITEM_TERM of item_ids,
+             more than one after the term moved to another device
+    """
+    device_ids = set()
+    for item_id in item_ids:
+        for member in await scan_members(redis_client, ITEM_TERM.format(item_id), suffix=':{}'.format(term_id)):
+            device_ids.add(member.split(':')[0])
+    return device_ids
+
+
+async def _unlink(redis_client, keys):
+    global _use_unlink
+    if _use_unlink:
+        try:
+            # aioredis没有unlink方法, 直接发送命令
+            return await redis_client.connection.execute(b'UNLINK', *keys)
+        except Exception as e:
+            if 'unknown command' not in str(e).lower():
+                raise
+            _use_unlink = False
+            logger.info('UNLINK not supported, fallback to DEL')
+    return await redis_client.delete(*keys)
+
+
+async def delete_keys(redis_client, keys, chunk_size=DELETE_CHUNK, window=DELETE_WINDOW):
+    """
+    delete keys in chunks, `window` chunks are pipelined on the connection at a time and
+    the event loop gets a turn between windows, so a large delete does not stall other requests
+    :param keys: iterable, consumed lazily window by window
+    :return: number of keys deleted
+    """
+    keys = iter(keys)
+    deleted = 0
+    while True:
+        chunks = [chunk for chunk in (list(islice(keys, chunk_size)) for _ in range(window)) if chunk]
+        if not chunks:
+            return deleted
+        deleted += sum(await asyncio.gather(*[_unlink(redis_client, chunk) for chunk in chunks]))
+        await asyncio.sleep(0)
+
+
+async def execute_chunked(redis_client, records, queue, chunk_size=DELETE_CHUNK):
+    """
+    run the commands of many records as one multi_exec per chunk_size records, yielding to the event loop in between
+    :param queue: function(tr, record) queuing the commands of one record
+    """
+    records = list(records)
+    for idx in range(0, len(records), chunk_size):
+        tr = redis_client.multi_exec()
+        for record in records[idx:idx + chunk_size]:
+            queue(tr, record)
+        await tr.execute()
+        await asyncio.sleep(0)
+
+
+class IndexCollector(object):
+    """
+    collects sadd/hset of many records, then writes one SADD/HMSET per key
+    """
+    def __init__(self):
+        self.sets = defaultdict(set)
+        self.hashes = defaultdict(dict)
+
+    def sadd(self, key, member):
+        self.sets[key].add(member)
+
+    def hset(self, key, field, value):
+        self.hashes[key][field] = value
+
+    def flush(self, tr):
+        """
+        queue the collected writes on an aioredis multi_exec/pipeline
+        """
+        for key, members in self.sets.items():
+            tr.sadd(key, *members)
+        for key, fields in self.hashes.items():
+            tr.hmset(key, *[value for pair in fields.items() for value in pair])
+        self.sets.clear()
+        self.hashes.clear()
+
+
+def _scan(redis_client, match):
+    cursor = None
+    while cursor != 0:
+        cursor, keys = redis_client.scan(cursor or 0, match=match, count=SCAN_COUNT)
+        yield from keys
+
+
+def _hmget_all(redis_client, keys, *fields):
+    pipe = redis_client.pipeline(transaction=False)
+    for key in keys:
+        pipe.hmget(key, *fields)
+    return zip(keys, pipe.execute()) if keys else ()
+
+
+def rebuild(redis_client, dry_run=False):
+    """
+    rebuild all index keys from HS:TERM, HS:TERM_ITEM, HS:MAPPING, HS:DATA and HS:FORMULA
+    :param redis_client: redis.StrictRedis(decode_responses=True) or its in-process equivalent
+    :return: stats dict
+    """
+    stats = defaultdict(int)
+    index = IndexCollector()
+    sets, hashes = index.sets, index.hashes
+    term_device = {key.split(':')[2]: device_id for key, (device_id,) in
+                   _hmget_all(redis_client, list(_scan(redis_client, 'HS:TERM:*')), 'device_id') if device_id}
+    for key in _scan(redis_client, 'HS:TERM_ITEM:*'):
+        _, _, term_id, item_id = key.split(':')
+        device_id = term_device.get(term_id)
+        if device_id is None:
+            stats['orphan_term_items'] += 1
+            continue
+        stats['term_items'] += 1
+        add_term_item(index, device_id, term_id, item_id)
+    for key, (term_id, item_id) in _hmget_all(redis_client, list(_scan(redis_client, 'HS:MAPPING:*')),
+                                              'term_id', 'item_id'):
+        if term_id is None or item_id is None:
+            stats['broken_mappings'] += 1
+            continue
+        stats['mappings'] += 1
+        hashes[DEVICE_MAPPING.format(key.split(':')[3])]['{}:{}'.format(term_id, item_id)] = key
+    for key in _scan(redis_client, 'HS:DATA:*'):
+        _, _, device_id, term_id, item_id = key.split(':')
+        stats['data_keys'] += 1
+        add_data(index, device_id, term_id, item_id)
+    for key, (device_id, term_id, item_id) in _hmget_all(redis_client, list(_scan(redis_client, 'HS:FORMULA:*')),
+                                                         'device_id', 'term_id', 'item_id'):
+        if device_id and term_id and item_id:
+            stats['formulas'] += 1
+            add_data(index, device_id, term_id, item_id)
+    old_keys = {key for pattern in INDEX_PATTERNS for key in _scan(redis_client, pattern)}
+    stats['index_keys'] = len(sets) + len(hashes)
+    stats['stale_index_keys'] = len(old_keys - set(sets) - set(hashes))
+    if not dry_run:
+        pipe = redis_client.pipeline()
+        if old_keys:
+            pipe.delete(*old_keys)
+        for key, members in sets.items():
+            pipe.sadd(key, *members)
+        for key, fields in hashes.items():
+            pipe.hmset(key, fields)
+        pipe.execute()
+    logger.info('key index %s: %s', 'checked' if dry_run else 'rebuilt', dict(stats))
+    return dict(stats)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='rebuild reverse index keys of device config')
+    parser.add_argument('--redis', help='backend url, default env PYDATACOLL_REDIS or ' + backend.DEFAULT_URL)
+    parser.add_argument('--dry-run', action='store_true', help='only report, do not write')
+    args = parser.parse_args(argv)
+    if args.redis:
+        backend.configure(args.redis)
+    print(json.dumps(rebuild(backend.sync_client(), args.dry_run), indent=2))
+
+
+if __name__ == '__main__':
+    main()
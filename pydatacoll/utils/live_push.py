@@ -0,0 +1,186 @@
+import asyncio
+import fnmatch
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
+import aioredis
+
+from pydatacoll.utils import codec
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('LiveDataHub')
+
+DATA_CHANNEL = codec.DATA_PATTERN
+DATA_CHANNEL_PREFIX_LEN = len('CHANNEL:DEVICE_DATA:')
+MIN_INTERVAL = 0.1  # 客户端最快推送间隔(秒)
+MAX_INTERVAL = 60
+DEFAULT_INTERVAL = 0.5
+MAX_PENDING = 1000  # 每个客户端最多缓存的待推送指标数, 超过则丢弃最早的
+MAX_WRITE_BUFFER = 256 * 1024  # 客户端socket写缓冲超过该值时暂停推送, 继续合并新数据
+HEARTBEAT_INTERVAL = 15
+
+
+class LiveClient(object):
+    """
+    one websocket/SSE connection, values are coalesced by key `device_id:term_id:item_id`
+    and flushed by its own sender task, so a slow client never blocks the hub or other clients
+    """
+    def __init__(self, hub, send, transport=None, interval=DEFAULT_INTERVAL, max_pending=MAX_PENDING):
+        self.hub = hub
+        self.send = send  # coroutine function, param: str
+        self.transport = transport
+        self.interval = min(max(interval, MIN_INTERVAL), MAX_INTERVAL)
+        self.max_pending = max_pending
+        self.keys = set()
+        self.patterns = set()
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.closed = False
+        self.task = None
+        self.wakeup = asyncio.Event(loop=hub.io_loop)
+
+    def offer(self, key, raw_msg):
+        if key in self.pending:
+            del self.pending[key]
+        elif len(self.pending) >= self.max_pending:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+        self.pending[key] = raw_msg
+        self.wakeup.set()
+
+    def writable(self):
+        if self.transport is None or not hasattr(self.transport, 'get_write_buffer_size'):
+            return True
+        return self.transport.get_write_buffer_size() < MAX_WRITE_BUFFER
+
+    async def run(self):
+        try:
+            while not self.closed:
+                try:
+                    await asyncio.wait_for(self.wakeup.wait(), HEARTBEAT_INTERVAL, loop=self.hub.io_loop)
+                except asyncio.TimeoutError:
+                    await self.send(None)
+                    continue
+                await asyncio.sleep(self.interval, loop=self.hub.io_loop)
+                if self.closed:
+                    break
+                if not self.writable():
+                    continue
+                self.wakeup.clear()
+                pending, self.pending = self.pending, OrderedDict()
+                if pending:
+                    await self.send('[{}]'.format(','.join(pending.values())))
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            logger.debug('live client send failed: %s', repr(e))
+        finally:
+            self.close()
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.wakeup.set()
+            self.hub.unsubscribe(self, *(self.keys | self.patterns))
+
+
+class LiveDataHub(object):
+    """
+    share one redis subscription of CHANNEL:DEVICE_DATA:* (and its binary batches) among all live clients,
+    client subscribe to exact key `device_id:term_id:item_id` or glob pattern like `1:*:*`
+    """
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, redis_pool: aioredis.RedisPool):
+        self.io_loop = io_loop
+        self.redis_pool = redis_pool
+        self.sub_client = None
+        self.key_clients = dict()  # key -> set(client)
+        self.pattern_clients = dict()  # pattern -> set(client)
+        self.clients = set()
+        self.duplicates = codec.DuplicateFilter()  # 同一个点的二进制和JSON两份只推送先到的
+        self.reader_tasks = list()
+
+    async def start(self):
+        if self.sub_client is not None:
+            return
+        try:
+            self.sub_client = await self.redis_pool.acquire()
+            channels = await self.sub_client.psubscribe(DATA_CHANNEL, codec.BIN_PATTERN)
+            self.reader_tasks = [self.io_loop.create_task(self._msg_reader(ch)) for ch in channels]
+            logger.info('live data hub started')
+        except Exception as e:
+            logger.error('live data hub start failed: %s', repr(e), exc_info=True)
+
+    async def stop(self):
+        for client in list(self.clients):
+            client.close()
+        if self.sub_client is not None:
+            await self.sub_client.punsubscribe(DATA_CHANNEL, codec.BIN_PATTERN)
+            self.redis_pool.release(self.sub_client)
+            self.sub_client = None
+
+    def add_client(self, send, transport=None, interval=DEFAULT_INTERVAL):
+        client = LiveClient(self, send, transport, interval)
+        self.clients.add(client)
+        client.task = self.io_loop.create_task(client.run())
+        return client
+
+    def subscribe(self, client, *keys):
+        for key in keys:
+            if any(ch in key for ch in '*?['):
+                client.patterns.add(key)
+                self.pattern_clients.setdefault(key, set()).add(client)
+            else:
+                client.keys.add(key)
+                self.key_clients.setdefault(key, set()).add(client)
+
+    def unsubscribe(self, client, *keys):
+        for key in keys:
+            for client_dict, client_keys in ((self.key_clients, client.keys),
+                                             (self.pattern_clients, client.patterns)):
+                if key in client_keys:
+                    client_keys.discard(key)
+                    clients = client_dict.get(key)
+                    if clients is not None:
+                        clients.discard(client)
+                        if not clients:
+                            del client_dict[key]
+        if client.closed:
+            self.clients.discard(client)
+
+    def dispatch(self, key, raw_msg):
+        for client in self.key_clients.get(key, ()):
+            client.offer(key, raw_msg)
+        for pattern, clients in self.pattern_clients.items():
+            if fnmatch.fnmatchcase(key, pattern):
+                for client in clients:
+                    if key not in client.keys:
+                        client.offer(key, raw_msg)
+
+    async def _msg_reader(self, ch):
+        binary = ch.name.decode() == codec.BIN_PATTERN
+        while await ch.wait_message():
+            try:
+                real_channel, msg = await ch.get()
+                if binary:
+                    device_id, points = codec.decode_batch(msg)
+                    for term_id, item_id, data_time, value in points:
+                        key = '{}:{}:{}'.format(device_id, term_id, item_id)
+                        if key not in self.key_clients and not self.pattern_clients:
+                            continue
+                        time_str = data_time.isoformat()
+                        if self.duplicates.first(key, time_str, True):
+                            self.dispatch(key, json.dumps({
+                                'device_id': device_id, 'term_id': term_id, 'item_id': item_id,
+                                'time': time_str, 'value': value}))
+                    continue
+                if not self.clients:
+                    continue
+                key = real_channel[DATA_CHANNEL_PREFIX_LEN:].decode()
+                raw_msg = msg.decode('utf-8')
+                if self.duplicates.first(key, json.loads(raw_msg).get('time'), False):
+                    self.dispatch(key, raw_msg)
+            except Exception as e:
+                logger.error('live data hub dispatch failed: %s', repr(e), exc_info=True)
+        logger.debug('live data hub quit msg_reader!')
@@ -0,0 +1,180 @@
+"""
+事件循环健康监测: 调度延迟及阻塞事件循环的回调
+
+设备I/O, 插件和API共用事件循环, 任何阻塞调用(同步redis, 耗时的pandas公式, 大量帧解析)都会推迟IEC104的定时器.
+LoopMonitor每INTERVAL秒在事件循环中安排一次回调, 实际执行时间比计划晚多少即为调度延迟, 记入直方图.
+另有一个看门狗线程, 发现计划的回调超过threshold秒仍未执行时, 说明事件循环被阻塞, 立即抓取事件循环线程的调用栈
+及当前运行的Task, 即阻塞者本身; 事件循环恢复后补上阻塞时长, 保存在最近MAX_EVENTS个慢回调中.
+看门狗每threshold/2秒检查一次, 只读取时间, 不影响事件循环.
+
+    monitor = LoopMonitor(io_loop)
+    monitor.start()
+    monitor.report()  # 最大延迟及最近的慢回调, 见/api/v1/debug/loop
+"""
+import asyncio
+import datetime
+import sys
+import threading
+from collections import deque, OrderedDict
+
+from pydatacoll.utils import metrics
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('LoopMonitor')
+
+INTERVAL = 0.25  # 测量调度延迟的间隔(秒)
+THRESHOLD = 0.1  # 阻塞超过此时长(秒)的回调记为慢回调
+MAX_EVENTS = 50  # 保留最近的慢回调数
+MAX_FRAMES = 30  # 每个慢回调保留的调用栈层数
+
+LAG = metrics.histogram('pydatacoll_loop_lag_seconds', 'delay of a callback scheduled on the event loop',
+                        buckets=(.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10))
+SLOW = metrics.counter('pydatacoll_loop_slow_callbacks_total', 'callbacks blocking the event loop over the threshold')
+
+try:
+    current_task = asyncio.current_task  # python 3.7+
+except AttributeError:
+    current_task = asyncio.Task.current_task
+
+_EVENTS_FILE = asyncio.events.__file__
+
+
+def task_name(task):
+    """
+    :return: qualified name of the coroutine a Task runs, eg: `IEC104Device.receive`
+    """
+    coro = getattr(task, '_coro', None)
+    return getattr(coro, '__qualname__', None) or repr(task)
+
+
+def callback_frames(frame):
+    """
+    :return: frames of the callback (or Task step) the event loop is running, outermost first,
+             None if the loop is not running a callback
+    """
+    frames = list()
+    while frame is not None:
+        code = frame.f_code
+        if code.co_name == '_run' and code.co_filename == _EVENTS_FILE:  # asyncio.Handle._run
+            return frames[::-1]
+        frames.append(frame)
+        frame = frame.f_back
+    return None
+
+
+def format_stack(frame, limit=MAX_FRAMES):
+    """
+    :return: list of `file:line function`, outermost first, from the callback the event loop is running
+    """
+    frames = callback_frames(frame)
+    if frames is None:
+        frames = list()
+        while frame is not None:
+            frames.append(frame)
+            frame = frame.f_back
+        frames.reverse()
+    return ['{}:{} {}'.format(frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name)
+            for frame in frames[-limit:]]
+
+
+class LoopMonitor(object):
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, interval=INTERVAL, threshold=THRESHOLD):
+        self.io_loop = io_loop
+        self.interval = interval
+        self.threshold = threshold
+        self.events = deque(maxlen=MAX_EVENTS)  # 最近的慢回调, 新的在后
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+        self.slow_total = 0
+        self.expected = None  # 下一次回调的计划时间(io_loop.time())
+        self.handle = None
+        self.thread = None
+        self.thread_id = None
+        self._stopping = threading.Event()
+        self._captured = None  # 看门狗抓到的阻塞: (expected, event), 由事件循环补上阻塞时长后加入events
+        self._paused = None  # 事件循环未运行(如两次run_until_complete之间)时的expected, 这段延迟不计
+
+    def start(self):
+        """
+        must be called in the thread running io_loop
+        """
+        if self.thread is not None:
+            return
+        self.thread_id = threading.get_ident()
+        self._stopping.clear()
+        self._schedule()
+        self.thread = threading.Thread(target=self._watch, name='LoopMonitor', daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.handle is not None:
+            self.handle.cancel()
+            self.handle = None
+        if self.thread is not None:
+            self._stopping.set()
+            self.thread.join()
+            self.thread = None
+        self.expected = None
+
+    def _schedule(self):
+        self.expected = self.io_loop.time() + self.interval
+        self.handle = self.io_loop.call_later(self.interval, self._tick)
+
+    def _tick(self):
+        if self._paused == self.expected:
+            self._schedule()
+            return
+        lag = max(self.io_loop.time() - self.expected, 0.0)
+        LAG.observe(lag)
+        self.last_lag = lag
+        self.max_lag = max(self.max_lag, lag)
+        captured, self._captured = self._captured, None
+        if lag >= self.threshold:
+            self.slow_total += 1
+            SLOW.inc()
+            event = captured[1] if captured is not None and captured[0] == self.expected else self._event(None)
+            event['blocked'] = round(lag, 6)
+            self.events.append(event)
+            logger.warning('event loop blocked for %.3fs by %s', lag, event['task'])
+        self._schedule()
+
+    def _event(self, frame):
+        try:
+            task = current_task(self.io_loop)
+        except RuntimeError:  # python 3.7+在事件循环未运行时报错
+            task = None
+        return OrderedDict([
+            ('time', datetime.datetime.now().isoformat()),
+            ('blocked', None),
+            ('task', task_name(task) if task is not None else None),
+            ('stack', format_stack(frame) if frame is not None else []),
+        ])
+
+    def _watch(self):
+        """
+        watchdog thread: capture the stack of the event loop thread once it is blocked over the threshold
+        """
+        while not self._stopping.wait(self.threshold / 2):
+            expected = self.expected
+            if expected is None or self.io_loop.time() - expected < self.threshold:
+                continue
+            if not self.io_loop.is_running():
+                self._paused = expected
+                continue
+            if self._captured is not None and self._captured[0] == expected:
+                continue  # 同一次阻塞只抓取一次
+            frame = sys._current_frames().get(self.thread_id)
+            self._captured = (expected, self._event(frame))
+
+    def report(self):
+        """
+        :return: json serializable dict
+        """
+        return OrderedDict([
+            ('interval', self.interval),
+            ('threshold', self.threshold),
+            ('last_lag', round(self.last_lag, 6)),
+            ('max_lag', round(self.max_lag, 6)),
+            ('slow_total', self.slow_total),
+            ('events', list(self.events)),
+        ])
@@ -0,0 +1,549 @@
+import asyncio
+import fnmatch
+from collections import deque
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('MemRedis')
+
+
+class ReplyError(Exception):
+    pass
+
+
+def _to_str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def _to_bytes(value):
+    if isinstance(value, bytes):
+        return value
+    return str(value).encode('utf-8')
+
+
+class MemoryStore(object):
+    """
+    in-process replacement of one redis db: strings, hashes, lists, sets and pub/sub,
+    values are kept as str as if the client decodes responses with utf-8,
+    every command runs synchronously so a pipeline or multi_exec is naturally atomic
+    """
+    def __init__(self):
+        self.data = dict()
+        self.channels = dict()  # channel -> set(MemoryChannel)
+        self.patterns = dict()  # pattern -> set(MemoryChannel)
+
+    def _get(self, key, kind):
+        value = self.data.get(_to_str(key))
+        if value is not None and not isinstance(value, kind):
+            raise ReplyError('WRONGTYPE Operation against a key holding the wrong kind of value')
+        return value
+
+    def _get_or_create(self, key, kind):
+        value = self._get(key, kind)
+        if value is None:
+            value = self.data[_to_str(key)] = kind()
+        return value
+
+    def _drop_empty(self, key):
+        key = _to_str(key)
+        if key in self.data and not self.data[key] and not isinstance(self.data[key], str):
+            del self.data[key]
+
+    # keys
+    def delete(self, key, *keys):
+        count = 0
+        for k in (key,) + keys:
+            if self.data.pop(_to_str(k), None) is not None:
+                count += 1
+        return count
+
+    unlink = delete
+
+    def exists(self, key):
+        return 1 if _to_str(key) in self.data else 0
+
+    def keys(self, pattern):
+        return [key for key in self.data if fnmatch.fnmatchcase(key, _to_str(pattern))]
+
+    def scan(self, cursor=0, match=None, count=None):
+        return 0, self.keys(match or '*')
+
+    def flushdb(self):
+        self.data.clear()
+        return True
+
+    def type(self, key):
+        value = self.data.get(_to_str(key))
+        return {str: 'string', dict: 'hash', deque: 'list', set: 'set'}.get(type(value), 'none')
+
+    # strings
+    def get(self, key):
+        return self._get(key, str)
+
+    def set(self, key, value):
+        self.data[_to_str(key)] = _to_str(value)
+        return True
+
+    # hashes
+    def hget(self, key, field):
+        return (self._get(key, dict) or {}).get(_to_str(field))
+
+    def hset(self, key, field, value):
+        hash_value = self._get_or_create(key, dict)
+        field = _to_str(field)
+        created = field not in hash_value
+        hash_value[field] = _to_str(value)
+        return 1 if created else 0
+
+    def hmset(self, key, field, value, *pairs):
+        if len(pairs) % 2 != 0:
+            raise ReplyError('ERR wrong number of arguments for HMSET')
+        hash_value = self._get_or_create(key, dict)
+        pairs = (field, value) + pairs
+        for idx in range(0, len(pairs), 2):
+            hash_value[_to_str(pairs[idx])] = _to_str(pairs[idx + 1])
+        return True
+
+    def hmget(self, key, field, *fields):
+        hash_value = self._get(key, dict) or {}
+        return [hash_value.get(_to_str(f)) for f in (field,) + fields]
+
+    def hgetall(self, key):
+        return dict(self._get(key, dict) or {})
+
+    def hkeys(self, key):
+        return list(self._get(key, dict) or {})
+
+    def hvals(self, key):
+        return list((self._get(key, dict) or {}).values())
+
+    def hlen(self, key):
+        return len(self._get(key, dict) or {})
+
+    def hexists(self, key, field):
+        return 1 if _to_str(field) in (self._get(key, dict) or {}) else 0
+
+    def hdel(self, key, field, *fields):
+        hash_value = self._get(key, dict) or {}
+        count = sum(1 for f in (field,) + fields if hash_value.pop(_to_str(f), None) is not None)
+        self._drop_empty(key)
+        return count
+
+    # lists
+    def rpush(self, key, value, *values):
+        list_value = self._get_or_create(key, deque)
+        list_value.extend(_to_str(v) for v in (value,) + values)
+        return len(list_value)
+
+    def lpush(self, key, value, *values):
+        list_value = self._get_or_create(key, deque)
+        list_value.extendleft(_to_str(v) for v in (value,) + values)
+        return len(list_value)
+
+    def rpop(self, key):
+        list_value = self._get(key, deque)
+        if not list_value:
+            return None
+        value = list_value.pop()
+        self._drop_empty(key)
+        return value
+
+    def lpop(self, key):
+        list_value = self._get(key, deque)
+        if not list_value:
+            return None
+        value = list_value.popleft()
+        self._drop_empty(key)
+        return value
+
+    def llen(self, key):
+        return len(self._get(key, deque) or ())
+
+    def lindex(self, key, index):
+        list_value = self._get(key, deque) or ()
+        index = int(index)
+        if -len(list_value) <= index < len(list_value):
+            return list_value[index]
+        return None
+
+    @staticmethod
+    def _range(length, start, stop):
+        start, stop = int(start), int(stop)
+        start = max(0, start + length if start < 0 else start)
+        stop = min(length - 1, stop + length if stop < 0 else stop)
+        return start, stop
+
+    def lrange(self, key, start, stop):
+        list_value = self._get(key, deque) or ()
+        start, stop = self._range(len(list_value), start, stop)
+        return [list_value[idx] for idx in range(start, stop + 1)]
+
+    def ltrim(self, key, start, stop):
+        list_value = self._get(key, deque)
+        if list_value is not None:
+            start, stop = self._range(len(list_value), start, stop)
+            self.data[_to_str(key)] = deque(list_value[idx] for idx in range(start, stop + 1))
+            self._drop_empty(key)
+        return True
+
+    # sets
+    def sadd(self, key, member, *members):
+        set_value = self._get_or_create(key, set)
+        count = len(set_value)
+        set_value.update(_to_str(m) for m in (member,) + members)
+        return len(set_value) - count
+
+    def srem(self, key, member, *members):
+        set_value = self._get(key, set) or set()
+        count = len(set_value)
+        set_value.difference_update(_to_str(m) for m in (member,) + members)
+        count -= len(set_value)
+        self._drop_empty(key)
+        return count
+
+    def smembers(self, key):
+        return list(self._get(key, set) or ())
+
+    def sismember(self, key, member):
+        return 1 if _to_str(member) in (self._get(key, set) or ()) else 0
+
+    def scard(self, key):
+        return len(self._get(key, set) or ())
+
+    def sscan(self, key, cursor=0, match=None, count=None):
+        # 游标即偏移量, 集合在两次调用之间没有修改时与redis一样每个成员只返回一次
+        members = list(self._get(key, set) or ())
+        cursor = int(cursor)
+        end = cursor + (count or 10)
+        match = _to_str(match or '*')
+        return (end if end < len(members) else 0), [
+            member for member in members[cursor:end] if fnmatch.fnmatchcase(member, match)]
+
+    # pub/sub
+    def publish(self, channel, message):
+        channel, message = _to_bytes(channel), _to_bytes(message)
+        receivers = 0
+        for ch in self.channels.get(channel.decode('utf-8'), ()):
+            ch.put(channel, message)
+            receivers += 1
+        for pattern, pattern_channels in self.patterns.items():
+            if fnmatch.fnmatchcase(channel.decode('utf-8'), pattern):
+                for ch in pattern_channels:
+                    ch.put(channel, message)
+                    receivers += 1
+        return receivers
+
+    def add_channel(self, ch):
+        registry = self.patterns if ch.is_pattern else self.channels
+        registry.setdefault(ch.name.decode('utf-8'), set()).add(ch)
+
+    def remove_channel(self, ch):
+        registry = self.patterns if ch.is_pattern else self.channels
+        name = ch.name.decode('utf-8')
+        registry.get(name, set()).discard(ch)
+        if not registry.get(name, True):
+            del registry[name]
+
+
+# 可在pipeline/multi_exec中排队执行的命令
+COMMANDS = ('delete', 'unlink', 'exists', 'keys', 'scan', 'flushdb', 'type', 'get', 'set',
+            'hget', 'hset', 'hmset', 'hmget', 'hgetall', 'hkeys', 'hvals', 'hlen', 'hexists', 'hdel',
+            'rpush', 'lpush', 'rpop', 'lpop', 'llen', 'lindex', 'lrange', 'ltrim',
+            'sadd', 'srem', 'smembers', 'sismember', 'scard', 'sscan', 'publish')
+
+
+class MemoryChannel(object):
+    """
+    the subset of aioredis.Channel used by the project
+    """
+    def __init__(self, name, is_pattern, io_loop: asyncio.AbstractEventLoop):
+        self.name = _to_bytes(name)
+        self.is_pattern = is_pattern
+        self.io_loop = io_loop
+        self.messages = deque()  # (channel, message)
+        self.waiter = None
+        self.is_active = True
+
+    def put(self, channel, message):
+        if self.is_active:
+            self.messages.append((channel, message))
+            self._wakeup()
+
+    def close(self):
+        self.is_active = False
+        self._wakeup()
+
+    def _wakeup(self):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+
+    async def wait_message(self):
+        """
+        :return: False once the channel is unsubscribed and drained
+        """
+        while not self.messages and self.is_active:
+            self.waiter = asyncio.Future(loop=self.io_loop)
+            await self.waiter
+        return len(self.messages) > 0
+
+    async def get(self, encoding=None):
+        if not await self.wait_message():
+            return None
+        channel, message = self.messages.popleft()
+        if encoding is not None:
+            message = message.decode(encoding)
+        return (channel, message) if self.is_pattern else message
+
+    async def get_json(self, encoding='utf-8'):
+        item = await self.get(encoding=encoding)
+        if item is None:
+            return None
+        if self.is_pattern:
+            return item[0], json.loads(item[1])
+        return json.loads(item)
+
+
+def _async_command(name):
+    async def command(self, *args, **kwargs):
+        return getattr(self.store, name)(*args, **kwargs)
+    command.__name__ = name
+    return command
+
+
+def _queued_command(name):
+    def command(self, *args, **kwargs):
+        fut = asyncio.Future(loop=self.io_loop)
+        self.commands.append((fut, name, args, kwargs))
+        return fut
+    command.__name__ = name
+    return command
+
+
+class MemoryPipeline(object):
+    """
+    stands for both pipeline() and multi_exec(), commands return futures resolved by execute()
+    """
+    def __init__(self, store: MemoryStore, io_loop: asyncio.AbstractEventLoop):
+        self.store = store
+        self.io_loop = io_loop
+        self.commands = list()
+
+    async def execute(self, *, return_exceptions=False):
+        results = list()
+        commands, self.commands = self.commands, list()
+        for fut, name, args, kwargs in commands:
+            try:
+                result = getattr(self.store, name)(*args, **kwargs)
+                fut.set_result(result)
+            except Exception as e:
+                if not return_exceptions:
+                    fut.cancel()
+                    raise
+                result = e
+                fut.set_exception(e)
+                fut.exception()  # 避免未取得异常的告警
+            results.append(result)
+        return results
+
+
+class MemoryConnection(object):
+    """
+    the subset of aioredis.Redis used by the project, backed by a MemoryStore
+    """
+    def __init__(self, store: MemoryStore, io_loop: asyncio.AbstractEventLoop):
+        self.store = store
+        self.io_loop = io_loop
+        self.pubsub_channels = dict()  # name -> MemoryChannel
+        self.pubsub_patterns = dict()
+        self.closed = False
+
+    @property
+    def in_pubsub(self):
+        return len(self.pubsub_channels) + len(self.pubsub_patterns)
+
+    @property
+    def connection(self):
+        return self
+
+    async def execute(self, command, *args):
+        """
+        raw command through `redis_client.connection.execute`, for commands aioredis has no method for
+        """
+        name = _to_str(command).lower()
+        if name not in COMMANDS:
+            raise ReplyError("ERR unknown command '{}'".format(name))
+        return getattr(self.store, name)(*args)
+
+    def pipeline(self):
+        return MemoryPipeline(self.store, self.io_loop)
+
+    def multi_exec(self):
+        return MemoryPipeline(self.store, self.io_loop)
+
+    def _subscribe(self, registry, is_pattern, names):
+        channels = list()
+        for name in names:
+            name = _to_str(name)
+            ch = registry.get(name)
+            if ch is None:
+                ch = registry[name] = MemoryChannel(name, is_pattern, self.io_loop)
+                self.store.add_channel(ch)
+            channels.append(ch)
+        return channels
+
+    def _unsubscribe(self, registry, names):
+        for name in names or list(registry):
+            ch = registry.pop(_to_str(name), None)
+            if ch is not None:
+                self.store.remove_channel(ch)
+                ch.close()
+
+    async def subscribe(self, channel, *channels):
+        return self._subscribe(self.pubsub_channels, False, (channel,) + channels)
+
+    async def psubscribe(self, pattern, *patterns):
+        return self._subscribe(self.pubsub_patterns, True, (pattern,) + patterns)
+
+    async def unsubscribe(self, *channels):
+        self._unsubscribe(self.pubsub_channels, channels)
+
+    async def punsubscribe(self, *patterns):
+        self._unsubscribe(self.pubsub_patterns, patterns)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self._unsubscribe(self.pubsub_channels, ())
+            self._unsubscribe(self.pubsub_patterns, ())
+
+    async def wait_closed(self):
+        pass
+
+
+for _name in COMMANDS:
+    setattr(MemoryConnection, _name, _async_command(_name))
+    setattr(MemoryPipeline, _name, _queued_command(_name))
+
+
+class _ConnectionContextManager(object):
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, *args):
+        self.pool.release(self.conn)
+
+
+class MemoryPool(object):
+    """
+    the subset of aioredis.RedisPool used by the project, usable as `with (await pool) as conn`
+    """
+    def __init__(self, store: MemoryStore, io_loop: asyncio.AbstractEventLoop, minsize=1, maxsize=10):
+        self.store = store
+        self.io_loop = io_loop
+        self.minsize = minsize
+        self.maxsize = maxsize
+        self.used = set()
+        self.closed = False
+
+    @property
+    def size(self):
+        return len(self.used)
+
+    @property
+    def freesize(self):
+        return 0
+
+    async def acquire(self):
+        conn = MemoryConnection(self.store, self.io_loop)
+        self.used.add(conn)
+        return conn
+
+    def release(self, conn):
+        self.used.discard(conn)
+        # 与aioredis一致: 处于订阅状态的连接归还时关闭
+        if conn.in_pubsub:
+            conn.close()
+
+    async def clear(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    async def wait_closed(self):
+        pass
+
+    async def _context(self):
+        conn = await self.acquire()
+        return _ConnectionContextManager(self, conn)
+
+    def __await__(self):
+        return self._context().__await__()
+
+
+def _sync_command(name):
+    def command(self, *args, **kwargs):
+        return getattr(self.store, name)(*args, **kwargs)
+    command.__name__ = name
+    return command
+
+
+class MemorySyncClient(object):
+    """
+    the subset of redis.StrictRedis(decode_responses=True) used by the project, backed by a MemoryStore
+    """
+    def __init__(self, store: MemoryStore):
+        self.store = store
+
+    def hmset(self, key, mapping: dict):
+        pairs = [value for pair in mapping.items() for value in pair]
+        return self.store.hmset(key, *pairs)
+
+    def exists(self, key):
+        return bool(self.store.exists(key))
+
+    def sismember(self, key, member):
+        return bool(self.store.sismember(key, member))
+
+    def smembers(self, key):
+        return set(self.store.smembers(key))
+
+    def delete(self, *keys):
+        return self.store.delete(*keys) if keys else 0
+
+    def pipeline(self, transaction=True):
+        return MemorySyncPipeline(self)
+
+
+def _queued_sync_command(name):
+    def command(self, *args, **kwargs):
+        self.commands.append((name, args, kwargs))
+        return self
+    command.__name__ = name
+    return command
+
+
+class MemorySyncPipeline(object):
+    def __init__(self, client: MemorySyncClient):
+        self.client = client
+        self.commands = list()
+
+    def execute(self):
+        commands, self.commands = self.commands, list()
+        return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in commands]
+
+
+for _name in COMMANDS:
+    if not hasattr(MemorySyncClient, _name):
+        setattr(MemorySyncClient, _name, _sync_command(_name))
+    setattr(MemorySyncPipeline, _name, _queued_sync_command(_name))
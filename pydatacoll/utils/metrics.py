@@ -0,0 +1,356 @@
+"""
+进程内的性能指标: Counter, Gauge, Histogram, 以Prometheus文本格式(0.0.4)输出
+
+    REQUESTS = metrics.counter('pydatacoll_http_requests_total', 'HTTP requests', ('handler', 'status'))
+    REQUESTS.labels('get_device', 200).inc()
+    LATENCY = metrics.histogram('pydatacoll_http_request_seconds', 'HTTP request latency', ('handler',))
+    LATENCY.labels('get_device').observe(elapsed)
+
+每组标签值第一次使用时创建子项, 之后只有一次dict查找和加法, 热路径上没有锁和字符串格式化;
+热点代码可以先保存labels()返回的子项. 输出时才计算直方图的累计值.
+
+多进程部署(pydatacoll.launcher)时, 每个进程每PUBLISH_INTERVAL秒把快照写入HS:METRICS的一个字段(进程名),
+/metrics汇总本进程及其他未过期的快照, 每条时间序列加上process标签. 快照中还可以附带其他报告(add_report),
+如事件循环的健康状况(pydatacoll.utils.loop_monitor), 用collect_reports()读取.
+"""
+import asyncio
+import os
+import socket
+import time
+from bisect import bisect_left
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('Metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SNAPSHOT_KEY = 'HS:METRICS'
+PUBLISH_INTERVAL = 10  # 快照写入redis的间隔(秒), 超过3个间隔未更新的快照视为进程已退出
+
+_process = '{}/{}'.format(socket.gethostname(), os.getpid())
+
+
+def set_process(name):
+    """
+    name of this process in the process label, launcher uses the name of the child process so it survives restarts
+    """
+    global _process
+    _process = '{}/{}'.format(socket.gethostname(), name)
+
+
+def process_name():
+    return _process
+
+
+class _CounterChild(object):
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+
+class _GaugeChild(_CounterChild):
+    __slots__ = ('function',)
+
+    def __init__(self):
+        super().__init__()
+        self.function = None
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def get(self):
+        return self.function() if self.function is not None else self.value
+
+
+class _HistogramChild(object):
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # 最后一个是+Inf
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.children = dict()  # 标签值 -> 子项
+        self._default = None
+        if not self.labelnames:
+            self._default = self.children[()] = self._new_child()
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values):
+        child = self.children.get(values)
+        if child is None:
+            if len(values) != len(self.labelnames):
+                raise ValueError('{} expects labels {}'.format(self.name, self.labelnames))
+            child = self.children[values] = self._new_child()
+        return child
+
+    def remove(self, *values):
+        """
+        drop the child of label values no longer used, eg: a deleted formula
+        """
+        self.children.pop(values, None)
+
+    def _samples(self, labels, child):
+        return [['', labels, child.value]]
+
+    def collect(self):
+        """
+        :return: dict of name, type, help and samples: list of [suffix, labels dict, value]
+        """
+        samples = list()
+        for values, child in list(self.children.items()):
+            samples.extend(self._samples(OrderedDict(zip(self.labelnames, (str(value) for value in values))), child))
+        return {'name': self.name, 'type': self.kind, 'help': self.documentation, 'samples': samples}
+
+
+class Counter(_Metric):
+    kind = 'counter'
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+
+class Gauge(_Metric):
+    kind = 'gauge'
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def inc(self, amount=1):
+        self._default.value += amount
+
+    def dec(self, amount=1):
+        self._default.value -= amount
+
+    def set(self, value):
+        self._default.value = value
+
+    def set_function(self, function):
+        """
+        value is read from function() at collection time
+        """
+        self._default.function = function
+
+    def _samples(self, labels, child):
+        return [['', labels, child.get()]]
+
+
+class Histogram(_Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        self.bounds = tuple(sorted(float(bound) for bound in buckets))
+        super().__init__(name, documentation, labelnames)
+
+    def _new_child(self):
+        return _HistogramChild(self.bounds)
+
+    def observe(self, value):
+        self._default.observe(value)
+
+    def _samples(self, labels, child):
+        samples = list()
+        cumulative = 0
+        for bound, count in zip(self.bounds + (float('inf'),), list(child.counts)):
+            cumulative += count
+            samples.append(['_bucket', OrderedDict(labels, le=_format_value(bound)), cumulative])
+        samples.append(['_sum', labels, child.sum])
+        samples.append(['_count', labels, cumulative])
+        return samples
+
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = OrderedDict()  # name -> metric
+
+    def register(self, metric_class, name, *args, **kwargs):
+        """
+        :return: the metric already registered under name, or a new one
+        """
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = self.metrics[name] = metric_class(name, *args, **kwargs)
+        elif not isinstance(metric, metric_class):
+            raise ValueError('metric {} already registered as {}'.format(name, metric.kind))
+        return metric
+
+    def collect(self):
+        return [metric.collect() for metric in list(self.metrics.values())]
+
+
+REGISTRY = Registry()
+
+
+def counter(name, documentation, labelnames=()):
+    return REGISTRY.register(Counter, name, documentation, labelnames)
+
+
+def gauge(name, documentation, labelnames=()):
+    return REGISTRY.register(Gauge, name, documentation, labelnames)
+
+
+def histogram(name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+    return REGISTRY.register(Histogram, name, documentation, labelnames, buckets=buckets)
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    if value != value:
+        return 'NaN'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def _escape(value):
+    return value.replace('\\', r'\\').replace('"', r'\"').replace('\n', r'\n')
+
+
+def render(snapshots):
+    """
+    :param snapshots: OrderedDict, process name -> families returned by Registry.collect()
+    :return: text exposition format, samples of each process carry a process label
+    """
+    families = OrderedDict()
+    for process, process_families in snapshots.items():
+        for family in process_families:
+            merged = families.setdefault(family['name'], {'type': family['type'], 'help': family['help'], 'lines': []})
+            for suffix, labels, value in family['samples']:
+                labels = ','.join('{}="{}"'.format(name, _escape(str(label)))
+                                  for name, label in list(labels.items()) + [('process', process)])
+                merged['lines'].append('{}{}{{{}}} {}'.format(family['name'], suffix, labels, _format_value(value)))
+    lines = list()
+    for name, family in families.items():
+        lines.append('# HELP {} {}'.format(name, family['help'].replace('\\', r'\\').replace('\n', r'\n')))
+        lines.append('# TYPE {} {}'.format(name, family['type']))
+        lines.extend(family['lines'])
+    return '\n'.join(lines) + '\n'
+
+
+async def _snapshots(redis_client):
+    """
+    :return: OrderedDict, process -> snapshot of other processes not expired, expired ones are removed
+    """
+    snapshots = OrderedDict()
+    expired = list()
+    now = time.time()
+    for process, snapshot in sorted((await redis_client.hgetall(SNAPSHOT_KEY)).items()):
+        if process == _process:
+            continue
+        try:
+            snapshot = json.loads(snapshot)
+            if now - snapshot['time'] > PUBLISH_INTERVAL * 3:
+                expired.append(process)
+            else:
+                snapshots[process] = snapshot
+        except (ValueError, KeyError, TypeError):
+            expired.append(process)
+    if expired:
+        await redis_client.hdel(SNAPSHOT_KEY, *expired)
+    return snapshots
+
+
+async def collect_all(redis_client, registry=REGISTRY):
+    """
+    :return: OrderedDict for render(), this process first, then unexpired snapshots of other processes
+    """
+    snapshots = OrderedDict([(_process, registry.collect())])
+    for process, snapshot in (await _snapshots(redis_client)).items():
+        snapshots[process] = snapshot.get('families', [])
+    return snapshots
+
+
+async def collect_reports(redis_client, name, local=None):
+    """
+    :param name: name given to SnapshotPublisher.add_report()
+    :param local: report of this process
+    :return: OrderedDict, process -> report, this process first
+    """
+    reports = OrderedDict()
+    if local is not None:
+        reports[_process] = local
+    for process, snapshot in (await _snapshots(redis_client)).items():
+        report = snapshot.get('reports', {}).get(name)
+        if report is not None:
+            reports[process] = report
+    return reports
+
+
+class SnapshotPublisher(object):
+    """
+    write the snapshot of this process to HS:METRICS periodically, so /metrics of any API worker covers all processes
+    """
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, redis_pool, registry=REGISTRY, interval=PUBLISH_INTERVAL):
+        self.io_loop = io_loop
+        self.redis_pool = redis_pool
+        self.registry = registry
+        self.interval = interval
+        self.reports = OrderedDict()  # name -> function returning a json serializable report
+        self.task = None
+
+    def add_report(self, name, function):
+        """
+        publish function() along with the metrics, read by collect_reports()
+        """
+        self.reports[name] = function
+
+    def snapshot(self):
+        return {'time': time.time(), 'families': self.registry.collect(),
+                'reports': {name: function() for name, function in self.reports.items()}}
+
+    def start(self):
+        if self.task is None:
+            self.task = self.io_loop.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        try:
+            with (await self.redis_pool) as redis_client:
+                await redis_client.hdel(SNAPSHOT_KEY, _process)
+        except Exception as e:
+            logger.warning('remove metrics snapshot failed: %s', repr(e))
+
+    async def run(self):
+        while True:
+            try:
+                with (await self.redis_pool) as redis_client:
+                    await redis_client.hset(SNAPSHOT_KEY, _process, json.dumps(self.snapshot()))
+                await asyncio.sleep(self.interval, loop=self.io_loop)
+            except asyncio.CancelledError:
+                break
+            except Exception as e:
+                logger.error('publish metrics snapshot failed: %s', repr(e), exc_info=True)
+                await asyncio.sleep(self.interval, loop=self.io_loop)
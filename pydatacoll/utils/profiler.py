@@ -0,0 +1,143 @@
+"""
+运行中进程的按需性能分析
+
+    sample: 用ITIMER_REAL定时器每SAMPLE_INTERVAL秒触发一次SIGALRM, 在信号处理函数中记录事件循环(主线程)的调用栈,
+            持续seconds秒, 输出collapsed stack格式
+            (每行 `协程;帧;帧... 次数`, 可直接用flamegraph.pl或speedscope查看). 每个调用栈以当前Task的协程名开头,
+            即按协程汇总; 普通回调为(callback), 事件循环空闲等待I/O时为(idle), 事件循环自身的处理为(loop).
+    cprofile: 在事件循环线程中启用cProfile, 持续seconds秒, 输出pstats文件内容(marshal), 用pstats.Stats读取.
+
+信号处理函数在两条字节码之间执行, 得到的是当时正在执行的帧, 阻塞事件循环的调用(如time.sleep, 同步I/O)也能采到;
+采样线程则只能在事件循环线程释放GIL时采样, 看不到短时间的计算, 所以不用线程. 要求事件循环在主线程中运行, 且不支持Windows.
+不在分析时没有任何开销: 定时器和cProfile只在分析期间启用. 同一进程同一时间只能进行一次分析.
+API进程通过POST /api/v1/debug/profile分析; 所有进程(包括launcher启动的插件进程)收到SIGUSR1时采样,
+收到SIGUSR2时运行cProfile, 持续SIGNAL_SECONDS秒, 结果写入临时目录并记录日志.
+"""
+import asyncio
+import cProfile
+import datetime
+import marshal
+import os
+import signal
+import tempfile
+from collections import Counter
+
+from pydatacoll.utils import metrics
+from pydatacoll.utils.loop_monitor import callback_frames, current_task, task_name
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('Profiler')
+
+SAMPLE_INTERVAL = 0.005  # 采样间隔(秒)
+MAX_SECONDS = 300  # 一次分析的最长时间(秒)
+SIGNAL_SECONDS = 30  # 信号触发的分析时长(秒)
+FORMATS = ('collapsed', 'pstats')
+
+
+class ProfilerBusy(Exception):
+    pass
+
+
+class Profiler(object):
+    def __init__(self, io_loop: asyncio.AbstractEventLoop):
+        self.io_loop = io_loop
+        self.busy = False
+
+    def _acquire(self):
+        if self.busy:
+            raise ProfilerBusy('a profile is already running in this process')
+        self.busy = True
+
+    def _collapse(self, frame):
+        """
+        :return: `coroutine;file:function;...`, outermost first
+        """
+        frames = callback_frames(frame)
+        if frames is None:
+            return '(idle)' if os.path.basename(frame.f_code.co_filename) == 'selectors.py' else '(loop)'
+        try:
+            task = current_task(self.io_loop)
+        except RuntimeError:
+            task = None
+        names = [task_name(task) if task is not None else '(callback)']
+        names.extend('{}:{}'.format(os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+                     for frame in frames)
+        return ';'.join(names)
+
+    async def sample(self, seconds, interval=SAMPLE_INTERVAL):
+        """
+        must be called in the main thread running io_loop
+        :return: collapsed stacks, one `stack count` per line, most frequent first
+        """
+        counts = Counter()
+
+        def on_timer(_, frame):
+            counts[self._collapse(frame)] += 1
+        self._acquire()
+        try:
+            old_handler = signal.signal(signal.SIGALRM, on_timer)  # 不在主线程中时抛出ValueError
+        except Exception:
+            self.busy = False
+            raise
+        try:
+            signal.setitimer(signal.ITIMER_REAL, interval, interval)
+            await asyncio.sleep(seconds, loop=self.io_loop)
+        finally:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, old_handler)
+            self.busy = False
+        return ''.join('{} {}\n'.format(stack, count) for stack, count in counts.most_common())
+
+    async def cprofile(self, seconds):
+        """
+        must be called in the thread running io_loop
+        :return: content of a pstats file
+        """
+        self._acquire()
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            await asyncio.sleep(seconds, loop=self.io_loop)
+        finally:
+            profile.disable()
+            self.busy = False
+        profile.create_stats()
+        return marshal.dumps(profile.stats)
+
+    async def run(self, seconds, profile_format='collapsed'):
+        """
+        :return: bytes of the result in profile_format
+        """
+        if profile_format == 'pstats':
+            return await self.cprofile(seconds)
+        return (await self.sample(seconds)).encode('utf-8')
+
+    async def _run_to_file(self, profile_format, seconds, directory):
+        try:
+            logger.info('profiling %s for %ss', profile_format, seconds)
+            result = await self.run(seconds, profile_format)
+            file_name = os.path.join(directory, 'pydatacoll-{}-{}.{}'.format(
+                metrics.process_name().replace('/', '-'), datetime.datetime.now().strftime('%Y%m%d%H%M%S'),
+                profile_format))
+            with open(file_name, 'wb') as profile_file:
+                profile_file.write(result)
+            logger.info('profile saved to %s', file_name)
+        except ProfilerBusy as e:
+            logger.warning('profile ignored: %s', e)
+        except Exception as e:
+            logger.error('profile failed: %s', repr(e), exc_info=True)
+
+    def install_signal(self, seconds=SIGNAL_SECONDS, directory=None):
+        """
+        SIGUSR1: sample, SIGUSR2: cProfile, the result is written to directory (default: the temp directory)
+        """
+        directory = directory or tempfile.gettempdir()
+        for sig_name, profile_format in (('SIGUSR1', 'collapsed'), ('SIGUSR2', 'pstats')):
+            sig = getattr(signal, sig_name, None)
+            if sig is None:  # Windows
+                continue
+            try:
+                self.io_loop.add_signal_handler(sig, lambda fmt=profile_format: self.io_loop.create_task(
+                    self._run_to_file(fmt, seconds, directory)))
+            except (NotImplementedError, RuntimeError):
+                pass
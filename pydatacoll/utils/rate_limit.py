@@ -0,0 +1,121 @@
+import asyncio
+import random
+import weakref
+from collections import deque
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('RateLimit')
+
+# 进程内所有设备共享的限流参数: (每秒令牌数, 桶容量)
+BUCKET_PARAM = {
+    'connect': (20, 50),  # 建立TCP连接
+    'interrogation': (5, 10),  # 连接后的总召唤/电能量召唤
+}
+BACKOFF_BASE = 3  # 首次重连等待(秒), 实际等待在[一半, 全部]之间随机
+BACKOFF_CAP = 300  # 最长重连等待(秒)
+
+
+class Backoff(object):
+    """
+    exponential backoff with equal jitter: the n-th delay is uniformly chosen from [d/2, d], d = min(cap, base*2^n),
+    so devices dropped at the same moment drift apart instead of retrying in lockstep
+    """
+    def __init__(self, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+        self.base = base
+        self.cap = cap
+        self.attempts = 0
+        self.delay = 0
+
+    def next_delay(self):
+        ceiling = min(self.cap, self.base * 2 ** min(self.attempts, 32))
+        self.delay = random.uniform(ceiling / 2, ceiling)
+        self.attempts += 1
+        return self.delay
+
+    def reset(self):
+        self.attempts = 0
+        self.delay = 0
+
+
+class TokenBucket(object):
+    """
+    process-wide token bucket, waiters are served in FIFO order as tokens refill
+    """
+    _buckets = weakref.WeakKeyDictionary()  # io_loop -> name -> TokenBucket
+
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, rate, capacity):
+        self.io_loop = io_loop
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_time = io_loop.time()
+        self.waiters = deque()
+        self.wake_handler = None
+        self.granted = 0  # 累计获得令牌次数
+        self.delayed = 0  # 其中需要排队等待的次数
+        self.wait_time = 0  # 累计排队时间(秒)
+        self.max_waiting = 0  # 最大排队数
+
+    @classmethod
+    def of(cls, io_loop: asyncio.AbstractEventLoop, name):
+        buckets = cls._buckets.setdefault(io_loop, dict())
+        bucket = buckets.get(name)
+        if bucket is None:
+            rate, capacity = BUCKET_PARAM[name]
+            bucket = buckets[name] = cls(io_loop, rate, capacity)
+        return bucket
+
+    @classmethod
+    def all_stats(cls, io_loop: asyncio.AbstractEventLoop):
+        return {name: bucket.stats() for name, bucket in cls._buckets.get(io_loop, {}).items()}
+
+    def _refill(self):
+        now = self.io_loop.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_time) * self.rate)
+        self.last_time = now
+
+    def _wakeup(self):
+        self.wake_handler = None
+        self._refill()
+        while self.waiters and self.tokens >= 1:
+            fut = self.waiters.popleft()
+            if not fut.done():
+                self.tokens -= 1
+                fut.set_result(None)
+        if self.waiters:
+            self.wake_handler = self.io_loop.call_later((1 - self.tokens) / self.rate, self._wakeup)
+
+    async def acquire(self):
+        self._refill()
+        if self.tokens >= 1 and not self.waiters:
+            self.tokens -= 1
+            self.granted += 1
+            return
+        fut = asyncio.Future(loop=self.io_loop)
+        self.waiters.append(fut)
+        self.max_waiting = max(self.max_waiting, len(self.waiters))
+        if self.wake_handler is None:
+            self.wake_handler = self.io_loop.call_later((1 - self.tokens) / self.rate, self._wakeup)
+        begin = self.io_loop.time()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut in self.waiters:
+                self.waiters.remove(fut)
+            elif fut.done() and not fut.cancelled():
+                # 已分得令牌, 但在恢复执行前被取消: 归还令牌并唤醒下一个等待者
+                self.tokens = min(self.capacity, self.tokens + 1)
+                if self.waiters:
+                    if self.wake_handler is not None:
+                        self.wake_handler.cancel()
+                    self._wakeup()
+            raise
+        self.granted += 1
+        self.delayed += 1
+        self.wait_time += self.io_loop.time() - begin
+
+    def stats(self):
+        return {'rate': self.rate, 'capacity': self.capacity, 'tokens': int(self.tokens),
+                'waiting': len(self.waiters), 'max_waiting': self.max_waiting,
+                'granted': self.granted, 'delayed': self.delayed, 'wait_time': round(self.wait_time, 3)}
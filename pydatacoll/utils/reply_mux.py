@@ -0,0 +1,106 @@
+import asyncio
+import uuid
+try:
+    import ujson as json
+except ImportError:
+    import json
+import aioredis
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('ReplyDispatcher')
+
+
+class ReplyDispatcher(object):
+    """
+    request-response over redis pub/sub with one long-lived pattern subscription,
+    replies are dispatched to waiting futures by correlation id, so in-flight requests need no extra connections
+    """
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, redis_pool: aioredis.RedisPool, *patterns):
+        self.io_loop = io_loop
+        self.redis_pool = redis_pool
+        self.patterns = patterns
+        self.sub_client = None
+        self.waiters = dict()  # correlation id -> list(Future)
+
+    async def start(self):
+        if self.sub_client is not None:
+            return
+        try:
+            self.sub_client = await self.redis_pool.acquire()
+            channels = await self.sub_client.psubscribe(*self.patterns)
+            for channel in channels:
+                self.io_loop.create_task(self._msg_reader(channel))
+            logger.info('reply dispatcher started, patterns=%s', self.patterns)
+        except Exception as e:
+            logger.error('reply dispatcher start failed: %s', repr(e), exc_info=True)
+
+    async def stop(self):
+        for waiters in self.waiters.values():
+            for fut in waiters:
+                fut.cancel()
+        self.waiters.clear()
+        if self.sub_client is not None:
+            await self.sub_client.punsubscribe(*self.patterns)
+            self.redis_pool.release(self.sub_client)
+            self.sub_client = None
+
+    @staticmethod
+    def new_request_id():
+        return uuid.uuid4().hex
+
+    @staticmethod
+    def correlation_of(channel: str, msg: str):
+        """
+        :param channel: real channel the reply published to
+        :param msg: raw reply message, json with `request_ids` echoed by the responder
+        :return: correlation ids the reply belongs to, fallback to channel name if no request_ids found
+        """
+        try:
+            msg_dict = json.loads(msg)
+            if isinstance(msg_dict, dict) and msg_dict.get('request_ids'):
+                return msg_dict['request_ids']
+        except ValueError:
+            pass
+        return channel,
+
+    def expect(self, correlation_id):
+        fut = asyncio.Future(loop=self.io_loop)
+        self.waiters.setdefault(correlation_id, list()).append(fut)
+        return fut
+
+    def discard(self, correlation_id, fut):
+        waiters = self.waiters.get(correlation_id)
+        if waiters is not None:
+            if fut in waiters:
+                waiters.remove(fut)
+            if not waiters:
+                del self.waiters[correlation_id]
+
+    async def request(self, pub_channel: str, msg: str, correlation_id, timeout):
+        """
+        publish msg to pub_channel, then wait for the reply with correlation_id
+        :return: raw reply message
+        """
+        fut = self.expect(correlation_id)
+        try:
+            with (await self.redis_pool) as redis_client:
+                await redis_client.publish(pub_channel, msg)
+            return await asyncio.wait_for(fut, timeout, loop=self.io_loop)
+        finally:
+            self.discard(correlation_id, fut)
+
+    def dispatch(self, channel: str, msg: str):
+        for correlation_id in self.correlation_of(channel, msg):
+            for fut in self.waiters.pop(correlation_id, ()):
+                if not fut.done():
+                    fut.set_result(msg)
+
+    async def _msg_reader(self, ch):
+        while await ch.wait_message():
+            try:
+                real_channel, msg = await ch.get(encoding='utf-8')
+                self.dispatch(real_channel.decode(), msg)
+            except Exception as e:
+                logger.error('reply dispatcher dispatch failed: %s', repr(e), exc_info=True)
+        logger.debug('reply dispatcher quit msg_reader!')
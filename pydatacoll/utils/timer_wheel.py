@@ -0,0 +1,102 @@
+import asyncio
+import weakref
+
+import pydatacoll.utils.logger as my_logger
+
+logger = my_logger.get_logger('TimerWheel')
+
+TICK = 0.1  # 时间轮精度(秒), 协议定时器均为秒级, 无需更高精度
+SLOTS = 1024  # 一圈覆盖 TICK*SLOTS 秒, 更长的定时器到期时重新放入时间轮
+
+
+class WheelTimer(object):
+    """
+    one re-armable timer owned by a device, start/stop only update the deadline,
+    the timer is moved between buckets only when it must fire earlier than its current bucket
+    """
+    __slots__ = ('wheel', 'callback', 'deadline', 'bucket_tick')
+
+    def __init__(self, wheel, callback):
+        self.wheel = wheel
+        self.callback = callback
+        self.deadline = None
+        self.bucket_tick = None  # 所在桶的tick序号, None表示不在时间轮中
+
+    def start(self, delay):
+        self.deadline = self.wheel.io_loop.time() + delay
+        if self.bucket_tick is None or self.bucket_tick > self.wheel.tick_of(self.deadline):
+            self.wheel.schedule(self)
+
+    def stop(self):
+        self.deadline = None
+
+    @property
+    def active(self):
+        return self.deadline is not None
+
+
+class TimerWheel(object):
+    """
+    hashed timer wheel shared by all devices of one event loop, a single call_later per tick drives every
+    protocol timer, expired buckets are checked lazily against the real deadline and re-armed timers cascade
+    into later buckets instead of being cancelled and recreated
+    """
+    _wheels = weakref.WeakKeyDictionary()
+
+    def __init__(self, io_loop: asyncio.AbstractEventLoop, tick=TICK, slots=SLOTS):
+        self.io_loop = io_loop
+        self.tick = tick
+        self.slots = slots
+        self.buckets = [set() for _ in range(slots)]
+        self.current_tick = self.tick_of(io_loop.time())
+        self.count = 0  # 时间轮中的定时器数
+        self.tick_handler = None
+
+    @classmethod
+    def of(cls, io_loop: asyncio.AbstractEventLoop):
+        wheel = cls._wheels.get(io_loop)
+        if wheel is None:
+            wheel = cls._wheels[io_loop] = cls(io_loop)
+        return wheel
+
+    def timer(self, callback):
+        return WheelTimer(self, callback)
+
+    def tick_of(self, deadline):
+        return int(deadline / self.tick)
+
+    def schedule(self, timer: WheelTimer):
+        if timer.bucket_tick is not None:
+            self.buckets[timer.bucket_tick % self.slots].discard(timer)
+            self.count -= 1
+        bucket_tick = min(max(self.tick_of(timer.deadline), self.current_tick), self.current_tick + self.slots - 1)
+        self.buckets[bucket_tick % self.slots].add(timer)
+        timer.bucket_tick = bucket_tick
+        self.count += 1
+        if self.tick_handler is None:
+            self.tick_handler = self.io_loop.call_later(self.tick, self.on_tick)
+
+    def on_tick(self):
+        self.tick_handler = None
+        now = self.io_loop.time()
+        now_tick = self.tick_of(now)
+        while self.current_tick <= now_tick and self.count:
+            idx = self.current_tick % self.slots
+            bucket, self.buckets[idx] = self.buckets[idx], set()
+            self.current_tick += 1
+            self.count -= len(bucket)
+            for timer in bucket:
+                timer.bucket_tick = None
+                if timer.deadline is None:
+                    continue
+                if timer.deadline > now:
+                    self.schedule(timer)
+                    continue
+                timer.deadline = None
+                try:
+                    timer.callback()
+                except Exception as e:
+                    logger.error('timer callback failed: %s', repr(e), exc_info=True)
+        self.current_tick = max(self.current_tick, now_tick)
+        if self.count and self.tick_handler is None:
+            self.tick_handler = self.io_loop.call_later(self.tick, self.on_tick)
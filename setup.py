@@ -3,7 +3,7 @@ from distutils.core import setup
 setup(
         name='pydatacoll',
         version='0.1',
-        packages=['test', 'test.mock_device', 'pydatacoll', 'pydatacoll.utils', 'pydatacoll.plugins',
+        packages=['test', 'test.mock_device', 'test.benchmark', 'pydatacoll', 'pydatacoll.utils', 'pydatacoll.plugins',
                   'pydatacoll.protocols', 'pydatacoll.protocols.iec104', 'pydatacoll.resources'],
         url='https://github.com/timercrack/pydatacoll',
         license='Apache License V2.0',
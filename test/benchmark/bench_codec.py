@@ -0,0 +1,148 @@
+"""
+CHANNEL:DEVICE_DATA消息编解码性能测试: 逐点JSON与二进制批次(pydatacoll.utils.codec)
+
+    python -m test.benchmark.bench_codec                          # 结果输出到stdout
+    python -m test.benchmark.bench_codec --batch 1,10,100 -o codec.json
+    python -m test.benchmark.bench_codec --baseline old.json      # 与之前的结果比较, 速度下降超过阈值时返回1
+
+每种编码(ENCODINGS)在每个批次大小下分别统计: 发布端编码及订阅端解码的速度(点/秒), 每点字节数, 每批消息数;
+订阅端解码包括还原成插件收到的(channel, data_dict)
+"""
+import argparse
+import datetime
+import platform
+import random
+import sys
+import time
+from collections import OrderedDict
+try:
+    import ujson as json
+except ImportError:
+    import json
+
+from pydatacoll.utils import codec
+from test.benchmark.bench_frame import git_commit
+
+
+def json_encode(device_id, points):
+    return [(codec.DATA_CHANNEL.format(device_id, term_id, item_id), json.dumps({
+        'device_id': device_id, 'term_id': term_id, 'item_id': item_id,
+        'time': data_time.isoformat(), 'value': value})) for term_id, item_id, data_time, value in points]
+
+
+def json_decode(messages):
+    return [(channel.encode(), json.loads(msg)) for channel, msg in messages]
+
+
+def binary_encode(device_id, points):
+    return [(codec.BIN_CHANNEL.format(device_id), codec.encode_batch(device_id, points))]
+
+
+def binary_decode(messages):
+    rst = list()
+    for _, msg in messages:
+        device_id, points = codec.decode_batch(msg)
+        rst.extend(codec.to_message(device_id, point) for point in points)
+    return rst
+
+
+# 编码方式: 名称 -> (发布端编码函数, 订阅端解码函数)
+ENCODINGS = OrderedDict([
+    ('json', (json_encode, json_decode)),
+    ('binary', (binary_encode, binary_decode)),
+])
+
+
+def generate_batches(points, batch_size, seed=104):
+    rnd = random.Random(seed)
+    now = datetime.datetime.now()
+    batches = list()
+    for idx in range(0, points, batch_size):
+        count = min(batch_size, points - idx)
+        batches.append((str(rnd.randint(1, 5000)), [
+            (str(rnd.randint(1, 5000)), str(rnd.randint(1, 100000)),
+             now + datetime.timedelta(microseconds=rnd.randint(0, 10 ** 9)), round(rnd.uniform(-1e4, 1e4), 3))
+            for _ in range(count)]))
+    return batches
+
+
+def bench_encoding(encode, decode, batches, rounds):
+    points = sum(len(points) for _, points in batches)
+    encoded = [encode(device_id, points) for device_id, points in batches]
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        for device_id, batch in batches:
+            encode(device_id, batch)
+    encode_elapsed = time.perf_counter() - begin
+    begin = time.perf_counter()
+    for _ in range(rounds):
+        for messages in encoded:
+            decode(messages)
+    decode_elapsed = time.perf_counter() - begin
+    messages = sum(len(messages) for messages in encoded)
+    return {
+        'encode_pps': round(points * rounds / encode_elapsed) if encode_elapsed else 0,
+        'decode_pps': round(points * rounds / decode_elapsed) if decode_elapsed else 0,
+        'bytes_per_point': round(sum(len(msg) for messages in encoded for _, msg in messages) / points, 2),
+        'messages_per_batch': round(messages / len(batches), 2),
+    }
+
+
+def compare(result, baseline, threshold):
+    """
+    :return: list of regressions whose speed dropped more than threshold (0.1 = 10%)
+    """
+    regressions = list()
+    for batch_size, batch_rst in result['batches'].items():
+        for name, stats in batch_rst.items():
+            base_stats = baseline.get('batches', {}).get(batch_size, {}).get(name)
+            if not base_stats:
+                continue
+            for op in ('encode_pps', 'decode_pps'):
+                if not base_stats.get(op):
+                    continue
+                ratio = stats[op] / base_stats[op]
+                if ratio < 1 - threshold:
+                    regressions.append({'batch': batch_size, 'encoding': name, 'op': op, 'pps': stats[op],
+                                        'baseline_pps': base_stats[op], 'ratio': round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='CHANNEL:DEVICE_DATA codec benchmark')
+    parser.add_argument('--points', type=int, default=20000, help='points per batch size')
+    parser.add_argument('--batch', default='1,10,50,200', help='comma separated batch sizes')
+    parser.add_argument('--seed', type=int, default=104)
+    parser.add_argument('--rounds', type=int, default=3, help='passes over the points')
+    parser.add_argument('--baseline', help='previous result json to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed speed drop against baseline')
+    parser.add_argument('-o', '--output', help='write result json to file')
+    args = parser.parse_args(argv)
+
+    result = {
+        'meta': {'time': datetime.datetime.now().isoformat(), 'commit': git_commit(),
+                 'python': platform.python_version(), 'json': json.__name__,
+                 'points': args.points, 'rounds': args.rounds},
+        'batches': OrderedDict(),
+    }
+    for batch_size in [int(size) for size in args.batch.split(',')]:
+        batches = generate_batches(args.points, batch_size, args.seed)
+        result['batches'][str(batch_size)] = OrderedDict(
+            (name, bench_encoding(encode, decode, batches, args.rounds))
+            for name, (encode, decode) in ENCODINGS.items())
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            result['regressions'] = compare(result, json.load(f), args.threshold)
+        exit_code = 1 if result['regressions'] else 0
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
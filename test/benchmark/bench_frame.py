@@ -0,0 +1,279 @@
+"""
+IEC104帧编解码性能测试
+
+    python -m test.benchmark.bench_frame                          # 生成语料并测试, 结果输出到stdout
+    python -m test.benchmark.bench_frame -o frame.json            # 结果保存为json
+    python -m test.benchmark.bench_frame --recorded frames.txt    # 使用录制的报文, 格式同LST:FRAME: 时间,send/recv,16进制帧
+    python -m test.benchmark.bench_frame --save-corpus frames.txt # 保存生成的语料, 供其他版本复现
+    python -m test.benchmark.bench_frame --baseline old.json      # 与之前的结果比较, 吞吐下降超过阈值时返回1
+
+每种编解码实现(CODECS)分别统计: 总体及每种TYP的解析/组帧速度(帧/秒), 单帧耗时p50/p99(微秒), 每帧内存块数
+"""
+import argparse
+import datetime
+import gc
+import json
+import platform
+import random
+import struct
+import subprocess
+import sys
+import time
+import tracemalloc
+from collections import OrderedDict, defaultdict
+
+import construct
+
+from pydatacoll.protocols.iec104.frame import *
+
+# 编解码实现: 名称 -> (解析函数, 组帧函数), 新增快速路径时在此注册即可一并测试
+CODECS = OrderedDict([
+    ('construct', (iec_104.parse, iec_104.build_isu)),
+])
+
+# 语料中各类报文的比例
+CORPUS_MIX = OrderedDict([
+    ('interrogation', 0.45),  # 总召唤应答: 成组的遥测、遥信
+    ('spontaneous', 0.25),  # 带CP56Time2a时标的变位及突发遥测
+    ('counter', 0.1),  # 电能量召唤应答
+    ('command', 0.05),  # 召唤、读、设定值命令及其确认
+    ('s_frame', 0.1),
+    ('u_frame', 0.05),
+])
+
+
+def _float32(value):
+    return struct.unpack('<f', struct.pack('<f', value))[0]
+
+
+def _value(typ, rnd: random.Random):
+    if typ in (TYP.M_SP_NA_1, TYP.M_SP_TB_1):
+        return rnd.randint(0, 1)
+    if typ in (TYP.M_DP_NA_1, TYP.M_DP_TB_1):
+        return rnd.randint(1, 2)
+    if typ in (TYP.M_ME_NA_1, TYP.M_ME_NB_1):
+        return rnd.randint(0, 65535)
+    if typ in (TYP.M_ME_NC_1, TYP.M_ME_TF_1, TYP.C_SE_NC_1):
+        return _float32(rnd.uniform(-1000, 1000))
+    if typ in (TYP.M_IT_NA_1, TYP.M_IT_TB_1):
+        return rnd.randint(0, 2 ** 32 - 1)
+    return 0
+
+
+def _time(rnd: random.Random):
+    # CP56Time2a只精确到毫秒
+    return datetime.datetime(2016, 1, 1) + datetime.timedelta(milliseconds=rnd.randint(0, 365 * 86400 * 1000))
+
+
+def _i_frame(rnd, typ, cause, count=1, sq=0, address=1):
+    frame = iec_104.init_frame(rnd.randint(0, 32767), rnd.randint(0, 32767), typ, cause, SQ_COUNT=count, SQ=sq)
+    frame.ASDU.StartAddress = address
+    for idx, data in enumerate(frame.ASDU.data):
+        data.Address = address + idx
+        if 'Value' in data:
+            data.Value = _value(typ, rnd)
+        if 'CP56Time2a' in data:
+            data.CP56Time2a = _time(rnd)
+    return iec_104.build_isu(frame)
+
+
+def _interrogation(rnd):
+    typ, sq = rnd.choice([(TYP.M_ME_NC_1, 1), (TYP.M_SP_NA_1, 1), (TYP.M_ME_NB_1, 0), (TYP.M_DP_NA_1, 0)])
+    count = rnd.randint(1, max_objects(typ, sq))
+    return _i_frame(rnd, typ, Cause.introgen, count, sq, rnd.randint(1, 60000))
+
+
+def _spontaneous(rnd):
+    typ = rnd.choice([TYP.M_SP_TB_1, TYP.M_DP_TB_1, TYP.M_ME_TF_1])
+    return _i_frame(rnd, typ, Cause.spont, rnd.choice([1, 1, 1, 2, 4]), 0, rnd.randint(1, 60000))
+
+
+def _counter(rnd):
+    typ = rnd.choice([TYP.M_IT_NA_1, TYP.M_IT_TB_1])
+    count = rnd.randint(1, max_objects(typ) if typ == TYP.M_IT_NA_1 else 8)
+    return _i_frame(rnd, typ, Cause.reqcogen, count, 0, rnd.randint(1, 60000))
+
+
+def _command(rnd):
+    typ = rnd.choice([TYP.C_IC_NA_1, TYP.C_CI_NA_1, TYP.C_RD_NA_1, TYP.C_SE_NC_1, TYP.C_CS_NA_1])
+    return _i_frame(rnd, typ, rnd.choice([Cause.act, Cause.actcon, Cause.actterm]))
+
+
+def _s_frame(rnd):
+    return iec_104.build_isu(iec_104.init_frame("S", rnd.randint(0, 32767)))
+
+
+def _u_frame(rnd):
+    return iec_104.build_isu(iec_104.init_frame(rnd.choice(list(UFrame))))
+
+
+def generate_corpus(size, seed=104):
+    """
+    :return: list of encoded frames, deterministic for the same size and seed
+    """
+    rnd = random.Random(seed)
+    makers = {'interrogation': _interrogation, 'spontaneous': _spontaneous, 'counter': _counter,
+              'command': _command, 's_frame': _s_frame, 'u_frame': _u_frame}
+    corpus = list()
+    while len(corpus) < size:
+        corpus.append(makers[_weighted_choice(rnd, CORPUS_MIX)](rnd))
+    return corpus
+
+
+def _weighted_choice(rnd: random.Random, weights: dict):
+    threshold = rnd.random() * sum(weights.values())
+    for key, weight in weights.items():
+        threshold -= weight
+        if threshold < 0:
+            return key
+    return key
+
+
+def load_recorded(path):
+    """
+    :param path: text file, one frame per line as stored in LST:FRAME:{device_id}: time,send/recv,hex
+    """
+    corpus = list()
+    with open(path) as f:
+        for line in f:
+            parts = line.strip().split(',')
+            if len(parts) == 3:
+                corpus.append(bytes.fromhex(parts[2]))
+    return corpus
+
+
+def save_corpus(path, corpus):
+    now = datetime.datetime.now().isoformat()
+    with open(path, 'w') as f:
+        for frame in corpus:
+            f.write('{},recv,{}\n'.format(now, frame.hex()))
+
+
+def frame_kind(frame):
+    if frame.APCI1 == 'S':
+        return 'S'
+    if isinstance(frame.APCI1, UFrame):
+        return 'U'
+    return frame.ASDU.TYP.name
+
+
+def _percentile(sorted_list, pct):
+    if not sorted_list:
+        return 0
+    return sorted_list[min(len(sorted_list) - 1, int(len(sorted_list) * pct / 100))]
+
+
+def _stats(durations, count, elapsed):
+    durations.sort()
+    return {'frames': count, 'fps': round(count / elapsed) if elapsed else 0,
+            'p50_us': round(_percentile(durations, 50) * 1e6, 2), 'p99_us': round(_percentile(durations, 99) * 1e6, 2)}
+
+
+def bench_codec(parse, build, corpus, rounds):
+    """
+    :return: dict of total and per-TYP statistics for parse and build
+    """
+    parsed = [parse(data) for data in corpus]
+    kinds = [frame_kind(frame) for frame in parsed]
+    rst = {'parse': dict(), 'build': dict(), 'alloc': dict()}
+    for name, func, args in (('parse', parse, corpus), ('build', build, parsed)):
+        per_kind = defaultdict(list)
+        gc.disable()
+        begin = time.perf_counter()
+        for _ in range(rounds):
+            for kind, arg in zip(kinds, args):
+                t0 = time.perf_counter()
+                func(arg)
+                per_kind[kind].append(time.perf_counter() - t0)
+        elapsed = time.perf_counter() - begin
+        gc.enable()
+        all_durations = [duration for durations in per_kind.values() for duration in durations]
+        rst[name]['total'] = _stats(all_durations, len(all_durations), elapsed)
+        rst[name]['per_typ'] = {kind: _stats(durations, len(durations), sum(durations))
+                                for kind, durations in sorted(per_kind.items())}
+    # 每帧内存: 解析结果保留时占用的内存块数, 及解析过程中的峰值内存
+    kind_frames = defaultdict(list)
+    for kind, data in zip(kinds, corpus):
+        kind_frames[kind].append(data)
+    for kind, frames in sorted(kind_frames.items()):
+        gc.collect()
+        tracemalloc.start()
+        blocks = sys.getallocatedblocks()
+        keep = [parse(data) for data in frames]
+        blocks = sys.getallocatedblocks() - blocks
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rst['alloc'][kind] = {'blocks_per_frame': round(blocks / len(frames), 1),
+                              'bytes_per_frame': round(current / len(frames)), 'peak_bytes': peak}
+        del keep
+    return rst
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+        return None
+
+
+def compare(result, baseline, threshold):
+    """
+    :return: list of regressions whose fps dropped more than threshold (0.1 = 10%)
+    """
+    regressions = list()
+    for codec, codec_rst in result['codecs'].items():
+        base_rst = baseline.get('codecs', {}).get(codec)
+        if base_rst is None:
+            continue
+        for name in ('parse', 'build'):
+            for typ, stats in [('total', codec_rst[name]['total'])] + list(codec_rst[name]['per_typ'].items()):
+                base_stats = base_rst[name]['total'] if typ == 'total' else base_rst[name]['per_typ'].get(typ)
+                if not base_stats or not base_stats['fps']:
+                    continue
+                ratio = stats['fps'] / base_stats['fps']
+                if ratio < 1 - threshold:
+                    regressions.append({'codec': codec, 'op': name, 'typ': typ, 'fps': stats['fps'],
+                                        'baseline_fps': base_stats['fps'], 'ratio': round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='IEC104 frame codec benchmark')
+    parser.add_argument('--size', type=int, default=5000, help='generated corpus size')
+    parser.add_argument('--seed', type=int, default=104)
+    parser.add_argument('--rounds', type=int, default=3, help='passes over the corpus')
+    parser.add_argument('--recorded', help='use recorded frames instead of generated corpus')
+    parser.add_argument('--save-corpus', help='save the corpus in recorded format')
+    parser.add_argument('--baseline', help='previous result json to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed fps drop against baseline')
+    parser.add_argument('-o', '--output', help='write result json to file')
+    args = parser.parse_args(argv)
+
+    corpus = load_recorded(args.recorded) if args.recorded else generate_corpus(args.size, args.seed)
+    if args.save_corpus:
+        save_corpus(args.save_corpus, corpus)
+    result = {
+        'meta': {'time': datetime.datetime.now().isoformat(), 'commit': git_commit(),
+                 'python': platform.python_version(), 'construct': construct.__version__,
+                 'corpus': args.recorded or 'generated(size={}, seed={})'.format(args.size, args.seed),
+                 'frames': len(corpus), 'bytes': sum(len(data) for data in corpus), 'rounds': args.rounds},
+        'codecs': OrderedDict((name, bench_codec(parse, build, corpus, args.rounds))
+                              for name, (parse, build) in CODECS.items()),
+    }
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            result['regressions'] = compare(result, json.load(f), args.threshold)
+        exit_code = 1 if result['regressions'] else 0
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
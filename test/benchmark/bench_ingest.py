@@ -0,0 +1,346 @@
+"""
+采集链路端到端性能测试: 模拟从站 -> IEC104Device -> HS:DATA/CHANNEL:DEVICE_DATA -> 插件
+
+    python -m test.benchmark.bench_ingest --count 500 --spont-rate 2 --duration 60
+    python -m test.benchmark.bench_ingest --plugins formula_calc,db_save --formulas 200 -o ingest.json
+    python -m test.benchmark.bench_ingest --baseline old.json --threshold 0.15   # 回退超过阈值时返回1
+    python -m test.benchmark.bench_ingest --redis memory://                      # 使用进程内存储, 不需要redis服务器
+
+运行前会清空--redis指定的db, 然后注册模拟从站(见test.mock_device.fleet)并在本进程中启动DeviceManager及插件,
+从站运行在独立的进程中. 统计内容:
+    throughput: 测量期间CHANNEL:DEVICE_DATA收到的点数/秒, 及从站发出的信息体数/秒
+    latency: 从站时标(突发数据)或主站收到时间(召唤数据)到CHANNEL:DEVICE_DATA收到的时间(毫秒)
+    stages: 各处理阶段耗时p50/p99(毫秒), frame阶段包含process_data
+    loop_lag: 事件循环延迟(毫秒), memory: 本进程RSS
+"""
+import argparse
+import asyncio
+import datetime
+import functools
+import importlib
+import json
+import multiprocessing
+import platform
+import queue
+import resource
+import sys
+import time
+from collections import Counter, defaultdict, OrderedDict
+
+from pydatacoll.plugins.device_manage import DeviceManager
+from pydatacoll.protocols import BaseDevice
+from pydatacoll.protocols.iec104.device import IEC104Device
+from pydatacoll.utils import backend, codec, key_index
+from test.benchmark.bench_frame import git_commit
+from test.mock_device import fleet
+
+PLUGINS = {
+    'formula_calc': ('pydatacoll.plugins.formula_calc', 'FormulaCalc'),
+    'db_save': ('pydatacoll.plugins.db_save', 'DBSaver'),
+}
+FORMULA_DEVICE_ID = 0  # 公式结果写入的设备id, 不与模拟从站冲突
+LAG_INTERVAL = 0.1  # 事件循环延迟采样间隔(秒)
+CONNECT_TIME_OUT = 60  # 等待全部从站连上的最长时间(秒)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='end-to-end ingest benchmark')
+    parser.add_argument('--count', type=int, default=100, help='simulated outstations')
+    parser.add_argument('--processes', type=int, default=1, help='fleet worker processes')
+    parser.add_argument('--points', type=int, default=100)
+    parser.add_argument('--spont-rate', type=float, default=1, help='spontaneous events per second per outstation')
+    parser.add_argument('--latency', type=float, default=0, help='outstation response latency in milliseconds')
+    parser.add_argument('--interrogation-interval', type=float, default=60)
+    parser.add_argument('--base-port', type=int, default=20000)
+    parser.add_argument('--plugins', default='', help='comma separated plugins besides DeviceManager: ' +
+                                                      ','.join(sorted(PLUGINS)))
+    parser.add_argument('--formulas', type=int, default=0, help='formulas registered for FormulaCalc')
+    parser.add_argument('--pool-size', type=int, default=10, help='redis pool maxsize')
+    parser.add_argument('--warmup', type=float, default=10, help='seconds after all outstations connected')
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds')
+    parser.add_argument('--redis', default=backend.current_url(), help='redis url, memory:// for in-process store')
+    parser.add_argument('--baseline', help='previous result json to compare with')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative regression against baseline')
+    parser.add_argument('-o', '--output', help='write result json to file')
+    return parser.parse_args(argv)
+
+
+def percentiles(values, scale=1000):
+    values = sorted(values)
+    if not values:
+        return {'count': 0, 'p50': 0, 'p99': 0, 'max': 0}
+
+    def pick(pct):
+        return round(values[min(len(values) - 1, int(len(values) * pct / 100))] * scale, 3)
+    return {'count': len(values), 'p50': pick(50), 'p99': pick(99), 'max': round(values[-1] * scale, 3)}
+
+
+def rss_bytes():
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class StageTimer(object):
+    """
+    wraps coroutine methods on their classes to record durations per stage, `measuring` gates the recording
+    so warmup is excluded, `restore` puts the original methods back
+    """
+    def __init__(self):
+        self.durations = defaultdict(list)
+        self.measuring = False
+        self.originals = list()
+
+    def wrap(self, cls, name, stage):
+        original = getattr(cls, name)
+
+        @functools.wraps(original)
+        async def timed(*args, **kwargs):
+            begin = time.perf_counter()
+            try:
+                return await original(*args, **kwargs)
+            finally:
+                if self.measuring:
+                    self.durations[stage].append(time.perf_counter() - begin)
+        setattr(cls, name, timed)
+        self.originals.append((cls, name, original))
+
+    def restore(self):
+        for cls, name, original in reversed(self.originals):
+            setattr(cls, name, original)
+        self.originals.clear()
+
+    def stats(self):
+        return OrderedDict((stage, percentiles(durations)) for stage, durations in sorted(self.durations.items()))
+
+
+def prepare_redis(args, fleet_args):
+    redis_client = backend.sync_client()
+    redis_client.flushdb()
+    fleet.register(fleet_args, redis_client)
+    pipe = redis_client.pipeline(transaction=False)
+    for idx in range(args.count):
+        pipe.hset('HS:DEVICE:{}'.format(fleet.device_id_of(fleet_args, idx)), 'interrogation_interval',
+                  args.interrogation_interval)
+    # 每个公式引用两个不同从站的同一遥测点
+    for formula_id in range(1, args.formulas + 1):
+        address = (formula_id - 1) % max(1, args.points - int(args.points * fleet_args.sp_ratio)) + 1
+        params = ['{0}:{0}:{1}'.format(fleet.device_id_of(fleet_args, (formula_id + offset) % args.count),
+                                       fleet.ITEM_BASE + address) for offset in (0, 1)]
+        pipe.hmset('HS:FORMULA:{}'.format(formula_id), {
+            'id': formula_id, 'formula': 'p1+p2', 'device_id': FORMULA_DEVICE_ID, 'term_id': FORMULA_DEVICE_ID,
+            'item_id': formula_id, 'p1': params[0], 'p2': params[1]})
+        pipe.sadd('SET:FORMULA', formula_id)
+        for param in params:
+            pipe.sadd('SET:FORMULA_PARAM:{}'.format(param), formula_id)
+        key_index.add_data(pipe, FORMULA_DEVICE_ID, FORMULA_DEVICE_ID, formula_id)
+    pipe.execute()
+
+
+class Probe(object):
+    """
+    subscribes CHANNEL:DEVICE_DATA:* and its binary batches on its own connection,
+    counts points and measures their latency
+    """
+    def __init__(self, io_loop: asyncio.AbstractEventLoop):
+        self.io_loop = io_loop
+        self.measuring = False
+        self.points = 0
+        self.formula_points = 0
+        self.latencies = list()
+        self.lags = list()
+        self.duplicates = codec.DuplicateFilter()
+        self.pool = None
+        self.conn = None
+        self.lag_task = None
+
+    async def start(self):
+        self.pool = await backend.create_pool(self.io_loop, minsize=1, maxsize=1)
+        self.conn = await self.pool.acquire()
+        for channel in await self.conn.psubscribe(codec.DATA_PATTERN, codec.BIN_PATTERN):
+            self.io_loop.create_task(self.read(channel))
+        self.lag_task = self.io_loop.create_task(self.sample_lag())
+
+    def count(self, device_id, data_time):
+        if not self.measuring:
+            return
+        if str(device_id) == str(FORMULA_DEVICE_ID):
+            self.formula_points += 1
+            return
+        self.points += 1
+        self.latencies.append((datetime.datetime.now() - data_time).total_seconds())
+
+    async def read(self, channel):
+        binary = channel.name.decode() == codec.BIN_PATTERN
+        while await channel.wait_message():
+            real_channel, msg = await channel.get()
+            if binary:
+                device_id, points = codec.decode_batch(msg)
+                for point in points:
+                    data_channel, data_dict = codec.to_message(device_id, point)
+                    if self.duplicates.first(data_channel, data_dict['time'], True):
+                        self.count(device_id, point[2])
+                continue
+            msg = json.loads(msg.decode('utf-8'))
+            if not self.duplicates.first(real_channel, msg['time'], False):
+                continue
+            data_time = datetime.datetime.strptime(msg['time'][:26], '%Y-%m-%dT%H:%M:%S.%f') \
+                if '.' in msg['time'] else datetime.datetime.strptime(msg['time'], '%Y-%m-%dT%H:%M:%S')
+            self.count(msg['device_id'], data_time)
+
+    async def sample_lag(self):
+        while True:
+            begin = self.io_loop.time()
+            await asyncio.sleep(LAG_INTERVAL, loop=self.io_loop)
+            if self.measuring:
+                self.lags.append(max(0, self.io_loop.time() - begin - LAG_INTERVAL))
+
+    async def stop(self):
+        if self.lag_task is not None:
+            self.lag_task.cancel()
+        if self.conn is not None:
+            await self.conn.punsubscribe(codec.DATA_PATTERN, codec.BIN_PATTERN)
+            self.pool.release(self.conn)
+            await self.pool.clear()
+
+
+def fleet_totals(report_queue, latest):
+    while True:
+        try:
+            pid, stats = report_queue.get_nowait()
+            latest[pid] = stats
+        except queue.Empty:
+            break
+    return sum((Counter(stats) for stats in latest.values()), Counter())
+
+
+async def wait_connected(device_manager, count, io_loop):
+    begin = io_loop.time()
+    while io_loop.time() - begin < CONNECT_TIME_OUT:
+        if device_manager.connect_stats()['connected'] >= count:
+            return True
+        await asyncio.sleep(0.5, loop=io_loop)
+    return False
+
+
+def run(args):
+    fleet_args = fleet.parse_args([
+        '--count', str(args.count), '--points', str(args.points), '--spont-rate', str(args.spont_rate),
+        '--latency', str(args.latency), '--base-port', str(args.base_port), '--report', '1'])
+    backend.configure(args.redis)
+    prepare_redis(args, fleet_args)
+    report_queue = multiprocessing.Queue()
+    workers = [multiprocessing.Process(target=fleet.run_worker, daemon=True,
+                                       args=(fleet_args, range(idx, args.count, args.processes), report_queue))
+               for idx in range(args.processes)]
+    for worker in workers:
+        worker.start()
+
+    io_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(io_loop)
+    timer = StageTimer()
+    timer.wrap(IEC104Device, 'handle_i', 'frame')
+    timer.wrap(BaseDevice, 'process_data', 'process_data')
+    modules = list()
+    latest = dict()
+    try:
+        redis_pool = io_loop.run_until_complete(backend.create_pool(io_loop, maxsize=args.pool_size))
+        for name in filter(None, args.plugins.split(',')):
+            module_name, class_name = PLUGINS[name]
+            plugin_class = getattr(importlib.import_module(module_name), class_name)
+            # 包装后的方法保留param_function设置的属性, 插件实例化时照常注册频道
+            for fun_name in dir(plugin_class):
+                if getattr(getattr(plugin_class, fun_name), 'arg_channel', '').startswith('CHANNEL:DEVICE_DATA'):
+                    timer.wrap(plugin_class, fun_name, '{}.{}'.format(class_name, fun_name))
+            modules.append(plugin_class(io_loop, redis_pool))
+        device_manager = DeviceManager(io_loop, redis_pool)
+        modules.insert(0, device_manager)
+        probe = Probe(io_loop)
+        io_loop.run_until_complete(probe.start())
+        memory_begin = rss_bytes()
+        for module in modules:
+            io_loop.run_until_complete(module.install())
+        connect_begin = time.time()
+        connected = io_loop.run_until_complete(wait_connected(device_manager, args.count, io_loop))
+        connect_time = time.time() - connect_begin
+        io_loop.run_until_complete(asyncio.sleep(args.warmup, loop=io_loop))
+
+        fleet_begin = fleet_totals(report_queue, latest)
+        probe.measuring = timer.measuring = True
+        begin = time.time()
+        memory_peak = rss_bytes()
+        while time.time() - begin < args.duration:
+            io_loop.run_until_complete(asyncio.sleep(min(1, args.duration - (time.time() - begin)), loop=io_loop))
+            memory_peak = max(memory_peak, rss_bytes())
+        elapsed = time.time() - begin
+        probe.measuring = timer.measuring = False
+        fleet_end = fleet_totals(report_queue, latest)
+
+        result = OrderedDict([
+            ('meta', {'time': datetime.datetime.now().isoformat(), 'commit': git_commit(),
+                      'python': platform.python_version(), 'args': vars(args)}),
+            ('connect', {'all_connected': connected, 'seconds': round(connect_time, 3),
+                         'stats': device_manager.connect_stats()}),
+            ('throughput', {
+                'points_per_sec': round(probe.points / elapsed, 1),
+                'formula_points_per_sec': round(probe.formula_points / elapsed, 1),
+                'objects_sent_per_sec': round((fleet_end['objects_sent'] - fleet_begin['objects_sent']) / elapsed, 1),
+                'frames_sent_per_sec': round((fleet_end['frames_sent'] - fleet_begin['frames_sent']) / elapsed, 1)}),
+            ('latency', percentiles(probe.latencies)),
+            ('stages', timer.stats()),
+            ('loop_lag', percentiles(probe.lags)),
+            ('memory', {'rss_begin': memory_begin, 'rss_peak': memory_peak, 'rss_end': rss_bytes()}),
+        ])
+        for module in reversed(modules):
+            io_loop.run_until_complete(module.uninstall())
+        io_loop.run_until_complete(probe.stop())
+        io_loop.run_until_complete(asyncio.sleep(0.5, loop=io_loop))  # 等待订阅读取任务退出
+        return result
+    finally:
+        timer.restore()
+        for worker in workers:
+            worker.terminate()
+        io_loop.close()
+
+
+def compare(result, baseline, threshold):
+    """
+    :return: list of regressions: throughput dropped or p99 latency grew more than threshold (0.1 = 10%)
+    """
+    regressions = list()
+    checks = [('throughput', 'points_per_sec', True), ('latency', 'p99', False), ('loop_lag', 'p99', False)]
+    checks += [('stages', stage, False) for stage in result['stages']]
+    for section, key, higher_better in checks:
+        value, base = result[section].get(key), baseline.get(section, {}).get(key)
+        if section == 'stages':
+            value, base = value and value['p99'], base and base['p99']
+        if not value or not base:
+            continue
+        ratio = value / base
+        if (higher_better and ratio < 1 - threshold) or (not higher_better and ratio > 1 + threshold):
+            regressions.append({'metric': '{}.{}'.format(section, key), 'value': value, 'baseline': base,
+                                'ratio': round(ratio, 3)})
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    result = run(args)
+    exit_code = 0
+    if args.baseline:
+        with open(args.baseline) as f:
+            result['regressions'] = compare(result, json.load(f), args.threshold)
+        exit_code = 1 if result['regressions'] else 0
+    output = json.dumps(result, indent=2)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    return exit_code
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,452 @@
+"""
+模拟大量104从站, 用于在单机上测试DeviceManager及插件的采集吞吐
+
+    python -m test.mock_device.fleet --count 2000 --processes 4 --register    # 2000个从站, 监听20000~21999端口
+    python -m test.mock_device.fleet --count 500 --unix-dir /tmp/fleet        # 使用unix socket
+    python -m test.mock_device.fleet --points 500 --spont-rate 2 --latency 20 --drop-rate 0.001
+
+每个从站:
+    遥测(M_ME_NC_1)和遥信(M_SP_NA_1)共points个点, 地址从1开始, 其后为counters个电能量(M_IT_NA_1)
+    总召唤/分组召唤按objects个信息体一帧应答, 分组召唤返回 (地址-1)%16 == 组号-1 的点
+    每秒平均spont-rate次突发变位(M_ME_TF_1/M_SP_TB_1), 间隔服从指数分布
+    应答延迟latency毫秒, 发送遵守K/W窗口
+    故障注入(每个从站每秒发生的概率):
+        drop: 直接断开TCP连接
+        stopdt: 停止数据传输且不再应答任何报文(如同收到STOPDT), 直到主站超时断开
+        seq_error: 下一个I帧的发送序号跳过一个, 主站应检测到序号错误并重连
+--register 将从站写入redis(设备、终端、指标及104映射), 设备id从first-id开始, 每个从站一个终端, 终端id与设备id相同
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import queue
+import random
+import time
+from collections import Counter, deque
+
+import pydatacoll.utils.logger as my_logger
+from pydatacoll.protocols.iec104.frame import *
+from pydatacoll.utils import key_index
+
+logger = my_logger.get_logger('MockFleet')
+
+FAULTS = ('drop', 'stopdt', 'seq_error')
+FAULT_TICK = 1  # 故障注入检查间隔(秒)
+ITEM_BASE = 100000  # 注册到redis的指标id = ITEM_BASE + 信息体地址, 避免与已有指标冲突
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='simulated IEC104 outstation fleet')
+    parser.add_argument('--count', type=int, default=100, help='number of outstations')
+    parser.add_argument('--processes', type=int, default=1, help='worker processes')
+    parser.add_argument('--first-id', type=int, default=1001, help='device id of the first outstation')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--base-port', type=int, default=20000, help='port of the first outstation')
+    parser.add_argument('--unix-dir', help='listen on unix sockets in this directory instead of tcp ports')
+    parser.add_argument('--points', type=int, default=100, help='measured and single points per outstation')
+    parser.add_argument('--sp-ratio', type=float, default=0.2, help='share of single points in points')
+    parser.add_argument('--counters', type=int, default=16, help='integrated totals per outstation')
+    parser.add_argument('--objects', type=int, default=0,
+                        help='information objects per interrogation ASDU, 0 = as many as fit in one APDU')
+    parser.add_argument('--spont-rate', type=float, default=0.2, help='spontaneous events per second per outstation')
+    parser.add_argument('--latency', type=float, default=0, help='response latency in milliseconds')
+    parser.add_argument('--drop-rate', type=float, default=0)
+    parser.add_argument('--stopdt-rate', type=float, default=0)
+    parser.add_argument('--seq-error-rate', type=float, default=0)
+    parser.add_argument('--report', type=float, default=5, help='statistics report interval in seconds')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--register', action='store_true', help='write the fleet into redis')
+    parser.add_argument('--redis-host', default='127.0.0.1')
+    parser.add_argument('--redis-port', type=int, default=6379)
+    parser.add_argument('--redis-db', type=int, default=1)
+    return parser.parse_args(argv)
+
+
+def device_id_of(args, idx):
+    return args.first_id + idx
+
+
+def unix_path(args, idx):
+    return os.path.join(args.unix_dir, 'iec104_{}.sock'.format(device_id_of(args, idx)))
+
+
+def point_type(args, address):
+    """
+    :return: TYP of the point at `address`
+    """
+    sp_count = int(args.points * args.sp_ratio)
+    if address <= args.points - sp_count:
+        return TYP.M_ME_NC_1
+    if address <= args.points:
+        return TYP.M_SP_NA_1
+    return TYP.M_IT_NA_1
+
+
+def register(args, redis_client=None):
+    """
+    write devices, terms, items and HS:MAPPING:IEC104 of the fleet into redis
+    """
+    if redis_client is None:
+        import redis
+        redis_client = redis.StrictRedis(host=args.redis_host, port=args.redis_port, db=args.redis_db,
+                                         decode_responses=True)
+    pipe = redis_client.pipeline(transaction=False)
+    addresses = range(1, args.points + args.counters + 1)
+    for address in addresses:
+        item_id = ITEM_BASE + address
+        pipe.hmset('HS:ITEM:{}'.format(item_id), {
+            'id': item_id, 'name': 'fleet{}'.format(address), 'view_code': item_id,
+            'func_type': '遥测量' if point_type(args, address) != TYP.M_SP_NA_1 else '遥信量'})
+    pipe.sadd('SET:ITEM', *[ITEM_BASE + address for address in addresses])
+    for idx in range(args.count):
+        device_id = device_id_of(args, idx)
+        device = {'id': device_id, 'name': 'fleet{}'.format(device_id), 'status': 'on', 'protocol': 'iec104',
+                  'identify': device_id}
+        if args.unix_dir:
+            device['unix_socket'] = unix_path(args, idx)
+        else:
+            device.update(ip=args.host, port=args.base_port + idx)
+        pipe.hmset('HS:DEVICE:{}'.format(device_id), device)
+        pipe.sadd('SET:DEVICE', device_id)
+        pipe.hmset('HS:TERM:{}'.format(device_id), {
+            'id': device_id, 'name': 'fleet{}'.format(device_id), 'address': device_id, 'identify': device_id,
+            'protocol': 'iec104', 'device_id': device_id})
+        pipe.sadd('SET:TERM', device_id)
+        pipe.sadd('SET:DEVICE_TERM:{}'.format(device_id), device_id)
+        pipe.sadd('SET:TERM_ITEM:{}'.format(device_id), *[ITEM_BASE + address for address in addresses])
+        for address in addresses:
+            term_item = {'id': '{}:{}'.format(device_id, address), 'term_id': device_id,
+                         'item_id': ITEM_BASE + address, 'protocol_code': address,
+                         'code_type': point_type(args, address).value, 'base_val': 0, 'coefficient': 1}
+            mapping_key = 'HS:MAPPING:IEC104:{}:{}'.format(device_id, address)
+            pipe.hmset('HS:TERM_ITEM:{}:{}'.format(device_id, ITEM_BASE + address), term_item)
+            pipe.hmset(mapping_key, term_item)
+            key_index.add_term_item(pipe, device_id, device_id, ITEM_BASE + address, mapping_key)
+        pipe.execute()
+    pipe.execute()
+    logger.info('registered %s devices', args.count)
+
+
+class Outstation(asyncio.Protocol):
+    def __init__(self, device_id, args, stats: Counter, io_loop: asyncio.AbstractEventLoop):
+        self.device_id = device_id
+        self.args = args
+        self.stats = stats
+        self.io_loop = io_loop
+        self.random = random.Random(None if args.seed is None else args.seed + device_id)
+        self.values = {address: self.random_value(point_type(args, address))
+                       for address in range(1, args.points + args.counters + 1)}
+        self.transport = None
+        self.buffer = bytearray()
+        self.ssn = 0
+        self.rsn = 0
+        self.ack = 0  # 主站已确认的发送序号
+        self.w = 0
+        self.started = False
+        self.stalled = False
+        self.skip_ssn = False
+        self.send_queue = deque()
+        self.spont_handler = None
+        self.fault_handler = None
+
+    def random_value(self, typ):
+        if typ == TYP.M_SP_NA_1:
+            return self.random.randint(0, 1)
+        if typ == TYP.M_IT_NA_1:
+            return self.random.randint(0, 1000000)
+        return round(self.random.uniform(0, 1000), 2)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.buffer.clear()
+        self.ssn = self.rsn = self.ack = self.w = 0
+        self.started = self.stalled = self.skip_ssn = False
+        self.send_queue.clear()
+        self.stats['connections'] += 1
+        self.stats['connected'] += 1
+        if any((self.args.drop_rate, self.args.stopdt_rate, self.args.seq_error_rate)):
+            self.fault_handler = self.io_loop.call_later(FAULT_TICK, self.on_fault_tick)
+
+    def connection_lost(self, exc):
+        self.stats['connected'] -= 1
+        self.transport = None
+        self.started = False
+        for handler in (self.spont_handler, self.fault_handler):
+            if handler:
+                handler.cancel()
+        self.spont_handler = self.fault_handler = None
+
+    def data_received(self, data):
+        # 主站可能在一次写入中连续发送多帧
+        self.buffer.extend(data)
+        while len(self.buffer) >= 2 and len(self.buffer) >= self.buffer[1] + 2:
+            frame_data = bytes(self.buffer[:self.buffer[1] + 2])
+            del self.buffer[:len(frame_data)]
+            if not self.stalled:
+                self.frame_received(frame_data)
+
+    def frame_received(self, data):
+        try:
+            frame = iec_104.parse(data)
+            self.stats['frames_recv'] += 1
+            if isinstance(frame.APCI1, UFrame):
+                self.handle_u(frame)
+                return
+            self.ack = frame.APCI2
+            if frame.APCI1 != 'S':
+                self.rsn = (self.rsn + 1) % 32768
+                self.w += 1
+                self.handle_i(frame)
+                if self.w >= IECParam.W:
+                    self.write([iec_104.build_isu(iec_104.init_frame("S", self.rsn))])
+                    self.w = 0
+            self.flush()
+        except Exception as e:
+            logger.error("device[%s] receive failed: %s", self.device_id, repr(e), exc_info=True)
+
+    def handle_u(self, frame):
+        if frame.APCI1 == UFrame.STARTDT_ACT:
+            self.write([iec_104.build_isu(iec_104.init_frame(UFrame.STARTDT_CON))])
+            self.started = True
+            self.schedule_spont()
+        elif frame.APCI1 == UFrame.STOPDT_ACT:
+            self.write([iec_104.build_isu(iec_104.init_frame(UFrame.STOPDT_CON))])
+            self.started = False
+        elif frame.APCI1 == UFrame.TESTFR_ACT:
+            self.write([iec_104.build_isu(iec_104.init_frame(UFrame.TESTFR_CON))])
+
+    def handle_i(self, frame):
+        typ, cause = frame.ASDU.TYP, frame.ASDU.Cause
+        if cause != Cause.act:
+            return
+        frame.ASDU.Cause = Cause.actcon
+        responses = [frame]
+        if typ == TYP.C_IC_NA_1:
+            qoi = frame.ASDU.data[0].QOI
+            group = qoi - 20 if 21 <= qoi <= 36 else None
+            addresses = [address for address in range(1, self.args.points + 1)
+                         if group is None or (address - 1) % 16 == group - 1]
+            responses.extend(self.data_frames(addresses, Cause(qoi) if group else Cause.introgen))
+            responses.append(self.confirm(frame, Cause.actterm))
+            self.stats['interrogations'] += 1
+        elif typ == TYP.C_CI_NA_1:
+            rqt = frame.ASDU.data[0].RQT
+            group = rqt if 1 <= rqt <= 4 else None
+            addresses = [address for address in range(self.args.points + 1, self.args.points + self.args.counters + 1)
+                         if group is None or (address - 1) % 4 == group - 1]
+            responses.extend(self.data_frames(addresses, Cause(37 + group) if group else Cause.reqcogen))
+            responses.append(self.confirm(frame, Cause.actterm))
+            self.stats['interrogations'] += 1
+        elif typ == TYP.C_RD_NA_1:
+            address = frame.ASDU.data[0].Address
+            responses = self.data_frames([address], Cause.req) if address in self.values else []
+        self.respond(responses)
+
+    @staticmethod
+    def confirm(frame, cause):
+        confirm = iec_104.init_frame(0, 0, frame.ASDU.TYP, cause)
+        confirm.ASDU.data = frame.ASDU.data
+        return confirm
+
+    def data_frames(self, addresses, cause):
+        frames = list()
+        by_type = dict()
+        for address in addresses:
+            by_type.setdefault(point_type(self.args, address), list()).append(address)
+        for typ, typ_addresses in sorted(by_type.items()):
+            sq = 0 if typ == TYP.M_IT_NA_1 else 1
+            limit = max_objects(typ, sq)
+            if self.args.objects:
+                limit = min(limit, self.args.objects)
+            # SQ=1时同一帧内的地址必须连续
+            chunk = list()
+            for address in typ_addresses + [None]:
+                if chunk and (address is None or len(chunk) >= limit or sq and address != chunk[-1] + 1):
+                    frame = iec_104.init_frame(0, 0, typ, cause, SQ_COUNT=len(chunk), SQ=sq)
+                    frame.ASDU.StartAddress = chunk[0]
+                    for data, data_address in zip(frame.ASDU.data, chunk):
+                        data.Address = data_address
+                        data.Value = self.values[data_address]
+                    frames.append(frame)
+                    self.stats['objects_sent'] += len(chunk)
+                    chunk = list()
+                if address is not None:
+                    chunk.append(address)
+        return frames
+
+    def schedule_spont(self):
+        if self.args.spont_rate > 0 and self.spont_handler is None:
+            self.spont_handler = self.io_loop.call_later(self.random.expovariate(self.args.spont_rate),
+                                                         self.on_spont)
+
+    def on_spont(self):
+        self.spont_handler = None
+        if not self.started or self.stalled or not self.args.points:
+            return
+        address = self.random.randint(1, self.args.points)
+        typ = point_type(self.args, address)
+        self.values[address] = 1 - self.values[address] if typ == TYP.M_SP_NA_1 else self.random_value(typ)
+        frame = iec_104.init_frame(0, 0, TYP.M_SP_TB_1 if typ == TYP.M_SP_NA_1 else TYP.M_ME_TF_1, Cause.spont)
+        frame.ASDU.StartAddress = address
+        frame.ASDU.data[0].Address = address
+        frame.ASDU.data[0].Value = self.values[address]
+        frame.ASDU.data[0].CP56Time2a = datetime.datetime.now()
+        self.stats['spont_events'] += 1
+        self.stats['objects_sent'] += 1
+        self.respond([frame])
+        self.schedule_spont()
+
+    def on_fault_tick(self):
+        self.fault_handler = None
+        if self.transport is None:
+            return
+        args = self.args
+        if self.random.random() < args.drop_rate:
+            self.stats['fault_drop'] += 1
+            self.transport.abort()
+            return
+        if not self.stalled and self.random.random() < args.stopdt_rate:
+            self.stats['fault_stopdt'] += 1
+            self.stalled = True
+            self.send_queue.clear()
+        if self.random.random() < args.seq_error_rate:
+            self.stats['fault_seq_error'] += 1
+            self.skip_ssn = True
+        self.fault_handler = self.io_loop.call_later(FAULT_TICK, self.on_fault_tick)
+
+    def respond(self, frames):
+        if not frames:
+            return
+        if self.args.latency > 0:
+            self.io_loop.call_later(self.args.latency / 1000, self.enqueue, frames)
+        else:
+            self.enqueue(frames)
+
+    def enqueue(self, frames):
+        if self.transport is None or self.stalled:
+            return
+        self.send_queue.extend(frames)
+        self.flush()
+
+    def flush(self):
+        """
+        send queued I frames while the count of unconfirmed frames is below K
+        """
+        if not self.started or self.stalled:
+            return
+        encode_list = list()
+        while self.send_queue and (self.ssn - self.ack) % 32768 < IECParam.K:
+            frame = self.send_queue.popleft()
+            if self.skip_ssn:
+                self.ssn = (self.ssn + 1) % 32768
+                self.skip_ssn = False
+            frame.APCI1 = self.ssn
+            frame.APCI2 = self.rsn
+            encode_list.append(iec_104.build_isu(frame))
+            self.ssn = (self.ssn + 1) % 32768
+        if encode_list:
+            self.w = 0
+            self.write(encode_list)
+
+    def write(self, encode_list):
+        if self.transport is None:
+            return
+        self.transport.write(b''.join(encode_list))
+        self.stats['frames_sent'] += len(encode_list)
+        self.stats['bytes_sent'] += sum(len(data) for data in encode_list)
+
+
+async def start_servers(args, indices, io_loop: asyncio.AbstractEventLoop, stats: Counter):
+    """
+    listen for the outstations in `indices`, each listening socket accepts connections into its own Outstation
+    :return: list of servers
+    """
+    servers = list()
+    for idx in indices:
+        outstation = Outstation(device_id_of(args, idx), args, stats, io_loop)
+        if args.unix_dir:
+            path = unix_path(args, idx)
+            if os.path.exists(path):
+                os.unlink(path)
+            servers.append(await io_loop.create_unix_server(lambda o=outstation: o, path))
+        else:
+            servers.append(await io_loop.create_server(
+                lambda o=outstation: o, args.host, args.base_port + idx, reuse_address=True))
+    return servers
+
+
+def raise_fd_limit():
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft < hard:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError) as e:
+        logger.warning('raise fd limit failed: %s', repr(e))
+
+
+def run_worker(args, indices, report_queue):
+    raise_fd_limit()
+    io_loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(io_loop)
+    stats = Counter()
+    servers = io_loop.run_until_complete(start_servers(args, indices, io_loop, stats))
+    logger.info('worker[%s] listening for %s outstations', os.getpid(), len(servers))
+
+    def report():
+        report_queue.put((os.getpid(), dict(stats)))
+        io_loop.call_later(args.report, report)
+    io_loop.call_later(args.report, report)
+    try:
+        io_loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for server in servers:
+            server.close()
+        io_loop.close()
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.unix_dir:
+        os.makedirs(args.unix_dir, exist_ok=True)
+    if args.register:
+        register(args)
+    report_queue = multiprocessing.Queue()
+    workers = list()
+    for worker_idx in range(args.processes):
+        indices = range(worker_idx, args.count, args.processes)
+        worker = multiprocessing.Process(target=run_worker, args=(args, indices, report_queue), daemon=True)
+        worker.start()
+        workers.append(worker)
+    latest = dict()
+    last_total, last_time = Counter(), time.time()
+    try:
+        while any(worker.is_alive() for worker in workers):
+            try:
+                pid, stats = report_queue.get(timeout=args.report)
+                latest[pid] = stats
+            except queue.Empty:
+                continue
+            if len(latest) < len(workers) and time.time() - last_time < args.report * 2:
+                continue
+            total = sum((Counter(stats) for stats in latest.values()), Counter())
+            now = time.time()
+            elapsed = now - last_time or 1
+            logger.info('connected=%s frames_sent=%.0f/s objects_sent=%.0f/s frames_recv=%.0f/s totals=%s',
+                        total['connected'], (total['frames_sent'] - last_total['frames_sent']) / elapsed,
+                        (total['objects_sent'] - last_total['objects_sent']) / elapsed,
+                        (total['frames_recv'] - last_total['frames_recv']) / elapsed, dict(total))
+            last_total, last_time = total, now
+            latest.clear()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for worker in workers:
+            worker.terminate()
+
+
+if __name__ == '__main__':
+    main()
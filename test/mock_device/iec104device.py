@@ -1,8 +1,8 @@
 import asyncio
 from collections import defaultdict
 from collections import deque
-import redis
 
+from pydatacoll.utils import backend
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.protocols.iec104.frame import *
 from . import mock_data
@@ -32,12 +32,13 @@ class IEC104Device(asyncio.Protocol):
         self.task_handler = None
         self.transport = None
         self.device_id = None
+        self.buffer = bytearray()
         logger.info('mock device server start!')
 
     def connection_made(self, transport):
         self.device_id = transport.get_extra_info('sockname')[1] - 2403
         self.io_loop = asyncio.get_event_loop()
-        self.redis = redis.StrictRedis(db=1, decode_responses=True)
+        self.redis = backend.sync_client()
         self.device_info = self.redis.hgetall('HS:DEVICE:{}'.format(self.device_id))
         logger.info('connect from %s, device_info=%s, id=%s',
                      transport.get_extra_info('peername'), self.device_info, self.device_id)
@@ -89,6 +90,14 @@ class IEC104Device(asyncio.Protocol):
         self.send_frame(iec_104.init_frame(UFrame.TESTFR_ACT))
 
     def data_received(self, data):
+        # 主站可能在一次写入中连续发送多帧
+        self.buffer.extend(data)
+        while len(self.buffer) >= 2 and len(self.buffer) >= self.buffer[1] + 2:
+            frame_data = bytes(self.buffer[:self.buffer[1] + 2])
+            del self.buffer[:len(frame_data)]
+            self.frame_received(frame_data)
+
+    def frame_received(self, data):
         try:
             self.start_timer(IECParam.T3)
             logger.debug("device[%s] recv: %s", self.device_id, data.hex())
@@ -165,7 +174,7 @@ class IEC104Device(asyncio.Protocol):
                 send_data = frame
                 send_data.ASDU.Cause = Cause.actcon
                 self.send_frame(send_data)
-                self.begin_C_IC_NA_1()
+                self.begin_C_IC_NA_1(frame.ASDU.data[0].QOI)
                 send_data.ASDU.Cause = Cause.actterm
                 self.send_frame(send_data)
             # 电能脉冲召唤命令
@@ -173,7 +182,7 @@ class IEC104Device(asyncio.Protocol):
                 send_data = frame
                 send_data.ASDU.Cause = Cause.actcon
                 self.send_frame(send_data)
-                self.begin_C_CI_NA_1()
+                self.begin_C_CI_NA_1(frame.ASDU.data[0].RQT)
                 send_data.ASDU.Cause = Cause.actterm
                 self.send_frame(send_data)
             # 读命令
@@ -272,12 +281,15 @@ class IEC104Device(asyncio.Protocol):
     def save_frame(self, frame, send=True):
         IEC104Device.frame_list[self.device_id].append(('send' if send else 'recv', frame))
 
-    def begin_C_IC_NA_1(self):
+    def begin_C_IC_NA_1(self, qoi=20):
         typ_list = list(range(39))
         typ_list = typ_list[1:17] + typ_list[20:22] + typ_list[30:]
+        # 分组召唤只返回本组数据: 按类型号分为16组
+        if 21 <= qoi <= 36:
+            typ_list = [typ for typ in typ_list if typ % 16 == qoi - 21]
         logger.debug('C_IC_NA_1 num=%s', len(typ_list))
         for typ in typ_list:
-            frame = iec_104.init_frame(self.ssn, self.rsn, TYP(typ), Cause.introgen)
+            frame = iec_104.init_frame(self.ssn, self.rsn, TYP(typ), Cause(qoi) if 21 <= qoi <= 36 else Cause.introgen)
             frame.ASDU.StartAddress = typ
             frame.ASDU.data[0].Address = typ
             frame.ASDU.data[0].Value = typ
@@ -287,9 +299,12 @@ class IEC104Device(asyncio.Protocol):
                 frame.ASDU.data[0].CP24Time2a = datetime.datetime.now()
             self.send_frame(frame)
 
-    def begin_C_CI_NA_1(self):
+    def begin_C_CI_NA_1(self, rqt=5):
         for addr in range(10):
-            frame = iec_104.init_frame(self.ssn, self.rsn, TYP.M_IT_NA_1, Cause.introgen)
+            if 1 <= rqt <= 4 and addr % 4 != rqt - 1:
+                continue
+            frame = iec_104.init_frame(self.ssn, self.rsn, TYP.M_IT_NA_1,
+                                       Cause(37 + rqt) if 1 <= rqt <= 4 else Cause.introgen)
             frame.ASDU.data[0].Address = addr
             frame.ASDU.data[0].Value = addr
             self.send_frame(frame)
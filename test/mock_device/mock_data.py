@@ -13,7 +13,8 @@
             指标1000（计算公式=max(设备1终端10指标1000, 设备2终端30指标1000)）
 """
 import datetime
-import redis
+
+from pydatacoll.utils import backend, key_index
 
 test_formula = {'id': '9', 'formula': 'p1+p2', 'device_id': '2', 'term_id': '30', 'item_id': '2000',
                 'p1': '1:10:1000',
@@ -81,7 +82,7 @@ device2_term30_item1000 = {
 
 
 def generate():
-    redis_client = redis.StrictRedis(db=1, decode_responses=True)
+    redis_client = backend.sync_client()
     redis_client.flushdb()
     [redis_client.hmset('HS:DEVICE:{}'.format(device['id']), device) for device in device_list]
     [redis_client.hmset('HS:TERM:{}'.format(term['id']), term) for term in term_list]
@@ -121,3 +122,4 @@ def generate():
     redis_client.hmset("HS:DATA:1:10:2000", device1_term10_item2000)
     redis_client.hmset("HS:DATA:1:20:1000", device1_term20_item1000)
     redis_client.hmset("HS:DATA:2:30:1000", device2_term30_item1000)
+    key_index.rebuild(redis_client)
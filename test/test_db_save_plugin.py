@@ -4,11 +4,9 @@ try:
     import ujson as json
 except ImportError:
     import json
-import functools
-import aioredis
 import asynctest
 import pymysql
-import redis
+from pydatacoll.utils import backend
 import pydatacoll.utils.logger as my_logger
 import pydatacoll.plugins.db_save as db_save
 
@@ -24,10 +22,8 @@ class DBSaverTest(asynctest.TestCase):
         self.cursor.execute("CREATE TABLE test_db_save(device_id INTEGER, term_id INTEGER, item_id INTEGER,"
                             "time DATETIME, value FLOAT)")
         self.conn.commit()
-        self.redis_pool = asyncio.get_event_loop().run_until_complete(
-                functools.partial(aioredis.create_pool, ('localhost', 6379), db=1, minsize=5, maxsize=10,
-                                  encoding='utf-8')())
-        self.redis_client = redis.StrictRedis(db=1, decode_responses=True)
+        self.redis_pool = asyncio.get_event_loop().run_until_complete(backend.create_pool())
+        self.redis_client = backend.sync_client()
         self.redis_client.flushdb()
         self.db_saver = db_save.DBSaver(self.loop, self.redis_pool)
         self.loop.run_until_complete(self.db_saver.install())
@@ -1,12 +1,11 @@
 import asyncio
-import functools
-import aioredis
 import asynctest
-import redis
 
+from pydatacoll.utils import backend
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.protocols.iec104.device import IEC104Device
 from pydatacoll.protocols.iec104.frame import *
+from pydatacoll.protocols.iec104.scheduler import InterrogationScheduler
 from test.mock_device.iec104device import IEC104Device as MockDevice
 from test.mock_device import mock_data
 
@@ -16,9 +15,8 @@ logger = my_logger.get_logger('IEC104DeviceTest')
 class IEC104DeviceTest(asynctest.TestCase):
     def setUp(self):
         super(IEC104DeviceTest, self).setUp()
-        self.redis_pool = asyncio.get_event_loop().run_until_complete(
-            functools.partial(aioredis.create_pool, ('localhost', 6379), db=1, minsize=5, maxsize=10, encoding='utf-8')())
-        self.redis_client = redis.StrictRedis(db=1, decode_responses=True)
+        self.redis_pool = asyncio.get_event_loop().run_until_complete(backend.create_pool())
+        self.redis_client = backend.sync_client()
         self.server_list = list()
         mock_data.generate()
         for device in mock_data.device_list:
@@ -65,7 +63,9 @@ class IEC104DeviceTest(asynctest.TestCase):
 
         wrong_device = IEC104Device({'id': 9, 'ip': '127.0.0.1', 'port': 9999}, self.loop, self.redis_pool)
         await asyncio.sleep(6)
-        self.assertEqual(wrong_device.connect_retry_count, 2)
+        # 重连间隔: 首次1.5~3秒, 第二次3~6秒
+        self.assertIn(wrong_device.connect_retry_count, (2, 3))
+        self.assertGreaterEqual(wrong_device.backoff.attempts, 2)
         device.disconnect()
 
     async def test_time_sync(self):
@@ -73,7 +73,7 @@ class IEC104DeviceTest(asynctest.TestCase):
         await asyncio.sleep(3)
         send_data = iec_104.init_frame(device.ssn, device.rsn, TYP.C_CS_NA_1, Cause.act)  # 103 时钟同步命令
         await device.send_frame(send_data)
-        self.assertEqual(device.send_list[0].ASDU.TYP, TYP.C_CS_NA_1)
+        self.assertEqual(device.unacked[0][2], TYP.C_CS_NA_1)
         await asyncio.sleep(2)
         self.assertEqual(self.redis_client.llen('LST:FRAME:2'), 4)
         recv_frame = MockDevice.frame_list[2][2]
@@ -96,7 +96,7 @@ class IEC104DeviceTest(asynctest.TestCase):
         # 100 总召唤
         send_data = iec_104.init_frame(device.ssn, device.rsn, TYP.C_IC_NA_1, Cause.act)
         await device.send_frame(send_data)
-        self.assertEqual(device.send_list[0].ASDU.TYP, TYP.C_IC_NA_1)
+        self.assertEqual(device.unacked[0][2], TYP.C_IC_NA_1)
         await asyncio.sleep(3)
         self.assertEqual(len(MockDevice.frame_list[1]), 35)  # 2U + 3S + 3I(call_all) + 27I(all data) = 35
         device.disconnect()
@@ -112,7 +112,7 @@ class IEC104DeviceTest(asynctest.TestCase):
         # 101 电能量召唤
         send_data = iec_104.init_frame(device.ssn, device.rsn, TYP.C_CI_NA_1, Cause.act)
         await device.send_frame(send_data)
-        self.assertEqual(device.send_list[0].ASDU.TYP, TYP.C_CI_NA_1)
+        self.assertEqual(device.unacked[0][2], TYP.C_CI_NA_1)
         await asyncio.sleep(3)
         self.assertEqual(len(MockDevice.frame_list[1]), 16)  # 2U + 1S + 3I(call_power) + 10I(power data) = 16
         device.disconnect()
@@ -170,3 +170,160 @@ class IEC104DeviceTest(asynctest.TestCase):
 
         self.assertEqual(rst['value'], 123)
         device.disconnect()
+
+    async def test_call_data_merge(self):
+        self.redis_client.hmset('HS:MAPPING:IEC104:1:100',
+                                {'term_id': 10, 'item_id': 20, 'protocol_code': 100, 'code_type': 36})
+        self.redis_client.hmset('HS:TERM_ITEM:10:20',
+                                {'term_id': 10, 'item_id': 20, 'protocol_code': 100, 'code_type': 36})
+        device = IEC104Device(mock_data.device_list[0], self.loop, self.redis_pool)
+        await asyncio.sleep(2)
+        with (await self.redis_pool) as sub_client:
+            res = await sub_client.subscribe('CHANNEL:DEVICE_CALL:1:10:20')
+            msg_list = list()
+
+            async def reader(ch):
+                while await ch.wait_message():
+                    msg_list.append(await ch.get_json())
+
+            tsk = asyncio.ensure_future(reader(res[0]))
+            await device.call_data({'term_id': 10, 'item_id': 20, 'request_id': 'a'})
+            await device.call_data({'term_id': 10, 'item_id': 20, 'request_id': 'b'})
+            await asyncio.sleep(1)
+            await sub_client.unsubscribe('CHANNEL:DEVICE_CALL:1:10:20')
+            await tsk
+
+        self.assertEqual(len(msg_list), 1)
+        self.assertEqual(msg_list[0]['request_ids'], ['a', 'b'])
+        self.assertEqual(msg_list[0]['value'], 123)
+        device.disconnect()
+
+    async def test_send_window(self):
+        device = IEC104Device(mock_data.device_list[0], self.loop, self.redis_pool)
+        await asyncio.sleep(2)
+        read_frames = list()
+        for _ in range(IECParam.K + 8):
+            frame = iec_104.init_frame(device.ssn, device.rsn, TYP.C_RD_NA_1, Cause.act)
+            frame.ASDU.data[0].Address = 100
+            read_frames.append(frame)
+        await device.send_frames(read_frames)
+        # 窗口已满, 剩余读命令排队
+        self.assertEqual(device.k, IECParam.K)
+        self.assertEqual(len(device.unacked), IECParam.K)
+        self.assertEqual(len(device.send_queues[2]), 8)
+        # 控制命令优先于排队中的读命令
+        await device.send_frame(device.prepare_ctrl_frame(mock_data.term10_item2000, 1))
+        self.assertEqual(len(device.send_queues[0]), 1)
+        await asyncio.sleep(2)
+        self.assertFalse(any(device.send_queues))
+        recv_typ = [frame[1].ASDU.TYP for frame in MockDevice.frame_list[1]
+                    if frame[0] == 'recv' and not isinstance(frame[1].APCI1, UFrame) and frame[1].APCI1 != 'S']
+        self.assertEqual(recv_typ[IECParam.K], TYP.C_SE_TC_1)
+        device.disconnect()
+
+    async def test_interrogation_schedule(self):
+        scheduler = InterrogationScheduler(self.loop, max_running=3)
+        running = set()
+        run_log = list()
+
+        class FakeDevice(object):
+            def __init__(self, device_id):
+                self.device_id = device_id
+
+            async def interrogate(self, name):
+                running.add(self.device_id)
+                run_log.append((self.device_id, len(running)))
+                scheduler.io_loop.call_later(0.5, self.done, name)
+                return True
+
+            def done(self, name):
+                running.discard(self.device_id)
+                scheduler.finish(self, name)
+
+        devices = [FakeDevice(str(idx)) for idx in range(10)]
+        for device in devices:
+            scheduler.add(device, 'station', 3)
+        phases = [info['phase'] for info in scheduler.schedule_list()]
+        self.assertEqual(len(set(phases)), 10)
+        self.assertTrue(all(0 <= phase < 3 for phase in phases))
+        await asyncio.sleep(4.5)
+        self.assertEqual(set(device_id for device_id, _ in run_log), set(device.device_id for device in devices))
+        self.assertLessEqual(max(concurrent for _, concurrent in run_log), 3)
+        for device in devices:
+            scheduler.remove(device)
+        self.assertEqual(scheduler.schedule_list(), [])
+
+    async def test_interrogation_group_reload(self):
+        scheduler = InterrogationScheduler(self.loop)
+
+        class FakeDevice(object):
+            def __init__(self, device_id, group):
+                self.device_id = device_id
+                self.device_info = {'id': device_id, 'interrogation_group': group}
+
+        devices = [FakeDevice('1', 'fast'), FakeDevice('2', 'slow')]
+        for device in devices:
+            scheduler.add(device, 'station', scheduler.device_interval(device.device_info))
+        scheduler.set_group_intervals({'fast': '60'})
+        intervals = {info['device_id']: info['interval'] for info in scheduler.schedule_list()}
+        self.assertEqual(intervals, {'1': 60, '2': 15 * 60})
+        scheduler.set_group_intervals({'slow': '3600'})
+        intervals = {info['device_id']: info['interval'] for info in scheduler.schedule_list()}
+        self.assertEqual(intervals, {'1': 15 * 60, '2': 3600})
+        for device in devices:
+            scheduler.remove(device)
+
+    async def test_group_interrogation(self):
+        self.assertEqual(IEC104Device.parse_groups('1:60, 2:3600,17:1,x', 16), {1: 60, 2: 3600})
+        self.redis_client.hmset('HS:TERM:10', {'interrogation_groups': '1:60', 'counter_groups': '2:30'})
+        self.redis_client.hmset('HS:TERM:20', {'interrogation_groups': '1:10,3:600'})
+        device = IEC104Device(mock_data.device_list[0], self.loop, self.redis_pool)
+        await asyncio.sleep(2)
+        self.assertEqual(device.group_tasks, {'group1': 10, 'group3': 600, 'counter2': 30})
+        schedule = {info['name']: info for info in device.scheduler.schedule_list()}
+        self.assertEqual(set(schedule), {'station', 'group1', 'group3', 'counter2'})
+        self.assertEqual(schedule['group1']['interval'], 10)
+        await device.interrogate('group1')
+        await device.interrogate('counter2')
+        await asyncio.sleep(2)
+        recv_cause = [frame[1].ASDU.Cause for frame in MockDevice.frame_list[1]
+                      if frame[0] == 'send' and not isinstance(frame[1].APCI1, UFrame) and frame[1].APCI1 != 'S']
+        self.assertIn(Cause.inro1, recv_cause)
+        self.assertIn(Cause.reqco2, recv_cause)
+        self.assertNotIn(Cause.introgen, recv_cause)
+        device.disconnect()
+        self.assertEqual(device.scheduler.schedule_list(), [])
+
+    async def test_ctrl_data_batch(self):
+        ctrl_list = list()
+        for idx in range(3):
+            term_item = {'term_id': 10, 'item_id': 30 + idx, 'protocol_code': 500 + idx, 'code_type': 50}
+            self.redis_client.hmset('HS:MAPPING:IEC104:1:{}'.format(500 + idx), term_item)
+            self.redis_client.hmset('HS:TERM_ITEM:10:{}'.format(30 + idx), term_item)
+            ctrl_list.append({'term_id': '10', 'item_id': str(30 + idx), 'value': idx + 0.5,
+                              'request_id': str(idx)})
+        device_info = dict(mock_data.device_list[0], max_command_objects='30')
+        device = IEC104Device(device_info, self.loop, self.redis_pool)
+        await asyncio.sleep(2)
+        with (await self.redis_pool) as sub_client:
+            res = await sub_client.psubscribe('CHANNEL:DEVICE_CTRL:1:10:*')
+            msg_list = list()
+
+            async def reader(ch):
+                while await ch.wait_message():
+                    _, msg = await ch.get_json()
+                    msg_list.append(msg)
+
+            tsk = asyncio.ensure_future(reader(res[0]))
+            await device.ctrl_data_batch(ctrl_list)
+            await asyncio.sleep(1)
+            await sub_client.punsubscribe('CHANNEL:DEVICE_CTRL:1:10:*')
+            await tsk
+
+        self.assertEqual(sorted(msg['request_ids'][0] for msg in msg_list), ['0', '1', '2'])
+        ctrl_frames = [frame[1] for frame in MockDevice.frame_list[1]
+                       if frame[0] == 'recv' and not isinstance(frame[1].APCI1, UFrame) and frame[1].APCI1 != 'S']
+        # 选择 + 执行, 各一帧
+        self.assertEqual(len(ctrl_frames), 2)
+        self.assertEqual(ctrl_frames[0].ASDU.SQ_COUNT, 3)
+        device.disconnect()
@@ -150,3 +150,20 @@ class IEC104Test(unittest.TestCase):
         re_build = iec_104.build(parse)
         # print("re_build=", re_build.hex())
         self.assertEqual(re_build, build)
+
+    def test_multi_object_command(self):
+        count = max_objects(TYP.C_SE_NC_1)
+        c = iec_104.init_frame(10, 3, TYP.C_SE_NC_1, Cause.act, SQ_COUNT=count)
+        for idx in range(count):
+            c.ASDU.data[idx].Address = 100 + idx
+            c.ASDU.data[idx].Value = idx * 1.5
+            c.ASDU.data[idx].SE = 1
+        build = iec_104.build_isu(c)
+        self.assertLessEqual(len(build), MAX_APDU_LENGTH)
+        parse = iec_104.parse(build)
+        self.assertEqual(parse.ASDU.SQ_COUNT, count)
+        self.assertEqual([data.Address for data in parse.ASDU.data], list(range(100, 100 + count)))
+        self.assertEqual(parse.ASDU.data[-1].Value, (count - 1) * 1.5)
+        with self.assertRaises(Exception):
+            c = iec_104.init_frame(10, 3, TYP.C_SE_NC_1, Cause.act, SQ_COUNT=count + 1)
+            iec_104.build_isu(c)
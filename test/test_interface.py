@@ -13,7 +13,8 @@ except ImportError:
 import pydatacoll.utils.logger as my_logger
 from pydatacoll.resources.protocol import *
 from test.mock_device import mock_data, iec104device
-from pydatacoll import api_server
+from pydatacoll import api_server, launcher
+from pydatacoll.utils import codec, key_index, metrics
 
 logger = my_logger.get_logger('TestInterface')
 
@@ -262,6 +263,47 @@ name 'p2' is not defined
             rst = self.redis_client.sismember('SET:TERM', 50)
             self.assertFalse(rst)
 
+    async def test_term_move_delete(self):
+        term = {'id': '91', 'name': 'move', 'address': '91', 'protocol': 'dlt645', 'device_id': '1'}
+        term_item = {'id': '91', 'term_id': '91', 'item_id': '1000', 'protocol_code': '991'}
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/terms', data=json.dumps(term)) as r:
+            self.assertEqual(r.status, 200)
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/terms/91/items', data=json.dumps(term_item)) as r:
+            self.assertEqual(r.status, 200)
+        self.redis_client.hset('HS:DATA:1:91:1000', '2016-01-01T00:00:00', 1)
+        self.redis_client.rpush('LST:DATA_TIME:1:91:1000', '2016-01-01T00:00:00')
+        term['device_id'] = 2
+        # 新设备上已有相同protocol_code的映射时拒绝移动
+        self.redis_client.hmset('HS:MAPPING:IEC104:2:991', {'term_id': '30', 'item_id': '2000'})
+        async with aiohttp.put('http://127.0.0.1:8080/api/v1/terms/91', data=json.dumps(term)) as r:
+            self.assertEqual(r.status, 409)
+        self.assertEqual(self.redis_client.hget('HS:TERM:91', 'device_id'), '1')
+        self.redis_client.delete('HS:MAPPING:IEC104:2:991')
+        async with aiohttp.put('http://127.0.0.1:8080/api/v1/terms/91', data=json.dumps(term)) as r:
+            self.assertEqual(r.status, 200)
+        self.assertFalse(self.redis_client.sismember('SET:DEVICE_TERM:1', 91))
+        self.assertTrue(self.redis_client.sismember('SET:DEVICE_TERM:2', 91))
+        self.assertFalse(self.redis_client.sismember(key_index.DEVICE_TERM_ITEM.format(1), '91:1000'))
+        self.assertTrue(self.redis_client.sismember(key_index.DEVICE_TERM_ITEM.format(2), '91:1000'))
+        # 映射改到新设备下, 旧设备不再把991解析为终端91
+        self.assertEqual(self.redis_client.hget(key_index.DEVICE_MAPPING.format(2), '91:1000'),
+                         'HS:MAPPING:IEC104:2:991')
+        self.assertIsNone(self.redis_client.hget(key_index.DEVICE_MAPPING.format(1), '91:1000'))
+        self.assertFalse(self.redis_client.exists('HS:MAPPING:IEC104:1:991'))
+        self.assertEqual(self.redis_client.hget('HS:MAPPING:IEC104:2:991', 'device_id'), '2')
+        self.assertEqual(self.redis_client.hget('HS:MAPPING:IEC104:2:991', 'term_id'), '91')
+        self.assertEqual(self.redis_client.hget('HS:TERM_ITEM:91:1000', 'device_id'), '2')
+        # 值的key名含旧设备, 仍登记在旧设备下, 删除终端时一并删除
+        async with aiohttp.delete('http://127.0.0.1:8080/api/v1/terms/91') as r:
+            self.assertEqual(r.status, 200)
+        for key in ('HS:TERM:91', 'HS:TERM_ITEM:91:1000', 'HS:MAPPING:IEC104:2:991', 'HS:DATA:1:91:1000',
+                    'LST:DATA_TIME:1:91:1000'):
+            self.assertFalse(self.redis_client.exists(key), key)
+        self.assertFalse(self.redis_client.sismember('SET:DEVICE_TERM:2', 91))
+        self.assertFalse(self.redis_client.sismember(key_index.DEVICE_DATA.format(1), '91:1000'))
+        self.assertFalse(self.redis_client.sismember(key_index.DEVICE_DATA.format(2), '91:1000'))
+        self.assertFalse({'1:91', '2:91'} & self.redis_client.smembers(key_index.ITEM_TERM.format(1000)))
+
     async def test_item_CRUD(self):
         async with aiohttp.get('http://127.0.0.1:8080/api/v1/items') as r:
             self.assertEqual(r.status, 200)
@@ -333,6 +375,85 @@ name 'p2' is not defined
             rst = await r.json()
             self.assertEqual(len(rst), 0)
 
+    async def test_get_data_formats(self):
+        url = 'http://127.0.0.1:8080/api/v1/devices/1/terms/10/items/1000/datas?format={}'
+        times = sorted(mock_data.device1_term10_item1000)
+        values = [float(mock_data.device1_term10_item1000[data_time]) for data_time in times]
+        async with aiohttp.get(url.format('columnar')) as r:
+            self.assertEqual(r.status, 200)
+            self.assertEqual(await r.json(), {'time': times, 'value': values})
+        async with aiohttp.get(url.format('binary')) as r:
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.headers['Content-Type'], api_server.SERIES_TYPE)
+            decoded_times, decoded_values = codec.decode_series(await r.read())
+            self.assertEqual(decoded_values, values)
+        async with aiohttp.get(url.format('xml')) as r:
+            self.assertEqual(r.status, 400)
+        # 超过compress.MIN_SIZE的响应按Accept-Encoding压缩
+        data_dict = {'2016-01-01T00:{:02d}:{:02d}'.format(idx // 60, idx % 60): str(idx) for idx in range(200)}
+        self.redis_client.hmset('HS:DATA:99:99:99', data_dict)
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/devices/99/terms/99/items/99/datas',
+                               headers={'Accept-Encoding': 'gzip'}) as r:
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(await r.json(), data_dict)
+        self.redis_client.delete('HS:DATA:99:99:99')
+
+    async def test_export_data(self):
+        times = ['2016-01-01T00:00:{:02d}'.format(idx) for idx in range(30)]
+        for item in ('10:1000', '10:2000', '20:1000'):
+            self.redis_client.hmset('HS:DATA:98:{}'.format(item), dict(zip(times, range(30))))
+            self.redis_client.rpush('LST:DATA_TIME:98:{}'.format(item), *times)
+            self.redis_client.sadd('SET:DEVICE_DATA:98', item)
+        url = 'http://127.0.0.1:8080/api/v1/datas/export?items=98:*:*,98:10:1000&start=2016-01-01T00:00:28'
+        async with aiohttp.get(url) as r:
+            self.assertEqual(r.status, 200)
+            rows = [json.loads(line) for line in (await r.text()).splitlines()]
+        self.assertEqual([(row['term_id'], row['item_id'], row['value']) for row in rows],
+                         [('10', '1000', 28), ('10', '1000', 29), ('10', '2000', 28), ('10', '2000', 29),
+                          ('20', '1000', 28), ('20', '1000', 29)])
+        # 从最后收到的一行之后续传
+        async with aiohttp.get(url + '&format=csv&cursor=98:10:2000:' + rows[2]['time']) as r:
+            self.assertEqual(r.status, 200)
+            lines = (await r.text()).splitlines()
+        self.assertEqual(lines, ['98,10,2000,2016-01-01T00:00:29,29.0', '98,20,1000,2016-01-01T00:00:28,28.0',
+                                 '98,20,1000,2016-01-01T00:00:29,29.0'])
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/datas/export?items=98:10') as r:
+            self.assertEqual(r.status, 400)
+        for query in ('&end=2016-01-01 00:00:29', '&end=2016-01-02', '&cursor=98:10:2000:2016-01-01'):
+            async with aiohttp.get(url + query) as r:
+                self.assertEqual(r.status, 400, query)
+        self.redis_client.delete(*key_index.data_keys(98, ['10:1000', '10:2000', '20:1000']))
+        self.redis_client.delete('SET:DEVICE_DATA:98')
+
+    async def test_get_metrics(self):
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/devices/1') as r:
+            self.assertEqual(r.status, 200)
+        async with aiohttp.get('http://127.0.0.1:8080/metrics') as r:
+            self.assertEqual(r.status, 200)
+            self.assertEqual(r.headers['Content-Type'], metrics.CONTENT_TYPE)
+            text = await r.text()
+        self.assertIn('# TYPE pydatacoll_http_request_duration_seconds histogram', text)
+        self.assertIn('pydatacoll_http_requests_total{handler="get_device",method="GET",status="200",process=', text)
+        self.assertIn('pydatacoll_http_request_duration_seconds_bucket{handler="get_device",le="+Inf",process=', text)
+
+    async def test_get_loop_health(self):
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/debug/loop') as r:
+            self.assertEqual(r.status, 200)
+            reports = await r.json()
+        report = list(reports.values())[0]  # 第一个是处理请求的进程
+        self.assertEqual(set(report), {'interval', 'threshold', 'last_lag', 'max_lag', 'slow_total', 'events'})
+
+    async def test_profile(self):
+        url = 'http://127.0.0.1:8080/api/v1/debug/profile?seconds={}&format={}'
+        async with aiohttp.post(url.format(0.5, 'collapsed')) as r:
+            self.assertEqual(r.status, 200)
+            self.assertTrue(all(line.rsplit(' ', 1)[1].isdigit() for line in (await r.text()).splitlines()))
+        async with aiohttp.post(url.format(0.5, 'xml')) as r:
+            self.assertEqual(r.status, 400)
+        async with aiohttp.post(url.format(0, 'collapsed')) as r:
+            self.assertEqual(r.status, 400)
+
     async def test_term_item_CRUD(self):
         async with aiohttp.get('http://127.0.0.1:8080/api/v1/terms/10/items/1000') as r:
             self.assertEqual(r.status, 200)
@@ -395,6 +516,112 @@ name 'p2' is not defined
             self.assertFalse(rst)
         del mock_data.test_term_item['device_id']
 
+    async def test_bulk_import_export(self):
+        items = [{'id': str(5000 + idx), 'name': 'bulk{}'.format(idx)} for idx in range(3)]
+        term_items = '\n'.join(json.dumps({'term_id': '30', 'item_id': item['id'], 'protocol_code': str(600 + idx)})
+                                for idx, item in enumerate(items))
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/bulk/term_items', data=term_items) as r:
+            self.assertEqual(r.status, 400)
+            rst = await r.json()
+            self.assertEqual(len(rst['errors']), 3)
+            self.assertFalse(self.redis_client.exists('HS:TERM_ITEM:30:5000'))
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/bulk/items', data=json.dumps(items)) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst['created'], 3)
+            self.assertTrue(self.redis_client.sismember('SET:ITEM', 5002))
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/bulk/items', data=json.dumps(items[:1])) as r:
+            self.assertEqual(r.status, 409)
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/bulk/term_items', data=term_items) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst['devices'], 1)
+            self.assertEqual(self.redis_client.hget('HS:MAPPING:IEC104:2:601', 'item_id'), '5001')
+            self.assertTrue(self.redis_client.sismember('SET:TERM_ITEM:30', 5001))
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/bulk/term_items?format=ndjson') as r:
+            self.assertEqual(r.status, 200)
+            rst = [json.loads(line) for line in (await r.text()).splitlines()]
+            self.assertEqual(len(rst), 7)
+            self.assertIn(dict(json.loads(term_items.splitlines()[0]), device_id='2'), rst)
+        async with aiohttp.delete('http://127.0.0.1:8080/api/v1/terms/30/items/5000') as r:
+            self.assertEqual(r.status, 200)
+            self.assertFalse(self.redis_client.exists('HS:MAPPING:IEC104:2:600'))
+
+    async def test_delete_no_stall(self):
+        # 删除有1万个终端指标的设备时, 其他请求的响应时间不超过阈值
+        url = 'http://127.0.0.1:8080/api/v1/bulk/{}'
+        items = [{'id': str(9000 + idx), 'name': 'stall{}'.format(idx)} for idx in range(200)]
+        terms = [{'id': str(900 + idx), 'name': 'stall{}'.format(idx), 'device_id': '9', 'protocol': 'dlt645'}
+                 for idx in range(50)]
+        term_items = '\n'.join(json.dumps({'term_id': term['id'], 'item_id': item['id'],
+                                            'protocol_code': '{}{}'.format(term['id'], item['id'])})
+                                for term in terms for item in items)
+        for kind, data in (('devices', json.dumps([{'id': '9', 'name': 'stall', 'protocol': 'virtual'}])),
+                           ('items', json.dumps(items)), ('terms', json.dumps(terms)), ('term_items', term_items)):
+            async with aiohttp.post(url.format(kind), data=data) as r:
+                self.assertEqual(r.status, 200)
+        self.assertEqual(self.redis_client.scard('SET:DEVICE_TERM_ITEM:9'), 10000)
+        latency = list()
+
+        async def probe():
+            while True:
+                begin = time.perf_counter()
+                async with aiohttp.get('http://127.0.0.1:8080/api/v1/device_protocols') as r:
+                    self.assertEqual(r.status, 200)
+                latency.append(time.perf_counter() - begin)
+                await asyncio.sleep(0.005)
+        probe_task = asyncio.ensure_future(probe())
+        await asyncio.sleep(0.1)
+        async with aiohttp.delete('http://127.0.0.1:8080/api/v1/devices/9') as r:
+            self.assertEqual(r.status, 200)
+        probe_task.cancel()
+        self.assertLess(max(latency), 0.2)
+        self.assertFalse(self.redis_client.exists('HS:TERM_ITEM:900:9000'))
+        self.assertFalse(self.redis_client.exists('SET:DEVICE_DATA:9'))
+        for item in items:
+            async with aiohttp.delete('http://127.0.0.1:8080/api/v1/items/{}'.format(item['id'])) as r:
+                self.assertEqual(r.status, 200)
+
+    async def test_config_etag(self):
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/items/2000') as r:
+            self.assertEqual(r.status, 200)
+            etag = r.headers['ETag']
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/items/2000', headers={'If-None-Match': etag}) as r:
+            self.assertEqual(r.status, 304)
+        item = dict(await (await aiohttp.get('http://127.0.0.1:8080/api/v1/items/2000')).json(), view_code='2001')
+        async with aiohttp.put('http://127.0.0.1:8080/api/v1/items/2000', data=json.dumps(item)) as r:
+            self.assertEqual(r.status, 200)
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/items/2000', headers={'If-None-Match': etag}) as r:
+            self.assertEqual(r.status, 200)
+            self.assertNotEqual(r.headers['ETag'], etag)
+            rst = await r.json()
+            self.assertEqual(rst['view_code'], '2001')
+        # 绕过API的修改发布变更消息后缓存失效
+        self.redis_client.hset('HS:ITEM:2000', 'view_code', '2000')
+        self.redis_client.publish('CHANNEL:ITEM_FRESH', json.dumps(item))
+        await asyncio.sleep(0.1)
+        async with aiohttp.get('http://127.0.0.1:8080/api/v1/items/2000') as r:
+            rst = await r.json()
+            self.assertEqual(rst['view_code'], '2000')
+
+    async def test_launcher_workers(self):
+        # 2个API进程共享端口, SIGTERM后各进程正常退出
+        process = multiprocessing.Process(target=launcher.main,
+                                          args=(['--port', '8081', '--workers', '2', '--no-plugins'],))
+        process.start()
+        try:
+            await asyncio.sleep(2)
+            rst = list()
+            for _ in range(10):
+                async with aiohttp.get('http://127.0.0.1:8081/api/v1/device_protocols') as r:
+                    self.assertEqual(r.status, 200)
+                    rst.append(await r.json())
+            self.assertEqual(rst, [DEVICE_PROTOCOLS] * 10)
+        finally:
+            process.terminate()
+            process.join(launcher.EXIT_GRACE + api_server.DRAIN_TIMEOUT)
+        self.assertEqual(process.exitcode, 0)
+
     async def test_device_call(self):
         call_dict = {'device_id': '1', 'term_id': '10', 'item_id': 1000}
         async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call', data=json.dumps(call_dict)) as r:
@@ -402,9 +629,102 @@ name 'p2' is not defined
             rst = await r.json()
             self.assertEqual(rst['value'], 123)
 
+    async def test_device_call_int_id(self):
+        call_dict = {'device_id': 1, 'term_id': 10, 'item_id': 1000}
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call', data=json.dumps(call_dict)) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(rst['value'], 123)
+
+    async def test_device_call_concurrent(self):
+        # 数字和字符串形式的id是同一个指标, 合并为一次召测
+        call_dicts = [{'device_id': '1', 'term_id': '10', 'item_id': 1000},
+                      {'device_id': 1, 'term_id': '10', 'item_id': '1000'}]
+
+        async def call(call_dict):
+            async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call', data=json.dumps(call_dict)) as r:
+                self.assertEqual(r.status, 200)
+                return await r.json()
+
+        rst_list = await asyncio.gather(*[call(call_dicts[idx % 2]) for idx in range(50)])
+        self.assertTrue(all(rst['value'] == 123 for rst in rst_list))
+
     async def test_device_ctrl(self):
         ctrl_dict = {'device_id': '2', 'term_id': '30', 'item_id': '1000', 'value': 123.4}
         async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_ctrl', data=json.dumps(ctrl_dict)) as r:
             self.assertEqual(r.status, 200)
             rst = await r.json()
             self.assertAlmostEqual(rst['value'], 123.4, delta=0.0001)
+
+    async def test_device_ctrl_int_id(self):
+        ctrl_dict = {'device_id': 2, 'term_id': 30, 'item_id': 1000, 'value': 123.4}
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_ctrl', data=json.dumps(ctrl_dict)) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertAlmostEqual(rst['value'], 123.4, delta=0.0001)
+
+    async def test_live_ws(self):
+        ws = await aiohttp.ws_connect('http://127.0.0.1:8080/api/v1/live/ws?items=1:10:1000&interval=0.1')
+        ws.send_str(json.dumps({'subscribe': ['2:*:*']}))
+        await asyncio.sleep(0.5)
+        self.redis_client.publish('CHANNEL:DEVICE_DATA:1:10:1000', json.dumps({
+            'device_id': '1', 'term_id': '10', 'item_id': '1000', 'time': '2016-01-01T00:00:00', 'value': 1}))
+        self.redis_client.publish('CHANNEL:DEVICE_DATA:1:10:1000', json.dumps({
+            'device_id': '1', 'term_id': '10', 'item_id': '1000', 'time': '2016-01-01T00:00:01', 'value': 2}))
+        self.redis_client.publish('CHANNEL:DEVICE_DATA:2:30:1000', json.dumps({
+            'device_id': '2', 'term_id': '30', 'item_id': '1000', 'time': '2016-01-01T00:00:01', 'value': 3}))
+        self.redis_client.publish('CHANNEL:DEVICE_DATA:1:20:1000', json.dumps({
+            'device_id': '1', 'term_id': '20', 'item_id': '1000', 'time': '2016-01-01T00:00:01', 'value': 4}))
+        msg = await asyncio.wait_for(ws.receive(), 3)
+        rst = json.loads(msg.data)
+        self.assertEqual(len(rst), 2)  # coalesced, 1:20:1000 not subscribed
+        self.assertEqual({data['value'] for data in rst}, {2, 3})
+        await ws.close()
+
+    async def test_device_call_batch(self):
+        call_list = [{'device_id': '1', 'term_id': '10', 'item_id': '1000'},
+                     {'device_id': '1', 'term_id': '20', 'item_id': '1000'},
+                     {'device_id': '1', 'term_id': '10', 'item_id': '99'}]
+        async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call/batch', data=json.dumps(call_list)) as r:
+            self.assertEqual(r.status, 200)
+            rst = await r.json()
+            self.assertEqual(len(rst), 3)
+            self.assertEqual(rst[0]['status'], 'ok')
+            self.assertEqual(rst[0]['value'], 123)
+            self.assertEqual(rst[1]['status'], 'ok')
+            self.assertEqual(rst[2]['status'], 'not_found')
+
+    async def test_device_call_batch_unknown_device(self):
+        # 设备只写入redis而未通知DeviceManager, 应立即回复错误而不是等待超时
+        self.redis_client.hmset('HS:DEVICE:92', {'id': '92', 'name': 'unknown', 'ip': '127.0.0.1', 'port': 2404,
+                                                 'protocol': 'iec104'})
+        self.redis_client.hmset('HS:TERM_ITEM:10:92', {'id': '92', 'term_id': '10', 'item_id': '92'})
+        try:
+            call_list = [{'device_id': '92', 'term_id': '10', 'item_id': '92'}]
+            start = time.time()
+            async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_call/batch',
+                                    data=json.dumps(call_list)) as r:
+                self.assertEqual(r.status, 200)
+                rst = await r.json()
+            self.assertLess(time.time() - start, api_server.HANDLER_TIME_OUT)
+            self.assertEqual(rst[0]['status'], 'error')
+            self.assertEqual(rst[0]['err_msg'], 'device not found!')
+        finally:
+            self.redis_client.delete('HS:DEVICE:92', 'HS:TERM_ITEM:10:92')
+
+    async def test_device_ctrl_batch_unknown_device(self):
+        self.redis_client.hmset('HS:DEVICE:93', {'id': '93', 'name': 'unknown', 'ip': '127.0.0.1', 'port': 2404,
+                                                 'protocol': 'iec104'})
+        self.redis_client.hmset('HS:TERM_ITEM:10:93', {'id': '93', 'term_id': '10', 'item_id': '93'})
+        try:
+            ctrl_list = [{'device_id': '93', 'term_id': '10', 'item_id': '93', 'value': 1}]
+            start = time.time()
+            async with aiohttp.post('http://127.0.0.1:8080/api/v1/device_ctrl/batch',
+                                    data=json.dumps(ctrl_list)) as r:
+                self.assertEqual(r.status, 200)
+                rst = await r.json()
+            self.assertLess(time.time() - start, api_server.HANDLER_TIME_OUT)
+            self.assertEqual(rst[0]['status'], 'error')
+            self.assertEqual(rst[0]['err_msg'], 'device not found!')
+        finally:
+            self.redis_client.delete('HS:DEVICE:93', 'HS:TERM_ITEM:10:93')
@@ -1,6 +1,22 @@
+import asyncio
+import datetime
+import gzip
+import json
+import marshal
+import threading
+import time
 import unittest
+import zlib
+from collections import OrderedDict
 
+from pydatacoll.plugins import shard_of
+from pydatacoll.utils import codec, compress, data_export, key_index, metrics, profiler
+from pydatacoll.utils.config_cache import ConfigCache, etag_matches
 from pydatacoll.utils.func_container import ParamFunctionContainer, param_function
+from pydatacoll.utils.loop_monitor import LoopMonitor
+from pydatacoll.utils.mem_redis import MemoryStore, MemoryPool, MemorySyncClient
+from pydatacoll.utils.rate_limit import Backoff, TokenBucket
+from pydatacoll.utils.timer_wheel import TimerWheel
 
 
 class UtilTest(unittest.TestCase):
@@ -24,3 +40,471 @@ class UtilTest(unittest.TestCase):
         api = MyAPI(1, 2, 3)
         self.assertDictEqual(api.module_arg_dict, {'api_device_list': {'method': 'GET', 'url': '/devices'},
                                                    'api_new_device': {'method': 'POST', 'url': '/devices_new'}})
+
+    def test_timer_wheel(self):
+        loop = asyncio.new_event_loop()
+        fired = list()
+        wheel = TimerWheel(loop, tick=0.01, slots=16)
+        t1 = wheel.timer(lambda: fired.append(('t1', loop.time())))
+        t2 = wheel.timer(lambda: fired.append(('t2', loop.time())))
+        t3 = wheel.timer(lambda: fired.append(('t3', loop.time())))
+        begin = loop.time()
+        t1.start(0.05)
+        t2.start(0.3)  # 超过一圈, 到期后重新放入时间轮
+        t3.start(0.05)
+        t3.stop()
+        t1.start(0.1)  # 重新计时只更新deadline
+        loop.run_until_complete(asyncio.sleep(0.5, loop=loop))
+        loop.close()
+        self.assertEqual([name for name, _ in fired], ['t1', 't2'])
+        self.assertGreaterEqual(fired[0][1] - begin, 0.1)
+        self.assertGreaterEqual(fired[1][1] - begin, 0.3)
+        self.assertFalse(t1.active)
+        self.assertEqual(wheel.count, 0)
+
+    def test_backoff(self):
+        backoff = Backoff(base=2, cap=10)
+        delays = [backoff.next_delay() for _ in range(5)]
+        for delay, ceiling in zip(delays, (2, 4, 8, 10, 10)):
+            self.assertGreaterEqual(delay, ceiling / 2)
+            self.assertLessEqual(delay, ceiling)
+        backoff.reset()
+        self.assertLessEqual(backoff.next_delay(), 2)
+
+    def test_token_bucket(self):
+        loop = asyncio.new_event_loop()
+        bucket = TokenBucket(loop, rate=10, capacity=5)
+        begin = loop.time()
+        loop.run_until_complete(asyncio.gather(*[bucket.acquire() for _ in range(15)], loop=loop))
+        elapsed = loop.time() - begin
+        loop.close()
+        # 5个立即获得, 其余10个按每秒10个发放
+        self.assertGreaterEqual(elapsed, 0.9)
+        stats = bucket.stats()
+        self.assertEqual(stats['granted'], 15)
+        self.assertEqual(stats['delayed'], 10)
+        self.assertEqual(stats['max_waiting'], 10)
+
+    def test_token_bucket_cancel(self):
+        loop = asyncio.new_event_loop()
+        bucket = TokenBucket(loop, rate=10, capacity=1)
+        bucket.tokens = 0
+
+        async def run():
+            first = loop.create_task(bucket.acquire())
+            second = loop.create_task(bucket.acquire())
+            await asyncio.sleep(0, loop=loop)
+            # 令牌发给first后, first在恢复执行前被取消, 令牌应转给second
+            bucket.tokens = 1
+            bucket.wake_handler.cancel()
+            bucket._wakeup()
+            first.cancel()
+            await asyncio.wait_for(second, 0.05, loop=loop)
+            self.assertTrue(first.cancelled())
+
+        loop.run_until_complete(run())
+        loop.close()
+        stats = bucket.stats()
+        self.assertEqual(stats['granted'], 1)
+        self.assertEqual(stats['waiting'], 0)
+
+    def test_mem_redis(self):
+        loop = asyncio.new_event_loop()
+        store = MemoryStore()
+        pool = MemoryPool(store, loop)
+        sync_client = MemorySyncClient(store)
+        sync_client.hmset('HS:DEVICE:1', {'id': 1, 'name': 'd1'})
+        sync_client.sadd('SET:DEVICE', 1, 2)
+
+        async def run():
+            with (await pool) as redis_client:
+                self.assertDictEqual(await redis_client.hgetall('HS:DEVICE:1'), {'id': '1', 'name': 'd1'})
+                self.assertEqual(await redis_client.hmget('HS:DEVICE:1', 'name', 'ip'), ['d1', None])
+                self.assertEqual(await redis_client.sismember('SET:DEVICE', '2'), 1)
+                await redis_client.rpush('LST:DATA_TIME:1:10:20', 'a', 'b', 'c')
+                self.assertEqual(await redis_client.lindex('LST:DATA_TIME:1:10:20', -2), 'b')
+                self.assertEqual(await redis_client.lrange('LST:DATA_TIME:1:10:20', 1, -1), ['b', 'c'])
+                tr = redis_client.multi_exec()
+                fut = tr.hset('HS:DATA:1:10:20', 'a', 1.5)
+                tr.delete('SET:DEVICE')
+                self.assertEqual(await tr.execute(), [1, 1])
+                self.assertEqual(await fut, 1)
+                self.assertEqual(await redis_client.exists('SET:DEVICE'), 0)
+                self.assertEqual(sorted((await redis_client.scan(b'0', match='*:1:10:*'))[1]),
+                                 ['HS:DATA:1:10:20', 'LST:DATA_TIME:1:10:20'])
+            sub_client = await pool.acquire()
+            channel, = await sub_client.psubscribe('CHANNEL:DEVICE_DATA:*')
+            self.assertEqual(sync_client.publish('CHANNEL:DEVICE_DATA:1:10:20', '{"value": 1}'), 1)
+            self.assertEqual(sync_client.publish('CHANNEL:DEVICE_CTRL:1:10:20', '{"value": 2}'), 0)
+            self.assertTrue(await channel.wait_message())
+            self.assertEqual(await channel.get_json(), (b'CHANNEL:DEVICE_DATA:1:10:20', {'value': 1}))
+            await sub_client.punsubscribe('CHANNEL:DEVICE_DATA:*')
+            self.assertFalse(await channel.wait_message())
+            pool.release(sub_client)
+        loop.run_until_complete(run())
+        loop.close()
+        self.assertEqual(sync_client.smembers('SET:DEVICE'), set())
+        self.assertEqual(sync_client.hget('HS:DATA:1:10:20', 'a'), '1.5')
+
+    def test_codec(self):
+        points = [('10', '20', datetime.datetime(2016, 1, 2, 3, 4, 5, 678901), 1.5),
+                  ('10', '21', datetime.datetime(2016, 1, 2, 3, 4, 5), 1)]
+        device_id, decoded = codec.decode_batch(codec.encode_batch('1', points))
+        self.assertEqual(device_id, '1')
+        self.assertEqual([(t, i, d.isoformat(), v) for t, i, d, v in decoded],
+                         [(t, i, d.isoformat(), v) for t, i, d, v in points])
+        # int保持为int, 与JSON一致
+        self.assertEqual(codec.to_message(device_id, decoded[1]),
+                         (b'CHANNEL:DEVICE_DATA:1:10:21', {'device_id': '1', 'term_id': '10', 'item_id': '21',
+                                                           'time': '2016-01-02T03:04:05', 'value': 1}))
+        self.assertIsInstance(decoded[1][3], int)
+        self.assertIsInstance(decoded[0][3], float)
+        self.assertRaises(ValueError, codec.encode_batch, 'd1', points)
+        for value in ('1.5', None, True, 2 ** 60):
+            self.assertRaises(ValueError, codec.encode_batch, '1', [('10', '20', points[0][2], value)])
+
+        loop = asyncio.new_event_loop()
+        store = MemoryStore()
+        pool = MemoryPool(store, loop)
+        publisher = codec.DataPublisher()
+
+        async def run():
+            sub_client = await pool.acquire()
+            json_channel, bin_channel = await sub_client.psubscribe(codec.DATA_PATTERN, codec.BIN_PATTERN)
+            with (await pool) as redis_client:
+                # 内部订阅者同时收到二进制和JSON, 此后没有外部订阅者的JSON通道暂停发布
+                await publisher.publish(redis_client, '1', points)
+                await publisher.publish(redis_client, '1', points)
+                self.assertEqual(len(bin_channel.messages), 2)
+                self.assertEqual(len(json_channel.messages), 2)
+                # 非整数id只发JSON
+                await publisher.publish(redis_client, 'd1', points[:1])
+                self.assertEqual(len(bin_channel.messages), 2)
+                self.assertEqual(len(json_channel.messages), 3)
+            await sub_client.punsubscribe(codec.DATA_PATTERN, codec.BIN_PATTERN)
+            pool.release(sub_client)
+        loop.run_until_complete(run())
+        loop.close()
+
+    def test_duplicate_filter(self):
+        duplicates = codec.DuplicateFilter(window=0.05, max_points=3)
+        # 二进制和JSON两份只保留先到的, 与顺序无关
+        self.assertTrue(duplicates.first('1:10:20', 't1', True))
+        self.assertFalse(duplicates.first('1:10:20', 't1', False))
+        self.assertTrue(duplicates.first('1:10:20', 't2', False))
+        self.assertFalse(duplicates.first('1:10:20', 't2', True))
+        # 只发JSON(编码失败或外部发布)时, 每条都处理
+        self.assertTrue(duplicates.first('1:10:20', 't3', False))
+        self.assertTrue(duplicates.first('1:10:20', 't3', False))
+        self.assertTrue(duplicates.first('1:10:21', 't3', True))
+        self.assertTrue(duplicates.first('1:10:21', 't4', True))
+        self.assertLessEqual(len(duplicates.recent), 3)
+        time.sleep(0.06)
+        self.assertTrue(duplicates.first('1:10:21', 't4', False))
+        self.assertEqual(len(duplicates.recent), 1)
+
+    def test_series_codec(self):
+        data_dict = {'2016-01-02T03:04:05.000010': '2', '2016-01-02T03:04:05': '1.5', '2016-01-01T00:00:00.5': '-3'}
+        times, values = codec.sorted_series(data_dict)
+        self.assertEqual(times, ['2016-01-01T00:00:00.5', '2016-01-02T03:04:05', '2016-01-02T03:04:05.000010'])
+        self.assertEqual(values, [-3.0, 1.5, 2.0])
+        decoded_times, decoded_values = codec.decode_series(codec.encode_series(times, values))
+        self.assertEqual([data_time.isoformat() for data_time in decoded_times],
+                         ['2016-01-01T00:00:00.500000', '2016-01-02T03:04:05', '2016-01-02T03:04:05.000010'])
+        self.assertEqual(decoded_values, values)
+        self.assertEqual(codec.decode_series(codec.encode_series([], [])), ([], []))
+        self.assertRaises(ValueError, codec.parse_time, 'yesterday')
+        self.assertRaises(ValueError, codec.parse_time, '2016-01-01 00:00:00')
+        self.assertRaises(ValueError, codec.parse_time, '2016-01-01')
+        self.assertEqual(codec.parse_time('2016-01-01T00:00:00.5') - codec.parse_time('2016-01-01T00:00:00'), 500000)
+
+    def test_compress(self):
+        self.assertEqual(compress.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(compress.negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(compress.negotiate('br, *;q=0.1'), 'gzip')
+        self.assertEqual(compress.negotiate('gzip;q=0, identity'), None)
+        self.assertEqual(compress.negotiate(None), None)
+        body = b'{"2016-01-02T03:04:05": "1.5"}' * 5000
+        loop = asyncio.new_event_loop()
+        # 超过OFFLOAD_SIZE的在线程池中压缩
+        self.assertEqual(gzip.decompress(loop.run_until_complete(compress.compress(loop, body, 'gzip'))), body)
+        self.assertEqual(zlib.decompress(loop.run_until_complete(compress.compress(loop, body[:100], 'deflate'))),
+                         body[:100])
+        loop.close()
+
+    def test_data_export(self):
+        loop = asyncio.new_event_loop()
+        store = MemoryStore()
+        pool = MemoryPool(store, loop)
+        sync_client = MemorySyncClient(store)
+        times = ['2016-01-01T00:00:{:02d}'.format(idx) for idx in range(50)]
+        for item in ('1:10:1000', '1:10:2000', '2:20:1000'):
+            sync_client.hmset('HS:DATA:{}'.format(item), {data_time: idx for idx, data_time in enumerate(times)})
+            sync_client.rpush('LST:DATA_TIME:{}'.format(item), *(times + times[-1:]))  # 重复追加的时间只导出一次
+            device_id, term_id, item_id = item.split(':')
+            sync_client.sadd('SET:DEVICE', device_id)
+            sync_client.sadd('SET:DEVICE_DATA:{}'.format(device_id), '{}:{}'.format(term_id, item_id))
+
+        async def run(patterns, **kwargs):
+            rows = list()
+
+            async def write(chunk):
+                self.assertLessEqual(len(chunk), 7)
+                rows.extend(chunk)
+            with (await pool) as redis_client:
+                items = await data_export.expand_items(redis_client, patterns)
+            await data_export.export(pool, items, write, chunk_size=7, **kwargs)
+            return rows
+
+        rows = loop.run_until_complete(run(['*:*:1000', '1:10:2000']))
+        self.assertEqual([row[:3] for row in rows[::50]],
+                         [('1', '10', '1000'), ('2', '20', '1000'), ('1', '10', '2000')])
+        self.assertEqual(len(rows), 150)
+        self.assertEqual(rows[0], ('1', '10', '1000', '2016-01-01T00:00:00', 0.0))
+        rows = loop.run_until_complete(run(['1:*:*'], start='2016-01-01T00:00:10', end='2016-01-01T00:00:20'))
+        self.assertEqual([row[3][-2:] for row in rows[:10]], [str(idx) for idx in range(10, 20)])
+        self.assertEqual(len(rows), 20)
+        # 从最后收到的一行之后继续
+        rows = loop.run_until_complete(run(['1:*:*'], start='2016-01-01T00:00:10', end='2016-01-01T00:00:20',
+                                           cursor='1:10:1000:2016-01-01T00:00:17'))
+        self.assertEqual([row[2:4] for row in rows[:3]], [('1000', '2016-01-01T00:00:18'),
+                                                          ('1000', '2016-01-01T00:00:19'),
+                                                          ('2000', '2016-01-01T00:00:10')])
+        self.assertEqual(len(rows), 12)
+        self.assertEqual(data_export.FORMATS['csv'][2](rows[:1]), '1,10,1000,2016-01-01T00:00:18,18.0\n')
+        self.assertRaises(ValueError, data_export.parse_cursor, '1:10:1000')
+        loop.close()
+
+    def test_key_index(self):
+        store = MemoryStore()
+        sync_client = MemorySyncClient(store)
+        sync_client.hmset('HS:TERM:10', {'id': 10, 'device_id': 1})
+        sync_client.hmset('HS:TERM_ITEM:10:1000', {'term_id': 10, 'item_id': 1000})
+        sync_client.hmset('HS:TERM_ITEM:50:1000', {'term_id': 50, 'item_id': 1000})
+        sync_client.hmset('HS:MAPPING:IEC104:1:100', {'term_id': 10, 'item_id': 1000})
+        sync_client.hmset('HS:DATA:1:10:1000', {'2016-01-01T00:00:00': 1})
+        sync_client.hmset('HS:FORMULA:1', {'device_id': 3, 'term_id': 40, 'item_id': 1000})
+        sync_client.sadd('SET:DEVICE_DATA:9', '90:9000')
+        stats = key_index.rebuild(sync_client)
+        self.assertEqual(stats['term_items'], 1)
+        self.assertEqual(stats['orphan_term_items'], 1)
+        self.assertEqual(stats['stale_index_keys'], 1)
+        self.assertEqual(sync_client.smembers('SET:DEVICE_TERM_ITEM:1'), {'10:1000'})
+        self.assertEqual(sync_client.smembers('SET:DEVICE_DATA:1'), {'10:1000'})
+        self.assertEqual(sync_client.smembers('SET:DEVICE_DATA:3'), {'40:1000'})
+        self.assertEqual(sync_client.smembers('SET:ITEM_TERM:1000'), {'1:10', '3:40'})
+        self.assertEqual(sync_client.hgetall('HS:DEVICE_MAPPING:1'), {'10:1000': 'HS:MAPPING:IEC104:1:100'})
+        self.assertFalse(sync_client.exists('SET:DEVICE_DATA:9'))
+
+        loop = asyncio.new_event_loop()
+        pool = MemoryPool(store, loop)
+
+        async def run():
+            with (await pool) as redis_client:
+                keys = list(key_index.data_keys('1', await redis_client.smembers('SET:DEVICE_DATA:1')))
+                self.assertEqual(await key_index.delete_keys(redis_client, keys + ['HS:TERM:10'], chunk_size=1), 2)
+        loop.run_until_complete(run())
+        loop.close()
+        self.assertFalse(sync_client.exists('HS:DATA:1:10:1000'))
+
+    def test_chunked_no_stall(self):
+        store = MemoryStore()
+        sync_client = MemorySyncClient(store)
+        members = ['{}:{}'.format(term_id, item_id) for term_id in range(10, 30) for item_id in range(1000, 3000)]
+        sync_client.sadd(key_index.DEVICE_DATA.format(1), *members)
+        for member in members:
+            sync_client.hmset('HS:DATA:1:{}'.format(member), {'2016-01-01T00:00:00': 1})
+        loop = asyncio.new_event_loop()
+        pool = MemoryPool(store, loop)
+        lags = list()
+
+        async def ticker():
+            while True:
+                begin = loop.time()
+                await asyncio.sleep(0.001, loop=loop)
+                lags.append(loop.time() - begin - 0.001)
+
+        async def run():
+            with (await pool) as redis_client:
+                found = await key_index.scan_members(redis_client, key_index.DEVICE_DATA.format(1), '10:')
+                self.assertEqual(len(found), 2000)
+                await key_index.execute_chunked(redis_client, members, lambda tr, member: tr.srem(
+                    key_index.DEVICE_DATA.format(1), member))
+                deleted = await key_index.delete_keys(redis_client, key_index.data_keys(1, members))
+                self.assertEqual(deleted, len(members))
+        ticker_task = loop.create_task(ticker())
+        loop.run_until_complete(run())
+        ticker_task.cancel()
+        loop.close()
+        self.assertFalse(store.data)
+        # 4万条记录分段处理, 每段之间事件循环都能运行
+        self.assertGreater(len(lags), 20)
+        self.assertLess(max(lags), 0.05)
+
+    def test_config_cache(self):
+        loop = asyncio.new_event_loop()
+        pool = MemoryPool(MemoryStore(), loop)
+        cache = ConfigCache(loop, pool)
+        loads = list()
+
+        def loader(value):
+            async def load():
+                loads.append(value)
+                return 200, value
+            return load
+
+        async def run():
+            await cache.start()
+            entry = await cache.get('HS:DEVICE:1', loader({'id': '1'}))
+            self.assertEqual((entry.status, entry.body), (200, '{"id": "1"}'))
+            self.assertEqual(await cache.get('HS:DEVICE:1', loader({'id': 'x'})), entry)
+            await cache.get('HS:ITEM:1000', loader({'id': '1000'}))
+            with (await pool) as redis_client:
+                await redis_client.publish('CHANNEL:DEVICE_FRESH', '{}')
+            await asyncio.sleep(0.01, loop=loop)
+            self.assertNotIn('HS:DEVICE:1', cache.entries)
+            self.assertIn('HS:ITEM:1000', cache.entries)
+            # 加载期间发生变更, 结果不缓存
+            generation = cache.generation
+
+            async def racing_load():
+                cache.invalidate('CHANNEL:ITEM_DEL')
+                return 200, {'id': 'old'}
+            await cache.get('HS:DEVICE:1', racing_load)
+            self.assertGreater(cache.generation, generation)
+            self.assertNotIn('HS:DEVICE:1', cache.entries)
+            self.assertNotIn('HS:ITEM:1000', cache.entries)
+            await cache.stop()
+            await cache.get('HS:DEVICE:1', loader({'id': '1'}))
+            self.assertFalse(cache.entries)
+        loop.run_until_complete(run())
+        loop.close()
+        self.assertEqual(len(loads), 3)
+        self.assertTrue(etag_matches('"a", W/"b"', '"b"'))
+        self.assertTrue(etag_matches('*', '"b"'))
+        self.assertFalse(etag_matches('"a"', '"b"'))
+        self.assertFalse(etag_matches(None, '"b"'))
+
+    def test_shard_of(self):
+        counts = [0] * 4
+        for device_id in range(1000):
+            shard = shard_of(device_id, 4)
+            self.assertEqual(shard, shard_of(str(device_id), 4))
+            counts[shard] += 1
+        self.assertTrue(all(150 < count < 350 for count in counts))
+        self.assertEqual({shard_of(device_id, 1) for device_id in range(100)}, {0})
+
+    def test_metrics(self):
+        registry = metrics.Registry()
+        requests = registry.register(metrics.Counter, 'test_requests_total', 'requests', ('handler', 'status'))
+        requests.labels('get_device', 200).inc()
+        requests.labels('get_device', 200).inc(2)
+        self.assertIs(registry.register(metrics.Counter, 'test_requests_total', 'requests'), requests)
+        self.assertRaises(ValueError, registry.register, metrics.Gauge, 'test_requests_total', 'requests')
+        self.assertRaises(ValueError, requests.labels, 'get_device')
+        pending = registry.register(metrics.Gauge, 'test_pending', 'pending')
+        pending.inc(3)
+        pending.dec()
+        latency = registry.register(metrics.Histogram, 'test_seconds', 'latency', buckets=(0.1, 1))
+        for value in (0.05, 0.1, 0.5, 2):
+            latency.observe(value)
+        text = metrics.render(OrderedDict([('host/api-0', registry.collect())]))
+        self.assertIn('# TYPE test_requests_total counter\n', text)
+        self.assertIn('test_requests_total{handler="get_device",status="200",process="host/api-0"} 3\n', text)
+        self.assertIn('test_pending{process="host/api-0"} 2\n', text)
+        self.assertIn('test_seconds_bucket{le="0.1",process="host/api-0"} 2\n', text)
+        self.assertIn('test_seconds_bucket{le="1.0",process="host/api-0"} 3\n', text)
+        self.assertIn('test_seconds_bucket{le="+Inf",process="host/api-0"} 4\n', text)
+        self.assertIn('test_seconds_count{process="host/api-0"} 4\n', text)
+        requests.remove('get_device', 200)
+        self.assertEqual(requests.collect()['samples'], [])
+
+        loop = asyncio.new_event_loop()
+        store = MemoryStore()
+        pool = MemoryPool(store, loop)
+        sync_client = MemorySyncClient(store)
+        sync_client.hset(metrics.SNAPSHOT_KEY, 'host/DBSaver-0', json.dumps(
+            {'time': time.time(), 'families': registry.collect()}))
+        sync_client.hset(metrics.SNAPSHOT_KEY, 'host/DBSaver-1', json.dumps(
+            {'time': time.time() - metrics.PUBLISH_INTERVAL * 4, 'families': registry.collect()}))
+
+        async def run():
+            with (await pool) as redis_client:
+                return await metrics.collect_all(redis_client, registry)
+        snapshots = loop.run_until_complete(run())
+        self.assertEqual(list(snapshots), [metrics.process_name(), 'host/DBSaver-0'])
+        self.assertEqual(list(sync_client.hgetall(metrics.SNAPSHOT_KEY)), ['host/DBSaver-0'])  # 过期的快照被删除
+        self.assertIn('test_pending{process="host/DBSaver-0"} 2\n', metrics.render(snapshots))
+        loop.close()
+
+    def test_loop_monitor(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        monitor = LoopMonitor(loop, interval=0.02, threshold=0.05)
+        monitor.start()
+        time.sleep(0.2)  # 事件循环未运行, 不算阻塞
+
+        async def blocking_call():
+            time.sleep(0.3)
+
+        async def run():
+            await asyncio.sleep(0.1)
+            await loop.create_task(blocking_call())
+            await asyncio.sleep(0.1)
+        loop.run_until_complete(run())
+        monitor.stop()
+        loop.close()
+        report = monitor.report()
+        self.assertEqual(report['slow_total'], 1)
+        self.assertGreaterEqual(report['max_lag'], 0.25)
+        event = report['events'][0]
+        self.assertEqual(event['task'], 'UtilTest.test_loop_monitor.<locals>.blocking_call')
+        self.assertTrue(event['stack'][-1].endswith(' blocking_call'))
+        self.assertGreaterEqual(event['blocked'], 0.25)
+
+    def test_profiler(self):
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        prof = profiler.Profiler(loop)
+
+        async def busy_loop():
+            while True:
+                sum(idx * idx for idx in range(10000))
+                await asyncio.sleep(0.001)
+
+        async def run():
+            task = loop.create_task(busy_loop())
+            collapsed, _ = await asyncio.gather(prof.sample(0.5), asyncio.sleep(0.1))
+            first = loop.create_task(prof.sample(0.1))
+            await asyncio.sleep(0)
+            with self.assertRaises(profiler.ProfilerBusy):
+                await prof.sample(0.1)
+            await first
+            stats = marshal.loads(await prof.cprofile(0.2))
+            task.cancel()
+            return collapsed, stats
+        collapsed, stats = loop.run_until_complete(run())
+        loop.close()
+        counts = dict(line.rsplit(' ', 1) for line in collapsed.splitlines())
+        stacks = [stack for stack in counts if stack.startswith('UtilTest.test_profiler.<locals>.busy_loop;')]
+        self.assertTrue(stacks)
+        self.assertGreater(sum(int(counts[stack]) for stack in stacks), 10)
+        self.assertIn('busy_loop', {function for _, _, function in stats})
+        self.assertFalse(prof.busy)
+
+        # 事件循环不在主线程中时不能采样, 失败后不能一直处于busy
+        results = list()
+
+        def sample_in_thread():
+            thread_loop = asyncio.new_event_loop()
+            thread_prof = profiler.Profiler(thread_loop)
+            for _ in range(2):
+                try:
+                    thread_loop.run_until_complete(thread_prof.sample(0.1))
+                except Exception as e:
+                    results.append((type(e), thread_prof.busy))
+            thread_loop.close()
+        thread = threading.Thread(target=sample_in_thread)
+        thread.start()
+        thread.join()
+        self.assertEqual(results, [(ValueError, False), (ValueError, False)])